@@ -2,21 +2,46 @@ CREATE SCHEMA delay;
 COMMENT ON SCHEMA delay IS 'Delay analysis data';
 
 
+CREATE SEQUENCE delay.preprocess_version;
+COMMENT ON SEQUENCE delay.preprocess_version IS
+'Row versions of the preprocess tables.';
+
 CREATE TABLE delay.preprocess_clusters (
     route_id  text NOT NULL,
     oday      DATE NOT NULL,
     mode      text,
     zst       bytea,
+    version   bigint NOT NULL DEFAULT nextval('delay.preprocess_version'),
     PRIMARY KEY (route_id, oday)
 );
+COMMENT ON COLUMN delay.preprocess_clusters.version IS
+'Bumped whenever zst is written. Recluster workers cache zst on local disk by route_id, oday and version,
+and read only this column to check that a cached file is current.';
 
 CREATE TABLE delay.preprocess_departures (
     route_id  text NOT NULL,
     oday      DATE NOT NULL,
     mode      text,
     zst       bytea,
+    version   bigint NOT NULL DEFAULT nextval('delay.preprocess_version'),
+    PRIMARY KEY (route_id, oday)
+);
+COMMENT ON COLUMN delay.preprocess_departures.version IS
+'Bumped whenever zst is written, see delay.preprocess_clusters.version.';
+
+CREATE TABLE delay.preprocess_departure_counts (
+    route_id         text NOT NULL,
+    oday             DATE NOT NULL,
+    direction_ids    smallint[] NOT NULL,
+    time_groups      text[] NOT NULL,
+    departure_counts integer[] NOT NULL,
+    createdAt        timestamptz NOT NULL DEFAULT now(),
     PRIMARY KEY (route_id, oday)
 );
+COMMENT ON TABLE delay.preprocess_departure_counts IS
+'Number of departures in preprocess_departures of a route-day by direction and time group,
+as parallel arrays. Written by preprocessing with the departures and summed by recluster
+analysis instead of reading them.';
 
 CREATE TABLE delay.recluster_routes(
     route_id      text NOT NULL,
@@ -25,13 +50,132 @@ CREATE TABLE delay.recluster_routes(
     mode          text,
     zst           bytea,
     csv_zst       bytea,
+    result        bytea,
+    zip           bytea,
     status        text,
     progress      text,
     days_excluded DATE[] NOT NULL DEFAULT ARRAY[]::DATE[],
+    cost          integer,
+    queue_payload jsonb,
+    attempts      integer NOT NULL DEFAULT 0,
     createdAt     timestamptz NOT NULL DEFAULT now(),
     modifiedAt    timestamptz NULL,
     PRIMARY KEY (route_id, from_oday, to_oday, days_excluded)
 );
+CREATE INDEX ON delay.recluster_routes (createdAt) WHERE status = 'QUEUED';
+COMMENT ON COLUMN delay.recluster_routes.status IS
+'QUEUED jobs wait for a free slot in createdAt order, PENDING jobs have been dispatched to an orchestrator and RUNNING ones are analyzed.';
+COMMENT ON COLUMN delay.recluster_routes.attempts IS
+'Number of times the job has been queued. Precompute stops retrying a failed window after RECLUSTER_PRECOMPUTE_ATTEMPTS.';
+COMMENT ON COLUMN delay.recluster_routes.cost IS
+'Estimated cost of the job as the number of preprocessed route-days in the window, used to limit the jobs running at once.';
+COMMENT ON COLUMN delay.recluster_routes.queue_payload IS
+'Orchestrator payload of a batch or comparison whose jobs are queued together as one entry with their summed cost, NULL for a single job.';
+
+CREATE OR REPLACE FUNCTION delay.notify_recluster_status()
+RETURNS TRIGGER
+VOLATILE
+LANGUAGE plpgsql
+AS $func$
+BEGIN
+  IF TG_OP = 'UPDATE'
+    AND OLD.status IS NOT DISTINCT FROM NEW.status
+    AND OLD.progress IS NOT DISTINCT FROM NEW.progress THEN
+    RETURN NEW;
+  END IF;
+  PERFORM pg_notify(
+    'recluster_status',
+    json_build_object(
+      'route_id', NEW.route_id,
+      'from_oday', NEW.from_oday,
+      'to_oday', NEW.to_oday,
+      'days_excluded', NEW.days_excluded::text
+    )::text
+  );
+  RETURN NEW;
+END;
+$func$;
+COMMENT ON FUNCTION delay.notify_recluster_status IS
+'Notify channel "recluster_status" with the key of a recluster_routes row
+when its status or progress changes. Listened to by the long-poll status endpoint of the API.';
+
+CREATE TRIGGER notify_recluster_status
+AFTER INSERT OR UPDATE OF status, progress ON delay.recluster_routes
+FOR EACH ROW EXECUTE FUNCTION delay.notify_recluster_status();
+COMMENT ON COLUMN delay.recluster_routes.result IS
+'Result as GeoParquet. GeoJSON and CSV are rendered from it on download. zst (GeoJSON) and csv_zst are only set for results stored before it.';
+COMMENT ON COLUMN delay.recluster_routes.zip IS
+'Zip of the GeoJSON and CSV served on download. Built on the first download of a result and cleared when the result is recalculated.';
+
+CREATE TABLE delay.recluster_route_clusters (
+    route_id         text NOT NULL,
+    from_oday        DATE NOT NULL,
+    to_oday          DATE NOT NULL,
+    days_excluded    DATE[] NOT NULL DEFAULT ARRAY[]::DATE[],
+    cluster_no       integer NOT NULL,
+    cluster_route_id text NOT NULL,
+    direction_id     smallint,
+    time_group       text NOT NULL,
+    dclass           text NOT NULL,
+    q_50_category    text,
+    latitude         double precision NOT NULL,
+    longitude        double precision NOT NULL,
+    properties       jsonb NOT NULL,
+    geom             geometry(POINT, 3067) GENERATED ALWAYS AS (ST_Transform(ST_SetSRID(ST_MakePoint(longitude, latitude), 4326), 3067)) STORED,
+    PRIMARY KEY (route_id, from_oday, to_oday, days_excluded, cluster_no),
+    FOREIGN KEY (route_id, from_oday, to_oday, days_excluded)
+        REFERENCES delay.recluster_routes (route_id, from_oday, to_oday, days_excluded) ON DELETE CASCADE
+);
+CREATE INDEX ON delay.recluster_route_clusters USING GIST (geom);
+COMMENT ON TABLE delay.recluster_route_clusters IS
+'Route level clusters of a recluster_routes result as rows for spatial queries, written with the result.
+The job is identified like in recluster_routes, cluster_no is the row number in the result and
+properties has all the columns of the result row.';
+COMMENT ON COLUMN delay.recluster_route_clusters.geom IS
+'Cluster POINT geometry in ETRS-TM35 coordinate system, generated from longitude & latitude.';
+
+CREATE TABLE delay.recluster_group_cache (
+    cache_key   text PRIMARY KEY,
+    labels      bytea NOT NULL,
+    createdAt   timestamptz NOT NULL DEFAULT now()
+);
+COMMENT ON TABLE delay.recluster_group_cache IS
+'Second level DBSCAN labels of a recluster group as zstd compressed int32 array.
+cache_key is a sha256 of the group key, the DBSCAN parameters and the group input rows,
+so any request with the same group input reuses the labels.';
+
+CREATE TABLE delay.recluster_partitions (
+    route_id      text NOT NULL,
+    from_oday     DATE NOT NULL,
+    to_oday       DATE NOT NULL,
+    days_excluded DATE[] NOT NULL DEFAULT ARRAY[]::DATE[],
+    partition_no  smallint NOT NULL,
+    route_ids     text[] NOT NULL,
+    result        bytea,
+    createdAt     timestamptz NOT NULL DEFAULT now(),
+    PRIMARY KEY (route_id, from_oday, to_oday, days_excluded, partition_no)
+);
+COMMENT ON TABLE delay.recluster_partitions IS
+'Route level clusters of the routes route_ids of a recluster job split into partitions, as Parquet.
+The job is identified like in recluster_routes. NULL result if the partition has no clusters.
+Merged into recluster_routes and removed once every partition is done.';
+
+CREATE TABLE delay.recluster_previews (
+    route_id      text NOT NULL,
+    from_oday     DATE NOT NULL,
+    to_oday       DATE NOT NULL,
+    days_excluded DATE[] NOT NULL DEFAULT ARRAY[]::DATE[],
+    status        text,
+    progress      text,
+    result        bytea,
+    createdAt     timestamptz NOT NULL DEFAULT now(),
+    modifiedAt    timestamptz NULL,
+    PRIMARY KEY (route_id, from_oday, to_oday, days_excluded)
+);
+COMMENT ON TABLE delay.recluster_previews IS
+'Approximate delay analytics results computed from a sample of the days of a window, as GeoParquet.
+The job is identified like in recluster_routes. Served on preview requests until the exact result
+is done. NULL result if the preview has no clusters.';
 
 CREATE TABLE delay.recluster_modes (
     route_id  text NOT NULL,
@@ -47,4 +191,29 @@ CREATE TABLE delay.failure_debug_data (
     oday      DATE NOT NULL,
     zst       bytea,
     PRIMARY KEY (route_id, oday)
-);
\ No newline at end of file
+);
+
+CREATE TABLE delay.stage_profile (
+    id          bigserial PRIMARY KEY,
+    job         text NOT NULL,
+    route_id    text NOT NULL,
+    from_oday   DATE,
+    to_oday     DATE,
+    stage       text NOT NULL,
+    calls       integer NOT NULL,
+    wall_s      double precision NOT NULL,
+    cpu_s       double precision NOT NULL,
+    peak_rss_mb double precision NOT NULL,
+    rss_delta_mb double precision NOT NULL,
+    createdAt   timestamptz NOT NULL DEFAULT now()
+);
+COMMENT ON TABLE delay.stage_profile IS
+'Per stage wall time, CPU time and RSS of preprocess and recluster jobs.
+Written only when PROFILING_ENABLED is set. Stages run several times per job are summed, see calls.';
+CREATE INDEX ON delay.stage_profile (job, route_id, createdAt);
+COMMENT ON COLUMN delay.stage_profile.cpu_s IS
+'CPU time of the process and of the child processes that terminated during the stage, e.g. DBSCAN process pools.';
+COMMENT ON COLUMN delay.stage_profile.peak_rss_mb IS
+'Highest RSS of the process sampled during the stage, the largest of all calls.';
+COMMENT ON COLUMN delay.stage_profile.rss_delta_mb IS
+'Growth of the RSS during the stage over the RSS at its start, the largest of all calls.';
@@ -64,7 +64,15 @@ def remove_old_data():
                 logger.debug("Removing delay data older than 12 months")
                 cur.execute("DELETE FROM delay.preprocess_clusters WHERE oday < now() - interval '12 month'")
                 cur.execute("DELETE FROM delay.preprocess_departures WHERE oday < now() - interval '12 month'")
+                cur.execute("DELETE FROM delay.preprocess_departure_counts WHERE oday < now() - interval '12 month'")
                 cur.execute("DELETE FROM delay.recluster_routes WHERE createdAt < now() - interval '12 month'")
+                cur.execute("DELETE FROM delay.stage_profile WHERE createdAt < now() - interval '12 month'")
+                logger.debug("Removing recluster group cache older than 4 weeks")
+                cur.execute("DELETE FROM delay.recluster_group_cache WHERE createdAt < now() - interval '4 week'")
+                # Partitions of failed recluster jobs are never merged
+                cur.execute("DELETE FROM delay.recluster_partitions WHERE createdAt < now() - interval '1 day'")
+                # Previews are only served until the exact result is done
+                cur.execute("DELETE FROM delay.recluster_previews WHERE createdAt < now() - interval '1 week'")
                 # TODO: add createdAt for recluster_modes
                 #cur.execute("DELETE FROM delay.recluster_modes WHERE createdAt < now() - interval '12 month'")
 
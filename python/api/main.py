@@ -1,6 +1,7 @@
 """HFP Analytics REST API"""
 
 import os
+from contextlib import asynccontextmanager
 from typing import Optional
 
 import azure.functions as func
@@ -13,6 +14,7 @@ from fastapi.openapi.docs import (
 from fastapi.responses import HTMLResponse
 
 from api.routers import apc, hfp, journeys, stops, vehicles
+from api.services.hfp import recluster_status_listener
 
 
 async def verify_api_code(
@@ -23,6 +25,14 @@ async def verify_api_code(
     pass
 
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One LISTEN connection per process for the delay analytics status long-polls
+    await recluster_status_listener.start()
+    yield
+    await recluster_status_listener.stop()
+
+
 app = FastAPI(
     title="HSL Analytics REST API",
     version=BUILD_VERSION,
@@ -64,6 +74,7 @@ app = FastAPI(
         },
     },
     dependencies=[Depends(verify_api_code)],
+    lifespan=lifespan,
 )
 
 
@@ -7,7 +7,7 @@ import re
 import time
 from datetime import date, datetime, timedelta, timezone
 from http import HTTPStatus
-from typing import List, Literal, Optional
+from typing import List, Literal, Optional, Tuple
 
 import httpx
 from common.config import DURABLE_BASE_URL
@@ -17,19 +17,23 @@ from common.preprocess import (
     find_missing_preprocess_data_in_db_compared_to_blob_storage,
     get_existing_date_and_route_id_from_preprocess_table,
 )
+from common.recluster import canonicalize_recluster_payload
 from common.utils import (
     create_filename,
     get_target_oday,
     is_date_range_valid,
     set_timezone,
+    tuples_to_feature_collection,
 )
 from fastapi import APIRouter, HTTPException, Query, status
 from fastapi.encoders import jsonable_encoder
 from fastapi.responses import JSONResponse, Response
 
 from api.services.hfp import (
+    get_delay_analytics_clusters,
     get_hfp_data,
     upload_missing_preprocess_data_to_db,
+    wait_delay_analytics_status,
 )
 from api.services.tlp import get_tlp_data, get_tlp_data_as_json
 
@@ -361,6 +365,105 @@ async def get_tlp_raw_data(
             return response
 
 
+def get_delay_analytics_window(
+    from_oday: Optional[date], to_oday: Optional[date]
+) -> tuple[date, date]:
+    """Window of a delay analytics request, the last 15 days by default."""
+    if not from_oday:
+        from_oday = get_target_oday(15)
+    if not to_oday:
+        to_oday = get_target_oday()
+
+    is_date_range_valid_, date_range_validity_message = is_date_range_valid(
+        from_oday=from_oday, to_oday=to_oday
+    )
+    if not is_date_range_valid_:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=date_range_validity_message,
+        )
+    return from_oday, to_oday
+
+
+def parse_route_ids(route_id: Optional[str], loc: str = "route_id") -> List[str]:
+    """Sorted route ids of a comma separated list. Empty list for all routes."""
+    if route_id is None or not route_id.strip():
+        return []
+
+    route_ids = [r.strip() for r in route_id.split(",") if r.strip()]
+    route_ids.sort()
+
+    for rid in route_ids:
+        if not route_id_pattern.match(rid):
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail=[
+                    {
+                        "loc": ["query", loc],
+                        "msg": f"Invalid route ID: {rid}. Only letters and digits allowed.",
+                        "input": rid,
+                    }
+                ],
+            )
+    return route_ids
+
+
+def parse_exclude_dates(exclude_dates: Optional[str], loc: str = "exclude_dates") -> List[str]:
+    """Sorted dates of a comma separated list of YYYY-MM-DD dates."""
+    if exclude_dates is None:
+        return []
+
+    raw_dates = [r.strip() for r in exclude_dates.split(",") if r.strip()]
+    valid_dates = []
+    for d in raw_dates:
+        try:
+            datetime.strptime(d, "%Y-%m-%d")
+            valid_dates.append(d)
+        except ValueError:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail=[
+                    {
+                        "loc": ["query", loc],
+                        "msg": f"Invalid date: {d}. Expected format is YYYY-MM-DD.",
+                        "input": d,
+                    }
+                ],
+            )
+    valid_dates.sort()
+    return valid_dates
+
+
+def parse_bbox(bbox: Optional[str]) -> Optional[Tuple[float, float, float, float]]:
+    """xmin, ymin, xmax, ymax of a comma separated bbox."""
+    if bbox is None or not bbox.strip():
+        return None
+
+    try:
+        xmin, ymin, xmax, ymax = [float(v) for v in bbox.split(",")]
+    except ValueError:
+        xmin = ymin = xmax = ymax = None
+    if xmin is None or xmin > xmax or ymin > ymax:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=[
+                {
+                    "loc": ["query", "bbox"],
+                    "msg": f"Invalid bbox: {bbox}. Expected format is xmin,ymin,xmax,ymax.",
+                    "input": bbox,
+                }
+            ],
+        )
+    return xmin, ymin, xmax, ymax
+
+
+def parse_values(values: Optional[str]) -> List[str]:
+    """Values of a comma separated list."""
+    if values is None:
+        return []
+    return [v.strip() for v in values.split(",") if v.strip()]
+
+
 @router.get(
     "/delay_analytics",
     summary="Get delay analytics data.",
@@ -375,7 +478,10 @@ async def get_tlp_raw_data(
             "content": {"application/gzip": {"schema": None, "example": None}},
         },
         202: {
-            "description": "Status message returned. Analysis queued, running or created, check again later."
+            "description": (
+                "Status message returned. Analysis queued, running or created, check again later. "
+                "A queued analysis waits for running ones to finish, queue_position tells its place in the queue."
+            )
         },
         204: {"description": "Query returned no data with the given parameters."},
         422: {"description": "Query had invalid parameters."},
@@ -422,6 +528,22 @@ async def get_delay_analytics_data_durable(
         ),
         example="2025-04-02,2025-04-03",
     ),
+    preview: bool = Query(
+        default=False,
+        title="Approximate preview",
+        description=(
+            "If the analysis is not done yet, return an approximate result calculated from "
+            "a sample of the days, as clusters_preview.zip. Its rows have approximate set to true. "
+            "The preview is calculated in the background and stored, 202 is returned until it is ready. "
+            "Once the analysis is done the exact data is returned instead. Windows of at most "
+            "RECLUSTER_PREVIEW_DAYS days are analyzed exactly as if preview was not given."
+        ),
+    ),
+    queue_exact: bool = Query(
+        default=True,
+        title="Queue exact analysis with preview",
+        description="Start the exact analysis when a preview is returned.",
+    ),
 ) -> Response:
     """
     # 200: data returned
@@ -430,71 +552,22 @@ async def get_delay_analytics_data_durable(
     # 422: invalid parameters
     """
 
-    default_from_oday = get_target_oday(15)
-    default_to_oday = get_target_oday()
-    if not from_oday:
-        from_oday = default_from_oday
-    if not to_oday:
-        to_oday = default_to_oday
-
-    is_date_range_valid_, date_range_validity_message = is_date_range_valid(
-        from_oday=from_oday, to_oday=to_oday
-    )
-    if not is_date_range_valid_:
-        raise HTTPException(
-            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
-            detail=date_range_validity_message,
-        )
-
-    if route_id is None or not route_id.strip():
-        route_ids = []
-    else:
-        route_ids = [r.strip() for r in route_id.split(",") if r.strip()]
-        route_ids.sort()
-
-        for rid in route_ids:
-            if not route_id_pattern.match(rid):
-                raise HTTPException(
-                    status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
-                    detail=[
-                        {
-                            "loc": ["query", "route_id"],
-                            "msg": f"Invalid route ID: {rid}. Only letters and digits allowed.",
-                            "input": rid,
-                        }
-                    ],
-                )
-
-    if exclude_dates is not None:
-        raw_dates = [r.strip() for r in exclude_dates.split(",") if r.strip()]
-        valid_dates = []
-        for d in raw_dates:
-            try:
-                datetime.strptime(d, "%Y-%m-%d")
-                valid_dates.append(d)
-            except ValueError:
-                raise HTTPException(
-                    status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
-                    detail=[
-                        {
-                            "loc": ["query", "exclude_dates"],
-                            "msg": f"Invalid date: {d}. Expected format is YYYY-MM-DD.",
-                            "input": d,
-                        }
-                    ],
-                )
-        valid_dates.sort()
-        exclude_dates = valid_dates
-    else:
-        exclude_dates = []
+    from_oday, to_oday = get_delay_analytics_window(from_oday, to_oday)
 
     payload = {
-        "route_ids": route_ids,
+        "route_ids": parse_route_ids(route_id),
         "from_oday": str(from_oday),
         "to_oday": str(to_oday),
-        "days_excluded": exclude_dates,
+        "days_excluded": parse_exclude_dates(exclude_dates),
     }
+    if preview:
+        payload["preview"] = True
+        payload["queue_exact"] = queue_exact
+    return await post_to_orchestrator(payload)
+
 
+async def post_to_orchestrator(payload: dict) -> Response:
+    """Pass a delay analytics request to the durable functions and relay the response."""
     try:
         async with httpx.AsyncClient() as client:
             orchestrator_url = f"{DURABLE_BASE_URL}/durable/orchestrator"
@@ -506,6 +579,8 @@ async def get_delay_analytics_data_durable(
                     media_type=resp.headers.get("Content-Type", "application/json"),
                 )
             resp.raise_for_status()
+            if resp.status_code == 204:
+                return Response(status_code=status.HTTP_204_NO_CONTENT)
             try:
                 return resp.json()
             except ValueError:
@@ -514,7 +589,9 @@ async def get_delay_analytics_data_durable(
                     content=resp.content,
                     media_type=resp.headers.get("Content-Type", "application/zip"),
                     headers={
-                        "Content-Disposition": 'attachment; filename="clusters.zip"'
+                        "Content-Disposition": resp.headers.get(
+                            "Content-Disposition", 'attachment; filename="clusters.zip"'
+                        )
                     },
                 )
     except Exception as e:
@@ -524,6 +601,341 @@ async def get_delay_analytics_data_durable(
         )
 
 
+@router.get(
+    "/delay_analytics/batch",
+    summary="Start delay analytics of several route scopes.",
+    description=(
+        "Starts the delay analytics of several route scopes over the same dates, e.g. some routes "
+        "one by one and all of them together. The routes of all scopes are loaded and analyzed once. "
+        "The scopes are queued together as one job, queue_position tells its place in the queue. "
+        "Returns the status of every scope. The data of a scope is downloaded from /hfp/delay_analytics "
+        "with the same route_id, from_oday, to_oday and exclude_dates."
+    ),
+    responses={
+        200: {"description": "All scopes are done."},
+        202: {"description": "Analysis of some scopes is queued or running, check again later."},
+        422: {"description": "Query had invalid parameters."},
+    },
+)
+async def get_delay_analytics_batch(
+    route_scopes: str = Query(
+        title="Route scopes",
+        description=(
+            "Route scopes separated by a semicolon. The route ids of a scope are separated by a comma."
+        ),
+        example="1057;1070;1057,1070",
+    ),
+    from_oday: Optional[date] = Query(
+        default=None,
+        title="From oday (YYYY-MM-DD)",
+        description="As in /hfp/delay_analytics. Default is 15 days prior.",
+        example="2025-04-01",
+    ),
+    to_oday: Optional[date] = Query(
+        default=None,
+        title="To oday (YYYY-MM-DD)",
+        description="As in /hfp/delay_analytics. Default is yesterday.",
+        example="2025-04-07",
+    ),
+    exclude_dates: Optional[str] = Query(
+        default=None,
+        title="Days to exclude (YYYY-MM-DD)",
+        description="As in /hfp/delay_analytics, applied to every scope.",
+        example="2025-04-02,2025-04-03",
+    ),
+) -> Response:
+    from_oday, to_oday = get_delay_analytics_window(from_oday, to_oday)
+
+    scopes = []
+    for scope in route_scopes.split(";"):
+        route_ids = parse_route_ids(scope, loc="route_scopes")
+        if not route_ids:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail=[
+                    {
+                        "loc": ["query", "route_scopes"],
+                        "msg": "Empty route scope.",
+                        "input": route_scopes,
+                    }
+                ],
+            )
+        if route_ids not in scopes:
+            scopes.append(route_ids)
+
+    payload = {
+        "scopes": scopes,
+        "from_oday": str(from_oday),
+        "to_oday": str(to_oday),
+        "days_excluded": parse_exclude_dates(exclude_dates),
+    }
+    return await post_to_orchestrator(payload)
+
+
+@router.get(
+    "/delay_analytics/compare",
+    summary="Compare delay analytics of two periods.",
+    description=(
+        "Compares the delay hotspots of the same routes in two periods. Period A is from_oday - to_oday "
+        "and period B compare_from_oday - compare_to_oday. Both periods are analyzed in one job if not "
+        "done already, and the results are also available from /hfp/delay_analytics. Once both are done, "
+        "returns a zip of the route level clusters matched between the periods. Clusters of the same route, "
+        "direction, time group and delay class match if their centers are within 50 m of each other. "
+        "Every row has q_50, n_departures and share_of_departures of both periods (_a, _b) and their "
+        "delta B - A, and change: matched, new (only in B) or gone (only in A)."
+    ),
+    responses={
+        200: {
+            "description": "The comparison is returned as an attachment in the response.",
+            "content": {"application/zip": {"schema": None, "example": None}},
+        },
+        202: {"description": "Analysis of a period is queued or running, check again later."},
+        204: {"description": "Neither period has clusters."},
+        422: {"description": "Query had invalid parameters."},
+    },
+)
+async def get_delay_analytics_comparison(
+    route_id: Optional[str] = Query(
+        default=None,
+        title="Route ID or Route IDs",
+        description="As in /hfp/delay_analytics.",
+        example="1057,1070",
+    ),
+    from_oday: Optional[date] = Query(
+        default=None,
+        title="From oday of period A (YYYY-MM-DD)",
+        description="As in /hfp/delay_analytics. Default is 15 days prior.",
+        example="2025-05-01",
+    ),
+    to_oday: Optional[date] = Query(
+        default=None,
+        title="To oday of period A (YYYY-MM-DD)",
+        description="As in /hfp/delay_analytics. Default is yesterday.",
+        example="2025-05-14",
+    ),
+    exclude_dates: Optional[str] = Query(
+        default=None,
+        title="Days to exclude from period A (YYYY-MM-DD)",
+        description="As in /hfp/delay_analytics.",
+        example="2025-05-02",
+    ),
+    compare_from_oday: date = Query(
+        title="From oday of period B (YYYY-MM-DD)",
+        example="2025-06-01",
+    ),
+    compare_to_oday: date = Query(
+        title="To oday of period B (YYYY-MM-DD)",
+        example="2025-06-14",
+    ),
+    compare_exclude_dates: Optional[str] = Query(
+        default=None,
+        title="Days to exclude from period B (YYYY-MM-DD)",
+        example="2025-06-06",
+    ),
+) -> Response:
+    from_oday, to_oday = get_delay_analytics_window(from_oday, to_oday)
+    compare_from_oday, compare_to_oday = get_delay_analytics_window(
+        compare_from_oday, compare_to_oday
+    )
+
+    payload = {
+        "route_ids": parse_route_ids(route_id),
+        "from_oday": str(from_oday),
+        "to_oday": str(to_oday),
+        "days_excluded": parse_exclude_dates(exclude_dates),
+        "compare": {
+            "from_oday": str(compare_from_oday),
+            "to_oday": str(compare_to_oday),
+            "days_excluded": parse_exclude_dates(
+                compare_exclude_dates, loc="compare_exclude_dates"
+            ),
+        },
+    }
+    return await post_to_orchestrator(payload)
+
+
+@router.get(
+    "/delay_analytics/status",
+    summary="Wait for a status change of delay analytics.",
+    description=(
+        "Long-polls the status of a delay analytics analysis started from /hfp/delay_analytics. "
+        "The request is held until the status or progress differs from known_status and known_progress, "
+        "or until wait seconds have passed, and the current status is returned. Pass the status and "
+        "progress of the previous response to wait for the next change. Once the status is DONE, "
+        "the data is downloaded from /hfp/delay_analytics. The analysis is not started by this endpoint."
+    ),
+    responses={
+        200: {"description": "Status, progress and queue position of the analysis. Status is null if it has not been started."},
+        422: {"description": "Query had invalid parameters."},
+    },
+)
+async def get_delay_analytics_status(
+    route_id: Optional[str] = Query(
+        default=None,
+        title="Route ID or Route IDs",
+        description="As in /hfp/delay_analytics.",
+        example="1057,1070",
+    ),
+    from_oday: Optional[date] = Query(
+        default=None,
+        title="From oday (YYYY-MM-DD)",
+        description="As in /hfp/delay_analytics. Default is 15 days prior.",
+        example="2025-04-01",
+    ),
+    to_oday: Optional[date] = Query(
+        default=None,
+        title="To oday (YYYY-MM-DD)",
+        description="As in /hfp/delay_analytics. Default is yesterday.",
+        example="2025-04-07",
+    ),
+    exclude_dates: Optional[str] = Query(
+        default=None,
+        title="Days to exclude (YYYY-MM-DD)",
+        description="As in /hfp/delay_analytics.",
+        example="2025-04-02,2025-04-03",
+    ),
+    known_status: Optional[str] = Query(
+        default=None,
+        title="Known status",
+        description="Status of the previous response. Returns right away if the status differs from it.",
+        example="RUNNING",
+    ),
+    known_progress: Optional[str] = Query(
+        default=None,
+        title="Known progress",
+        description="Progress of the previous response. Returns right away if the progress differs from it.",
+        example="100/500",
+    ),
+    wait: int = Query(
+        default=25,
+        ge=0,
+        le=55,
+        title="Wait seconds",
+        description="Longest time to hold the request waiting for a change.",
+    ),
+) -> dict:
+    from_oday, to_oday = get_delay_analytics_window(from_oday, to_oday)
+
+    # Same key as the analysis started by /hfp/delay_analytics
+    payload = canonicalize_recluster_payload(
+        {
+            "route_ids": parse_route_ids(route_id),
+            "from_oday": str(from_oday),
+            "to_oday": str(to_oday),
+            "days_excluded": parse_exclude_dates(exclude_dates),
+        }
+    )
+    with CustomDbLogHandler("api"):
+        job_status = await wait_delay_analytics_status(
+            payload["route_ids"],
+            date.fromisoformat(payload["from_oday"]),
+            date.fromisoformat(payload["to_oday"]),
+            [date.fromisoformat(d) for d in payload["days_excluded"]],
+            known_status,
+            known_progress,
+            wait,
+        )
+    return {**job_status, "params": payload}
+
+
+@router.get(
+    "/delay_analytics/clusters",
+    summary="Get delay analytics clusters in an area.",
+    description=(
+        "Returns the route level clusters of a done delay analytics analysis as a GeoJSON "
+        "FeatureCollection, optionally filtered by bbox, time group, delay class and q_50 category. "
+        "The properties are the columns of the downloaded result. The analysis is not started by "
+        "this endpoint, request /hfp/delay_analytics first."
+    ),
+    response_class=JSONResponse,
+    responses={
+        200: {"description": "Clusters matching the filters."},
+        404: {"description": "The analysis is not done."},
+        422: {"description": "Query had invalid parameters."},
+    },
+)
+async def get_delay_analytics_clusters_in_area(
+    route_id: Optional[str] = Query(
+        default=None,
+        title="Route ID or Route IDs",
+        description="As in /hfp/delay_analytics.",
+        example="1057,1070",
+    ),
+    from_oday: Optional[date] = Query(
+        default=None,
+        title="From oday (YYYY-MM-DD)",
+        description="As in /hfp/delay_analytics. Default is 15 days prior.",
+        example="2025-04-01",
+    ),
+    to_oday: Optional[date] = Query(
+        default=None,
+        title="To oday (YYYY-MM-DD)",
+        description="As in /hfp/delay_analytics. Default is yesterday.",
+        example="2025-04-07",
+    ),
+    exclude_dates: Optional[str] = Query(
+        default=None,
+        title="Days to exclude (YYYY-MM-DD)",
+        description="As in /hfp/delay_analytics.",
+        example="2025-04-02,2025-04-03",
+    ),
+    bbox: Optional[str] = Query(
+        default=None,
+        title="Bounding box",
+        description="xmin,ymin,xmax,ymax in WGS84 (EPSG:4326) longitudes and latitudes.",
+        example="24.93,60.16,24.96,60.18",
+    ),
+    time_group: Optional[str] = Query(
+        default=None,
+        title="Time groups",
+        description="Comma separated list of time groups.",
+        example="0_weekday_all",
+    ),
+    dclass: Optional[str] = Query(
+        default=None,
+        title="Delay classes",
+        description="Comma separated list of delay classes.",
+        example="Pysakki,tl",
+    ),
+    q_50_category: Optional[str] = Query(
+        default=None,
+        title="q_50 categories",
+        description="Comma separated list of q_50 categories.",
+        example="1_30_45,2_45_60",
+    ),
+) -> JSONResponse:
+    from_oday, to_oday = get_delay_analytics_window(from_oday, to_oday)
+
+    # Same key as the analysis started by /hfp/delay_analytics
+    payload = canonicalize_recluster_payload(
+        {
+            "route_ids": parse_route_ids(route_id),
+            "from_oday": str(from_oday),
+            "to_oday": str(to_oday),
+            "days_excluded": parse_exclude_dates(exclude_dates),
+        }
+    )
+    with CustomDbLogHandler("api"):
+        clusters = await get_delay_analytics_clusters(
+            payload["route_ids"],
+            date.fromisoformat(payload["from_oday"]),
+            date.fromisoformat(payload["to_oday"]),
+            [date.fromisoformat(d) for d in payload["days_excluded"]],
+            parse_bbox(bbox),
+            parse_values(time_group),
+            parse_values(dclass),
+            parse_values(q_50_category),
+        )
+
+    if clusters is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Delay analytics is not done for the given parameters. Request /hfp/delay_analytics first.",
+        )
+
+    return JSONResponse(content=tuples_to_feature_collection(geom_tuples=clusters))
+
+
 @router.post(
     "/add_preprocess_data_from_blob_to_db",
     summary="Imports missing preprocess data for clusters and departures from blob storage to database.",
@@ -2,14 +2,30 @@
 Services related to /hfp data endpoint
 """
 
+import asyncio
+import json
 import logging
-from datetime import datetime
+from contextlib import contextmanager, suppress
+from datetime import date, datetime
 from io import BytesIO
-from typing import List, Optional
+from typing import Dict, Iterator, List, Optional, Set, Tuple
 
+import common.constants as constants
+import geopandas as gpd
+import psycopg
+from common.config import POSTGRES_CONNECTION_STRING
 from common.container_client import FlowAnalyticsContainerClient
 from common.database import pool
+from common.enums import ReclusterStatus
 from common.models.hfp import PreprocessBlobModel
+from common.recluster import (
+    format_datetime_columns,
+    get_queue_position,
+    get_recluster_status,
+    load_recluster_geojson,
+    load_recluster_result,
+    store_recluster_clusters,
+)
 
 logger = logging.getLogger("api")
 
@@ -100,3 +116,256 @@ async def upload_missing_preprocess_data_to_db(
         logger.debug(
             f"Successfully added missing blob, [{blob_id + 1}/{blobs_count}] {missing_blob.blob_path}"
         )
+
+
+# Channel notified by the delay.notify_recluster_status trigger
+RECLUSTER_STATUS_CHANNEL = "recluster_status"
+
+
+async def get_delay_analytics_status(
+    route_ids: List[str], from_oday: date, to_oday: date, days_excluded: List[date]
+) -> dict:
+    """Status, progress and queue position of a delay analytics job. Status is None if the job does not exist."""
+    analysis_status = await get_recluster_status(
+        "recluster_routes", from_oday, to_oday, route_ids, days_excluded
+    )
+    status = analysis_status.get("status")
+    queue_position = None
+    if status is not None and status.name == "QUEUED":
+        queue_position = await get_queue_position(route_ids, from_oday, to_oday, days_excluded)
+    return {
+        "status": status.value if status else None,
+        "progress": analysis_status.get("progress"),
+        "queue_position": queue_position,
+    }
+
+
+class ReclusterStatusListener:
+    """
+    LISTEN connection of the process for the notifications of RECLUSTER_STATUS_CHANNEL, fanned
+    out to the requests waiting for a change of a job. Started with the app lifespan, or by the
+    next waiter if the app runs without one or the connection was lost.
+
+    Usage:
+        if await recluster_status_listener.start():
+            with recluster_status_listener.waiter(key) as notified:
+                ...
+                await notified.wait()
+    """
+
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+        self._listening = asyncio.Event()
+        self._waiters: Dict[str, Set[asyncio.Event]] = {}
+
+    def _running(self) -> bool:
+        return (
+            self._task is not None
+            and not self._task.done()
+            and self._task.get_loop() is asyncio.get_running_loop()
+        )
+
+    async def start(self) -> bool:
+        """Start listening unless already listening. Returns whether notifications are listened to."""
+        if not self._running():
+            self._listening = asyncio.Event()
+            self._task = asyncio.create_task(self._listen(self._listening))
+        listening = asyncio.create_task(self._listening.wait())
+        await asyncio.wait({self._task, listening}, return_when=asyncio.FIRST_COMPLETED)
+        listening.cancel()
+        return self._listening.is_set() and not self._task.done()
+
+    async def stop(self) -> None:
+        if self._running():
+            self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
+        self._task = None
+
+    async def _listen(self, listening: asyncio.Event) -> None:
+        try:
+            async with await psycopg.AsyncConnection.connect(
+                POSTGRES_CONNECTION_STRING, autocommit=True
+            ) as conn:
+                await conn.execute(f"LISTEN {RECLUSTER_STATUS_CHANNEL}")
+                listening.set()
+                async for notify in conn.notifies():
+                    key = json.dumps(json.loads(notify.payload), sort_keys=True)
+                    for notified in self._waiters.get(key, ()):
+                        notified.set()
+        except psycopg.Error:
+            logger.exception("Recluster status listener lost its connection")
+        finally:
+            # The waiters read the status instead of waiting for notifications that never come
+            for waiters in self._waiters.values():
+                for notified in waiters:
+                    notified.set()
+
+    @contextmanager
+    def waiter(self, key: dict) -> Iterator[asyncio.Event]:
+        """Event set when the job with the key, as the trigger formats it, is notified or listening stops."""
+        key_json = json.dumps(key, sort_keys=True)
+        notified = asyncio.Event()
+        self._waiters.setdefault(key_json, set()).add(notified)
+        try:
+            yield notified
+        finally:
+            waiters = self._waiters[key_json]
+            waiters.discard(notified)
+            if not waiters:
+                del self._waiters[key_json]
+
+
+recluster_status_listener = ReclusterStatusListener()
+
+
+async def wait_delay_analytics_status(
+    route_ids: List[str],
+    from_oday: date,
+    to_oday: date,
+    days_excluded: List[date],
+    known_status: Optional[str],
+    known_progress: Optional[str],
+    timeout: float,
+) -> dict:
+    """
+    Status of a delay analytics job as soon as its status or progress differs from the known ones,
+    or the current status after timeout seconds.
+
+    Waits for the notifications of the job from recluster_status_listener. The waiter is added
+    before the status is read, so a change in between is not missed. If listening fails, the
+    current status is returned right away.
+    """
+    if not await recluster_status_listener.start():
+        return await get_delay_analytics_status(route_ids, from_oday, to_oday, days_excluded)
+
+    # The key of the job as the trigger formats it
+    async with pool.connection() as conn:
+        cur = await conn.execute(
+            "SELECT %(route_id)s::text, %(days_excluded)s::date[]::text",
+            {"route_id": route_ids, "days_excluded": days_excluded},
+        )
+        route_id_text, days_excluded_text = await cur.fetchone()
+    key = {
+        "route_id": route_id_text,
+        "from_oday": str(from_oday),
+        "to_oday": str(to_oday),
+        "days_excluded": days_excluded_text,
+    }
+
+    with recluster_status_listener.waiter(key) as notified:
+        job_status = await get_delay_analytics_status(route_ids, from_oday, to_oday, days_excluded)
+        if (job_status["status"], job_status["progress"]) != (known_status, known_progress):
+            return job_status
+
+        try:
+            await asyncio.wait_for(notified.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    return await get_delay_analytics_status(route_ids, from_oday, to_oday, days_excluded)
+
+
+async def get_delay_analytics_clusters(
+    route_ids: List[str],
+    from_oday: date,
+    to_oday: date,
+    days_excluded: List[date],
+    bbox: Optional[Tuple[float, float, float, float]],
+    time_groups: List[str],
+    dclasses: List[str],
+    q_50_categories: List[str],
+) -> Optional[List[Tuple]]:
+    """
+    Route level clusters of a done delay analytics job as GeoJSON feature tuples, filtered by
+    bbox (xmin, ymin, xmax, ymax in WGS84) and the given values. None if the job is not done.
+
+    Results stored before delay.recluster_route_clusters have their rows added on first request,
+    from the GeoJSON if the result was stored before GeoParquet.
+    """
+    analysis_status = await get_recluster_status(
+        "recluster_routes", from_oday, to_oday, route_ids, days_excluded
+    )
+    if analysis_status.get("status") != ReclusterStatus.DONE:
+        return None
+
+    params = {
+        "route_id": route_ids,
+        "from_oday": from_oday,
+        "to_oday": to_oday,
+        "days_excluded": days_excluded,
+    }
+    key_conditions = [
+        "route_id = %(route_id)s::text",
+        "from_oday = %(from_oday)s",
+        "to_oday = %(to_oday)s",
+        "days_excluded = %(days_excluded)s::date[]",
+    ]
+    conditions = list(key_conditions)
+    if bbox is not None:
+        conditions.append(
+            "ST_Intersects(geom, ST_Transform(ST_MakeEnvelope(%(xmin)s, %(ymin)s, %(xmax)s, %(ymax)s, 4326), 3067))"
+        )
+        params.update(zip(["xmin", "ymin", "xmax", "ymax"], bbox))
+    for column, values in [
+        ("time_group", time_groups),
+        ("dclass", dclasses),
+        ("q_50_category", q_50_categories),
+    ]:
+        if values:
+            conditions.append(f"{column} = ANY(%({column}s)s::text[])")
+            params[f"{column}s"] = values
+
+    query = f"""
+        SELECT json_build_object(
+            'type', 'Feature',
+            'geometry', ST_AsGeoJSON(ST_Transform(geom, 4326))::json,
+            'properties', properties
+        )
+        FROM delay.recluster_route_clusters
+        WHERE {" AND ".join(conditions)}
+        ORDER BY cluster_no
+    """
+    exists_query = f"""
+        SELECT EXISTS (SELECT 1 FROM delay.recluster_route_clusters WHERE {" AND ".join(key_conditions)})
+    """
+    async with pool.connection() as conn:
+        cur = await conn.execute(query, params)
+        rows = await cur.fetchall()
+        if rows:
+            return rows
+
+        cur = await conn.execute(exists_query, params)
+        has_rows = (await cur.fetchone())[0]
+
+    if has_rows:
+        return rows
+
+    result = await load_recluster_result(
+        "recluster_routes", from_oday, to_oday, days_excluded, route_ids
+    )
+    if result is None:
+        # Results stored before GeoParquet only have the GeoJSON
+        geojson = await load_recluster_geojson(
+            "recluster_routes", from_oday, to_oday, days_excluded, route_ids
+        )
+        if geojson:
+            result = gpd.read_file(BytesIO(geojson))
+            format_datetime_columns(result)
+    if result is None or result.empty:
+        return rows
+
+    async with pool.connection() as conn:
+        # Concurrent requests of the same job add the rows once
+        await conn.execute(
+            "SELECT pg_advisory_xact_lock(%(lock_id)s, hashtext(%(route_id)s::text || %(from_oday)s || %(to_oday)s || %(days_excluded)s::date[]::text))",
+            {"lock_id": constants.RECLUSTER_CLUSTERS_LOCK_ID, **params},
+        )
+        cur = await conn.execute(exists_query, params)
+        if not (await cur.fetchone())[0]:
+            logger.debug(f"Adding {len(result)} route clusters of {route_ids} {from_oday} - {to_oday}")
+            await store_recluster_clusters(
+                conn, route_ids, from_oday, to_oday, days_excluded, result
+            )
+        cur = await conn.execute(query, params)
+        return await cur.fetchall()
@@ -0,0 +1,86 @@
+"""
+Peak memory benchmark for the preprocess data path.
+
+Reads a raw HFP export of one route and day, e.g. a file downloaded from /hfp/data, and runs
+the first level aggregation (common.preprocess.preprocess_dataframe) twice: with default pandas
+dtypes and with the compact dtypes that load_delay_hfp_data uses. Nothing is written to the
+database or to blob storage.
+
+Run from the python directory:
+    python -m benchmarks.preprocess_memory hfp-export_20250506_1057.csv.gz
+"""
+
+import argparse
+import asyncio
+import os
+import time
+import tracemalloc
+
+import pandas as pd
+
+# common.config requires these to be set. The benchmark never connects anywhere.
+REQUIRED_ENVS = [
+    "APC_STORAGE_CONTAINER_NAME",
+    "HFP_STORAGE_CONTAINER_NAME",
+    "HFP_STORAGE_CONNECTION_STRING",
+    "POSTGRES_CONNECTION_STRING",
+    "DURABLE_BASE_URL",
+    "AzureWebJobsStorage",
+    "HFP_EVENTS_TO_IMPORT",
+]
+
+
+def set_benchmark_envs() -> None:
+    for env in REQUIRED_ENVS:
+        os.environ.setdefault(env, "benchmark")
+
+
+def run(path: str, dtype) -> dict:
+    tracemalloc.start()
+    start = time.perf_counter()
+
+    df = pd.read_csv(path, dtype=dtype)
+    frame_mb = df.memory_usage(deep=True).sum() / 1024**2
+    _, read_peak = tracemalloc.get_traced_memory()
+
+    from common.preprocess import preprocess_dataframe
+
+    clusters, departures = preprocess_dataframe(df)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "rows": len(df),
+        "frame_mb": frame_mb,
+        "read_peak_mb": read_peak / 1024**2,
+        "peak_mb": peak / 1024**2,
+        "seconds": time.perf_counter() - start,
+        "clusters": 0 if clusters is None else len(clusters),
+        "departures": 0 if departures is None else len(departures),
+    }
+
+
+async def main(path: str) -> None:
+    # Imported here since common.database opens its connection pool on import,
+    # which requires a running event loop.
+    from common.preprocess import HFP_DTYPES
+
+    results = {
+        "default dtypes": run(path, None),
+        "compact dtypes": run(path, HFP_DTYPES),
+    }
+    for name, r in results.items():
+        print(
+            f"{name:>15}: {r['rows']} rows, frame {r['frame_mb']:.1f} MB, "
+            f"peak after read {r['read_peak_mb']:.1f} MB, peak total {r['peak_mb']:.1f} MB, "
+            f"{r['seconds']:.1f} s, {r['clusters']} clusters, {r['departures']} departures"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Peak memory of the preprocess data path")
+    parser.add_argument("path", help="Raw HFP csv (or csv.gz) of one route and oday")
+    args = parser.parse_args()
+
+    set_benchmark_envs()
+    asyncio.run(main(args.path))
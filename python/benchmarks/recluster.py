@@ -0,0 +1,250 @@
+"""
+End to end benchmark of the recluster analysis on synthetic preprocessed data.
+
+Generates preprocess_clusters and preprocess_departures files for a configurable number of
+routes, days and clusters, writes them with the same code as the preprocess job and runs
+common.recluster.recluster_analysis over them. Reports the time, CPU and peak RSS of every
+stage from the job's own StageProfiler, the number of DBSCAN groups and the size of the result.
+
+Needs a local database with the delay schema, e.g. the one of docker-compose, in
+POSTGRES_CONNECTION_STRING. Blob storage is replaced with a temporary directory. The synthetic
+data uses route ids starting with "BENCH" and days starting from --start-date, and is removed
+after the run unless --keep is given.
+
+Run from the python directory:
+    python -m benchmarks.recluster --routes 20 --days 14
+"""
+
+import argparse
+import asyncio
+import os
+import resource
+import tempfile
+import time
+from datetime import date, timedelta
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.preprocess_memory import set_benchmark_envs
+
+# Same first level clusters as the preprocess job produces
+DCLASSES = ["on_route", "arr", "dep", "pass"]
+ROUTE_PREFIX = "BENCH"
+
+
+class LocalContainerClient:
+    """Stands in for FlowAnalyticsContainerClient, writing blobs under a local directory."""
+
+    root = tempfile.mkdtemp(prefix="recluster_benchmark_")
+
+    async def save_preprocess_data(self, preprocess_type, compressed_csv, route_id, mode, oday):
+        self._write(f"preprocess/{preprocess_type}/{oday}/{oday}_{route_id}_{mode}", compressed_csv)
+
+    async def save_cluster_data(
+        self, recluster_type, compressed_data, from_oday, to_oday, route_id, file_extension=""
+    ):
+        self._write(
+            f"recluster/{recluster_type}/{from_oday}_{to_oday}/{from_oday}_{to_oday}_{route_id}{file_extension}",
+            compressed_data,
+        )
+
+    def _write(self, path: str, data: bytes) -> None:
+        path = os.path.join(self.root, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+
+
+def make_route_day(
+    rng: np.random.Generator,
+    route_id: str,
+    oday: date,
+    hotspots: np.ndarray,
+    departures: int,
+    clusters_per_departure: float,
+):
+    """First level clusters and departures of one route-day, like preprocess_dataframe returns them."""
+    from common.preprocess import TIME_GROUP_D, make_time_groups
+
+    starts = np.sort(rng.integers(5 * 3600, 24 * 3600, departures))
+    departures_df = pd.DataFrame(
+        {
+            "tst": f"{oday}T00:00:00.000Z",
+            "event_type": "DEP",
+            "route_id": route_id,
+            "direction_id": rng.integers(1, 3, departures),
+            "operator_id": 22,
+            "oper": 22,
+            "vehicle_number": rng.integers(1, 1000, departures),
+            "transport_mode": "bus",
+            "oday": str(oday),
+            "start": [f"{s // 3600:02d}:{s % 3600 // 60:02d}:00" for s in starts],
+        }
+    )
+    departures_df["time_group"] = make_time_groups(
+        departures_df[["oday", "start"]].copy(), "oday", "start", TIME_GROUP_D
+    ).to_numpy()
+
+    n_clusters = rng.poisson(clusters_per_departure, departures)
+    rows = departures_df.loc[departures_df.index.repeat(n_clusters)].reset_index(drop=True)
+    # Clusters of one direction gather around the same hotspots, scattered by ~10 m
+    hotspot = rng.integers(0, len(hotspots) // 2, len(rows)) * 2 + rows["direction_id"].to_numpy() - 1
+    position = hotspots[hotspot] + rng.normal(0, 0.0001, (len(rows), 2))
+    clusters_df = pd.DataFrame(
+        {
+            "route_id": route_id,
+            "direction_id": rows["direction_id"],
+            "hdg_median": rng.uniform(0, 360, len(rows)).round(1),
+            "dclass": rng.choice(DCLASSES, len(rows)),
+            "oday": str(oday),
+            "start": rows["start"],
+            "tst_median": rows["tst"],
+            "weight": rng.integers(3, 60, len(rows)),
+            "time_group": rows["time_group"],
+            "lat_median": position[:, 0],
+            "long_median": position[:, 1],
+        }
+    )
+    return clusters_df, departures_df
+
+
+async def write_synthetic_data(args) -> tuple[list[str], int]:
+    """Write the synthetic preprocess files. Returns the route ids and the number of clusters."""
+    from common.preprocess import store_compressed_csv
+
+    rng = np.random.default_rng(args.seed)
+    client = LocalContainerClient()
+    route_ids = [f"{ROUTE_PREFIX}{r:04d}" for r in range(args.routes)]
+    n_clusters = 0
+    for route_id in route_ids:
+        hotspots = rng.uniform([60.15, 24.75], [60.30, 25.15], size=(args.hotspots * 2, 2))
+        for day in range(args.days):
+            oday = args.start_date + timedelta(days=day)
+            clusters_df, departures_df = make_route_day(
+                rng, route_id, oday, hotspots, args.departures, args.density
+            )
+            n_clusters += len(clusters_df)
+            for table, df in [
+                ("preprocess_clusters", clusters_df),
+                ("preprocess_departures", departures_df),
+            ]:
+                await store_compressed_csv(table, route_id, "bus", oday, df, client)
+    return route_ids, n_clusters
+
+
+async def remove_synthetic_data(from_oday: date, to_oday: date) -> None:
+    from common.database import pool
+
+    async with pool.connection() as conn:
+        for table in ["preprocess_clusters", "preprocess_departures", "preprocess_departure_counts"]:
+            await conn.execute(
+                f"DELETE FROM delay.{table} WHERE route_id LIKE %(prefix)s AND oday BETWEEN %(from_oday)s AND %(to_oday)s",
+                {"prefix": f"{ROUTE_PREFIX}%", "from_oday": from_oday, "to_oday": to_oday},
+            )
+        await conn.execute(
+            "DELETE FROM delay.recluster_routes WHERE from_oday = %(from_oday)s AND to_oday = %(to_oday)s AND route_id LIKE %(prefix)s",
+            # route_id holds the route ids of a job as an array literal
+            {"prefix": f"{{{ROUTE_PREFIX}%", "from_oday": from_oday, "to_oday": to_oday},
+        )
+
+
+async def load_stage_profile(route_ids: list[str], from_oday: date, to_oday: date):
+    from common.database import pool
+
+    query = """
+        SELECT DISTINCT ON (stage) stage, calls, wall_s, cpu_s, peak_rss_mb, rss_delta_mb
+        FROM delay.stage_profile
+        WHERE job = 'recluster' AND route_id = %(route_id)s
+          AND from_oday = %(from_oday)s AND to_oday = %(to_oday)s
+        ORDER BY stage, createdAt DESC
+    """
+    async with pool.connection() as conn:
+        cur = await conn.execute(
+            query, {"route_id": ",".join(route_ids), "from_oday": from_oday, "to_oday": to_oday}
+        )
+        return await cur.fetchall()
+
+
+async def main(args) -> None:
+    # Imported here since common.database opens its connection pool on import,
+    # which requires a running event loop.
+    import common.recluster as recluster
+
+    recluster.FlowAnalyticsContainerClient = LocalContainerClient
+    from_oday = args.start_date
+    to_oday = args.start_date + timedelta(days=args.days - 1)
+
+    await remove_synthetic_data(from_oday, to_oday)
+    start = time.perf_counter()
+    route_ids, n_clusters = await write_synthetic_data(args)
+    print(
+        f"Wrote {n_clusters} first level clusters of {len(route_ids)} routes and {args.days} days "
+        f"in {time.perf_counter() - start:.1f} s"
+    )
+
+    # The all-routes mode would also pick up real routes of the database, so the benchmark
+    # always names its routes. --per-route runs them one at a time like the all-routes mode.
+    runs = [[route_id] for route_id in route_ids] if args.per_route else [route_ids]
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    start = time.perf_counter()
+    for run_route_ids in runs:
+        await recluster.recluster_analysis(run_route_ids, from_oday, to_oday, [])
+    total_s = time.perf_counter() - start
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    clusters, _ = await recluster.get_recluster_input(route_ids, from_oday, to_oday, [])
+    plan = recluster.make_recluster_plan(clusters)
+    weights = clusters["weight"].to_numpy()
+    fitted = sum(weights[idx].sum() >= recluster.MIN_WEIGHTED_SAMPLES for _, idx in plan)
+    result_rows = 0
+    for run_route_ids in runs:
+        result = await recluster.load_recluster_result(
+            "recluster_routes", from_oday, to_oday, [], run_route_ids
+        )
+        result_rows += 0 if result is None else len(result)
+
+    print(
+        f"Recluster of {len(runs)} job(s): {total_s:.2f} s, peak RSS {rss_after:.0f} MB "
+        f"({rss_before:.0f} MB before the jobs). DBSCAN groups: {len(plan)}, "
+        f"fitted: {fitted}, route level clusters: {result_rows}"
+    )
+    if len(runs) == 1:
+        for stage, calls, wall_s, cpu_s, peak_rss_mb, rss_delta_mb in await load_stage_profile(
+            route_ids, from_oday, to_oday
+        ):
+            print(
+                f"{stage:>16}: {wall_s:7.2f} s wall, {cpu_s:7.2f} s cpu, "
+                f"{peak_rss_mb:6.0f} MB peak rss, +{rss_delta_mb:5.0f} MB ({calls} calls)"
+            )
+
+    if not args.keep:
+        await remove_synthetic_data(from_oday, to_oday)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="End to end benchmark of the recluster analysis")
+    parser.add_argument("--routes", type=int, default=10)
+    parser.add_argument("--days", type=int, default=14)
+    parser.add_argument("--departures", type=int, default=100, help="Departures per route-day")
+    parser.add_argument(
+        "--density", type=float, default=6, help="Mean number of first level clusters per departure"
+    )
+    parser.add_argument("--hotspots", type=int, default=30, help="Delay hotspots per route and direction")
+    parser.add_argument("--start-date", type=date.fromisoformat, default=date(2000, 1, 3))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--per-route", action="store_true", help="Run one job per route")
+    parser.add_argument("--group-cache", action="store_true", help="Use the DBSCAN group cache")
+    parser.add_argument(
+        "--file-cache", action="store_true", help="Use the local preprocess file cache"
+    )
+    parser.add_argument("--keep", action="store_true", help="Keep the synthetic data in the database")
+    args = parser.parse_args()
+    if not os.getenv("POSTGRES_CONNECTION_STRING"):
+        parser.error("POSTGRES_CONNECTION_STRING of a local database is required")
+
+    set_benchmark_envs()
+    os.environ["PROFILING_ENABLED"] = "true"
+    os.environ["RECLUSTER_GROUP_CACHE"] = "true" if args.group_cache else "false"
+    os.environ["RECLUSTER_FILE_CACHE_MB"] = "2048" if args.file_cache else "0"
+    asyncio.run(main(args))
@@ -0,0 +1,70 @@
+"""
+Second level DBSCAN parameter sweep of the recluster analysis.
+
+Runs common.recluster.recluster_sweep for every combination of the given eps distances and
+min weighted samples over the preprocessed data of a window, in one pass. Prints a summary
+row per setting and optionally writes the route level clusters of all settings to a CSV file
+for comparison, with eps_distance_km and min_weighted_samples columns.
+
+Reads the preprocessed data of the database in POSTGRES_CONNECTION_STRING. Nothing is stored.
+
+Run from the python directory:
+    python -m benchmarks.recluster_sweep --routes 1057,1070 --from-oday 2025-05-01 --to-oday 2025-05-14 \\
+        --eps 0.015,0.02,0.03 --min-weights 40,60,80 --output sweep.csv
+"""
+
+import argparse
+import asyncio
+import itertools
+import os
+import time
+from datetime import date
+
+
+def parse_list(value: str, cast):
+    return [cast(v) for v in value.split(",") if v.strip()]
+
+
+async def main(args) -> None:
+    # Imported here since common.database opens its connection pool on import,
+    # which requires a running event loop.
+    from common.recluster import EPS_DISTANCE_2, MIN_WEIGHTED_SAMPLES, recluster_sweep
+
+    eps = args.eps or [EPS_DISTANCE_2]
+    min_weights = args.min_weights or [MIN_WEIGHTED_SAMPLES]
+    settings = list(itertools.product(eps, min_weights))
+
+    start = time.perf_counter()
+    route_clusters, summary = await recluster_sweep(
+        args.routes, args.from_oday, args.to_oday, args.exclude, settings
+    )
+    print(f"Sweep of {len(settings)} settings in {time.perf_counter() - start:.1f} s")
+    print(summary.to_string(index=False))
+
+    if args.output and route_clusters is not None:
+        route_clusters.to_csv(args.output, index=False)
+        print(f"Wrote {len(route_clusters)} route level clusters to {args.output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Second level DBSCAN parameter sweep")
+    parser.add_argument(
+        "--routes", type=lambda v: parse_list(v, str), default=[], help="Comma separated, all routes if not given"
+    )
+    parser.add_argument("--from-oday", type=date.fromisoformat, required=True)
+    parser.add_argument("--to-oday", type=date.fromisoformat, required=True)
+    parser.add_argument(
+        "--exclude", type=lambda v: parse_list(v, date.fromisoformat), default=[], help="Comma separated days"
+    )
+    parser.add_argument(
+        "--eps", type=lambda v: parse_list(v, float), help="Comma separated eps distances in km"
+    )
+    parser.add_argument(
+        "--min-weights", type=lambda v: parse_list(v, float), help="Comma separated min weighted samples"
+    )
+    parser.add_argument("--output", help="CSV file for the route level clusters of all settings")
+    args = parser.parse_args()
+    if not os.getenv("POSTGRES_CONNECTION_STRING"):
+        parser.error("POSTGRES_CONNECTION_STRING is required")
+
+    asyncio.run(main(args))
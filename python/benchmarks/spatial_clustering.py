@@ -0,0 +1,105 @@
+"""
+Equivalence check and timing of the recluster DBSCAN backends.
+
+Generates synthetic first level clusters around Helsinki and fits every group with
+sklearn DBSCAN (haversine, weighted) and with common.spatial_clustering.weighted_dbscan.
+The labels of every group must be identical. Also checks that weighted_dbscan_sweep gives
+the labels of separate weighted_dbscan calls for several settings. Exits with status 1 if
+any group differs.
+
+Run from the python directory:
+    python -m benchmarks.spatial_clustering --groups 2000
+"""
+
+import argparse
+import sys
+import time
+
+import numpy as np
+
+# Same parameters as common.recluster
+EPS_DISTANCE_KM = 0.02
+EARTH_RADIUS_KM = 6371
+MIN_WEIGHTED_SAMPLES = 60
+# Settings of the sweep check, relative to the above
+SWEEP_EPS_FACTORS = [0.5, 1, 1.5]
+SWEEP_WEIGHT_FACTORS = [0.5, 1, 2]
+
+
+def make_groups(n_groups: int, seed: int):
+    """Coordinates in radians, weights and group codes of synthetic groups."""
+    rng = np.random.default_rng(seed)
+    coords, weights, codes = [], [], []
+    for group in range(n_groups):
+        n_hotspots = rng.integers(1, 8)
+        hotspots = rng.uniform([60.15, 24.70], [60.30, 25.20], size=(n_hotspots, 2))
+        n = rng.integers(5, 400)
+        # Spread of ~10-30 m puts many points right at the 20 m radius
+        spread = rng.uniform(0.00005, 0.0003)
+        points = hotspots[rng.integers(0, n_hotspots, n)] + rng.normal(0, spread, (n, 2))
+        coords.append(np.radians(points.astype(np.float32)))
+        weights.append(rng.integers(1, 40, n).astype(np.int32))
+        codes.append(np.full(n, group))
+    return np.concatenate(coords), np.concatenate(weights), np.concatenate(codes)
+
+
+def main(n_groups: int, seed: int) -> int:
+    from common.spatial_clustering import weighted_dbscan, weighted_dbscan_sweep
+    from sklearn.cluster import DBSCAN
+
+    coords, weights, codes = make_groups(n_groups, seed)
+    epsilon = EPS_DISTANCE_KM / EARTH_RADIUS_KM
+    bounds = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1], True])
+
+    start = time.perf_counter()
+    expected = np.concatenate(
+        [
+            DBSCAN(eps=epsilon, min_samples=MIN_WEIGHTED_SAMPLES, metric="haversine").fit_predict(
+                coords[a:b], sample_weight=weights[a:b]
+            )
+            for a, b in zip(bounds[:-1], bounds[1:])
+        ]
+    )
+    sklearn_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    labels = weighted_dbscan(
+        coords, weights, codes, epsilon, MIN_WEIGHTED_SAMPLES, EARTH_RADIUS_KM
+    )
+    kdtree_s = time.perf_counter() - start
+
+    differing_groups = np.unique(codes[labels != expected])
+    print(
+        f"{len(codes)} points in {n_groups} groups, {int((expected != -1).sum())} clustered. "
+        f"sklearn {sklearn_s:.2f} s, kdtree {kdtree_s:.2f} s. "
+        f"Groups with different labels: {len(differing_groups)}"
+    )
+
+    settings = [
+        (epsilon * eps_factor, MIN_WEIGHTED_SAMPLES * weight_factor)
+        for eps_factor in SWEEP_EPS_FACTORS
+        for weight_factor in SWEEP_WEIGHT_FACTORS
+    ]
+    start = time.perf_counter()
+    separate = [
+        weighted_dbscan(coords, weights, codes, eps, min_weight, EARTH_RADIUS_KM)
+        for eps, min_weight in settings
+    ]
+    separate_s = time.perf_counter() - start
+    start = time.perf_counter()
+    swept = weighted_dbscan_sweep(coords, weights, codes, settings, EARTH_RADIUS_KM)
+    sweep_s = time.perf_counter() - start
+    differing_settings = sum(not np.array_equal(a, b) for a, b in zip(separate, swept))
+    print(
+        f"{len(settings)} settings: separate {separate_s:.2f} s, sweep {sweep_s:.2f} s. "
+        f"Settings with different labels: {differing_settings}"
+    )
+    return 1 if len(differing_groups) or differing_settings else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare recluster DBSCAN backends")
+    parser.add_argument("--groups", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    sys.exit(main(args.groups, args.seed))
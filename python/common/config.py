@@ -32,6 +32,10 @@ def env_as_float(env: str) -> float:
     return float(env)
 
 
+def env_as_bool(env: str) -> bool:
+    return env.strip().lower() in ("1", "true", "yes")
+
+
 def env_as_upper_str(env: str) -> str:
     return env.strip().upper()
 
@@ -89,6 +93,40 @@ IMPORT_COVERAGE_DAYS: int = get_env("IMPORT_COVERAGE_DAYS", "14", modifier=env_a
 # Days to exclude from delay analysis
 DAYS_TO_EXCLUDE: list[str] = get_env("DAYS_TO_EXCLUDE","",modifier=env_as_upper_str_list)
 
+# Opt-in stage profiling of preprocess and recluster jobs, see common/profiler.py
+PROFILING_ENABLED: bool = get_env("PROFILING_ENABLED", "false", modifier=env_as_bool)
+
+# Threads used to decompress and parse the per-day preprocess files of a recluster job
+RECLUSTER_LOAD_WORKERS: int = get_env("RECLUSTER_LOAD_WORKERS", "4", modifier=env_as_int)
+# Processes used to fit the second level DBSCAN groups of a recluster job. 1 fits them in the job process.
+RECLUSTER_WORKERS: int = get_env("RECLUSTER_WORKERS", "4", modifier=env_as_int)
+# Second level DBSCAN implementation of recluster jobs: "kdtree" (common/spatial_clustering.py) or "sklearn"
+RECLUSTER_BACKEND: str = get_env("RECLUSTER_BACKEND", "kdtree")
+# Reuse second level DBSCAN labels of groups with identical input from delay.recluster_group_cache
+RECLUSTER_GROUP_CACHE: bool = get_env("RECLUSTER_GROUP_CACHE", "true", modifier=env_as_bool)
+# Recluster jobs running at once. Further jobs wait in the queue of delay.recluster_routes with status QUEUED.
+RECLUSTER_MAX_CONCURRENT_JOBS: int = get_env("RECLUSTER_MAX_CONCURRENT_JOBS", "2", modifier=env_as_int)
+# Estimated cost, in preprocessed route-days, of the recluster jobs running at once. A single job may exceed it.
+RECLUSTER_MAX_RUNNING_COST: int = get_env("RECLUSTER_MAX_RUNNING_COST", "10000", modifier=env_as_int)
+# Maximum number of activities a recluster job is split into by route, run in parallel with durable fan-out
+RECLUSTER_PARTITIONS: int = get_env("RECLUSTER_PARTITIONS", "8", modifier=env_as_int)
+# Minimum number of routes per recluster partition. Jobs with fewer than twice this many routes run in one activity.
+RECLUSTER_PARTITION_MIN_ROUTES: int = get_env("RECLUSTER_PARTITION_MIN_ROUTES", "10", modifier=env_as_int)
+# Size of the local disk cache of preprocess files read by recluster jobs, see common/file_cache.py. 0 disables it.
+RECLUSTER_FILE_CACHE_MB: int = get_env("RECLUSTER_FILE_CACHE_MB", "2048", modifier=env_as_int)
+# Directory of the preprocess file cache. Empty for recluster_file_cache in the temp directory.
+RECLUSTER_FILE_CACHE_DIR: str = get_env("RECLUSTER_FILE_CACHE_DIR", "")
+# Days sampled from the window for an approximate delay analytics preview
+RECLUSTER_PREVIEW_DAYS: int = get_env("RECLUSTER_PREVIEW_DAYS", "7", modifier=env_as_int)
+# Maximum first level clusters per DBSCAN group in a delay analytics preview, sampled with their weight scaled up
+RECLUSTER_PREVIEW_GROUP_ROWS: int = get_env("RECLUSTER_PREVIEW_GROUP_ROWS", "500", modifier=env_as_int)
+# Lengths in days of the standard delay analytics windows precomputed every night, ending yesterday. 15 is the API default.
+RECLUSTER_PRECOMPUTE_DAYS: list[int] = get_env("RECLUSTER_PRECOMPUTE_DAYS", "7,14,15,28", modifier=env_as_int_list)
+# Routes precomputed one by one for the standard windows in addition to all routes. Empty for all routes only.
+RECLUSTER_PRECOMPUTE_ROUTES: list[str] = get_env("RECLUSTER_PRECOMPUTE_ROUTES", "", modifier=env_as_upper_str_list)
+# Times a standard window is queued by precompute before a failed or stuck analysis of it is no longer retried.
+RECLUSTER_PRECOMPUTE_ATTEMPTS: int = get_env("RECLUSTER_PRECOMPUTE_ATTEMPTS", "3", modifier=env_as_int)
+
 # Authentication str for docs.
 DEFAULT_AUTH_CODE: str = get_env("DEFAULT_AUTH_CODE", "")
 
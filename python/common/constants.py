@@ -1 +1,3 @@
 IMPORTER_LOCK_ID = 10
+RECLUSTER_QUEUE_LOCK_ID = 11
+RECLUSTER_CLUSTERS_LOCK_ID = 12
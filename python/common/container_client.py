@@ -45,10 +45,11 @@ class FlowAnalyticsContainerClient:
         from_oday: str,
         to_oday: str,
         route_id: str,
+        file_extension: str = "",
     ) -> None:
         metadata = {"from_oday": from_oday, "to_oday": to_oday, "route_id": route_id}
 
-        path = f"recluster/{recluster_type}/{from_oday}_{to_oday}/{from_oday}_{to_oday}_{route_id}"
+        path = f"recluster/{recluster_type}/{from_oday}_{to_oday}/{from_oday}_{to_oday}_{route_id}{file_extension}"
 
         async with self._get_container_client() as client:
             await client.upload_blob(
@@ -0,0 +1,122 @@
+"""Local disk cache of the preprocess files read by recluster jobs"""
+
+import hashlib
+import logging
+import mmap
+import os
+import tempfile
+from datetime import date
+from typing import Optional
+
+from common.config import RECLUSTER_FILE_CACHE_DIR, RECLUSTER_FILE_CACHE_MB
+
+logger = logging.getLogger("importer")
+
+
+class PreprocessFileCache:
+    """
+    Size bounded LRU cache of the zst files of the preprocess tables on local disk.
+
+    A file is stored under the hash of (table, route_id, oday, version), where version is the
+    row version of the preprocess table that is bumped whenever the file is written again. A
+    cached file is thus never stale: a new version gets a new name and the old one is evicted
+    in time. Reading a file touches its mtime, and the least recently used files are removed
+    once the cache grows over max_bytes.
+
+    Files are written atomically through a temporary file, so several worker processes of the
+    same host can share the directory.
+
+    Usage:
+        cache = get_preprocess_file_cache()
+        data = cache.read("preprocess_clusters", "1057", oday, version)
+        if data is None:
+            cache.write("preprocess_clusters", "1057", oday, version, zst)
+        else:
+            ...
+            data.close()
+        cache.evict()
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, table: str, route_id: str, oday: date, version: int) -> str:
+        key = f"{table}/{route_id}/{oday}/{version}".encode("utf-8")
+        return os.path.join(self.directory, hashlib.sha256(key).hexdigest() + ".zst")
+
+    def contains(self, table: str, route_id: str, oday: date, version: int) -> bool:
+        return os.path.exists(self.path(table, route_id, oday, version))
+
+    def read(
+        self, table: str, route_id: str, oday: date, version: int
+    ) -> Optional[mmap.mmap]:
+        """
+        Memory mapped file, None if not cached. The caller closes the map soon, as it
+        keeps a file descriptor open.
+        """
+        path = self.path(table, route_id, oday, version)
+        try:
+            with open(path, "rb") as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            os.utime(path)
+        except (FileNotFoundError, ValueError):
+            # ValueError is raised for an empty file, which is never written
+            return None
+        return data
+
+    def write(self, table: str, route_id: str, oday: date, version: int, data: bytes) -> None:
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, self.path(table, route_id, oday, version))
+        except OSError:
+            logger.exception("Failed to write preprocess file cache")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def evict(self) -> None:
+        """Remove the least recently used files until the cache fits in max_bytes."""
+        files = []
+        total_bytes = 0
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+                total_bytes += stat.st_size
+
+        if total_bytes <= self.max_bytes:
+            return
+
+        removed = 0
+        for _, size, path in sorted(files):
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
+            removed += 1
+        logger.debug(f"Evicted {removed} files from preprocess file cache")
+
+
+_cache: Optional[PreprocessFileCache] = None
+
+
+def get_preprocess_file_cache() -> Optional[PreprocessFileCache]:
+    """The cache configured with RECLUSTER_FILE_CACHE_DIR and _MB, None if disabled."""
+    global _cache
+    if RECLUSTER_FILE_CACHE_MB <= 0:
+        return None
+    if _cache is None:
+        directory = RECLUSTER_FILE_CACHE_DIR or os.path.join(
+            tempfile.gettempdir(), "recluster_file_cache"
+        )
+        _cache = PreprocessFileCache(directory, RECLUSTER_FILE_CACHE_MB * 1024 * 1024)
+    return _cache
@@ -2,17 +2,19 @@ import logging
 from collections import Counter
 from datetime import date, datetime, time, timedelta
 from io import BytesIO
-from typing import List, Optional
+from typing import Any, Dict, List, Optional, Tuple
 
 import numpy as np
 import pandas as pd
 import pytz
 import zstandard as zstd
+from psycopg import AsyncConnection
 from sklearn.cluster import DBSCAN
 
 from common.container_client import FlowAnalyticsContainerClient
 from common.database import pool
 from common.models.hfp import PreprocessBlobModel, PreprocessDBDistinctModel
+from common.profiler import StageProfiler
 
 logger = logging.getLogger("analyzer")
 
@@ -57,12 +59,46 @@ TIME_GROUP_D = {
     }
 }
 
-async def load_delay_hfp_data(route_id: Optional[str], oday: date) -> pd.DataFrame:
+# Compact dtypes for the columns of api.view_as_original_hfp_event. Low cardinality text columns
+# are categorical, measurements float32 and nullable integers use the pandas masked types.
+HFP_DTYPES = {
+    "event_type": "category",
+    "route_id": "category",
+    "direction_id": "Int8",
+    "operator_id": "int16",
+    "oper": "Int16",
+    "vehicle_number": "int32",
+    "transport_mode": "category",
+    "oday": "category",
+    "start": "category",
+    # float64 like read_csv gives: the speed classes are bounded by speeds derived from
+    # these and the coordinates are clustered with a 10 m radius, float32 would move events
+    # across the boundaries
+    "odo": "float64",
+    "spd": "float64",
+    "drst": "float64",
+    "loc": "category",
+    "stop": "Int32",
+    "hdg": "float32",
+    "long": "float64",
+    "lat": "float64",
+}
+
+DEPARTURE_COLUMNS = ['tst', 'event_type', 'route_id', 'direction_id', 'operator_id', 'oper', 'vehicle_number', 'transport_mode', 'oday', 'start', 'time_group']
+
+async def load_delay_hfp_data(
+    route_id: Optional[str],
+    oday: date,
+    profiler: Optional[StageProfiler] = None,
+) -> pd.DataFrame:
+    profiler = profiler or StageProfiler.disabled()
     csv_buffer = BytesIO()
-    await get_delay_hfp_data(route_id, oday, csv_buffer)
+    with profiler.stage("fetch"):
+        await get_delay_hfp_data(route_id, oday, csv_buffer)
     csv_buffer.seek(0)
 
-    df = pd.read_csv(csv_buffer)
+    with profiler.stage("parse"):
+        df = pd.read_csv(csv_buffer, dtype=HFP_DTYPES)
     return df
 
 async def get_delay_hfp_data(
@@ -196,6 +232,40 @@ async def find_missing_preprocess_data_in_db_compared_to_blob_storage(db_data: L
             
     
 
+def count_departures(departures: pd.DataFrame) -> Dict[str, list]:
+    """
+    Departures of one route-day by direction and time group,
+    as the array columns of delay.preprocess_departure_counts.
+    """
+    grouped = departures.groupby(["direction_id", "time_group"], observed=True).size()
+    return {
+        "direction_ids": [int(direction_id) for direction_id, _ in grouped.index],
+        "time_groups": [str(time_group) for _, time_group in grouped.index],
+        "departure_counts": [int(n) for n in grouped],
+    }
+
+
+async def store_departure_counts(
+    rows: List[Dict[str, Any]], conn: Optional[AsyncConnection] = None
+) -> None:
+    """Upsert rows of delay.preprocess_departure_counts, on conn if given."""
+    query = """
+        INSERT INTO delay.preprocess_departure_counts (route_id, oday, direction_ids, time_groups, departure_counts)
+        VALUES (%(route_id)s, %(oday)s, %(direction_ids)s, %(time_groups)s, %(departure_counts)s)
+        ON CONFLICT (route_id, oday) DO UPDATE
+            SET direction_ids    = EXCLUDED.direction_ids,
+                time_groups      = EXCLUDED.time_groups,
+                departure_counts = EXCLUDED.departure_counts,
+                createdAt        = now()
+    """
+    if conn is None:
+        async with pool.connection() as conn:
+            await store_departure_counts(rows, conn)
+        return
+    async with conn.cursor() as cur:
+        await cur.executemany(query, rows)
+
+
 async def store_compressed_csv(
     table: str,
     route_id: str,
@@ -203,16 +273,20 @@ async def store_compressed_csv(
     oday: date,
     df: pd.DataFrame,
     flow_analytics_container_client: FlowAnalyticsContainerClient,
+    profiler: Optional[StageProfiler] = None,
 ):
     """
     Store df as a compressed CSV into the database table "schema.table".
+    Departures also get their counts stored in delay.preprocess_departure_counts.
     """
-    csv_buffer = BytesIO()
-    df.to_csv(csv_buffer, sep=";", encoding="utf-8", index=False)
-    csv_buffer.seek(0)
-    csv_bytes = csv_buffer.getvalue()
+    profiler = profiler or StageProfiler.disabled()
+    with profiler.stage("compression"):
+        csv_buffer = BytesIO()
+        df.to_csv(csv_buffer, sep=";", encoding="utf-8", index=False)
+        csv_buffer.seek(0)
+        csv_bytes = csv_buffer.getvalue()
 
-    compressed_csv = compress_csv_bytes_to_zst(csv_bytes)
+        compressed_csv = compress_csv_bytes_to_zst(csv_bytes)
 
     table_full_name = f"delay.{table}"
     query = f"""
@@ -220,28 +294,36 @@ async def store_compressed_csv(
         VALUES (%(route_id)s, %(mode)s, %(oday)s, %(zst)s)
         ON CONFLICT (route_id, oday) DO UPDATE
             SET oday      = EXCLUDED.oday,
-                zst       = EXCLUDED.zst
+                zst       = EXCLUDED.zst,
+                version   = DEFAULT
     """
 
-    async with pool.connection() as conn:
-        await conn.execute(
-            query,
-            {
-                "route_id": route_id,
-                "mode": mode,
-                "oday": oday,
-                "zst": compressed_csv,
-            },
-        )
-    
+    with profiler.stage("db_write"):
+        async with pool.connection() as conn:
+            await conn.execute(
+                query,
+                {
+                    "route_id": route_id,
+                    "mode": mode,
+                    "oday": oday,
+                    "zst": compressed_csv,
+                },
+            )
+            if table == "preprocess_departures":
+                # Written with the file so that recluster never needs to read it for the counts
+                await store_departure_counts(
+                    [{"route_id": route_id, "oday": oday, **count_departures(df)}], conn
+                )
+
     preprocess_type = table.split('_')[1]
-    await flow_analytics_container_client.save_preprocess_data(
-        preprocess_type=preprocess_type,
-        compressed_csv=compressed_csv,
-        route_id=route_id,
-        mode=mode,
-        oday=oday.strftime("%Y-%m-%d"),
-    )
+    with profiler.stage("blob_write"):
+        await flow_analytics_container_client.save_preprocess_data(
+            preprocess_type=preprocess_type,
+            compressed_csv=compressed_csv,
+            route_id=route_id,
+            mode=mode,
+            oday=oday.strftime("%Y-%m-%d"),
+        )
 
 async def check_preprocessed_files(route_id: str, oday: date, table: str) -> bool:
     """
@@ -259,16 +341,215 @@ async def check_preprocessed_files(route_id: str, oday: date, table: str) -> boo
         row = await result_cursor.fetchone()
         return row and row[0] > 0
 
+def classify_events(
+    drst: np.ndarray,
+    mean_spd: np.ndarray,
+    stop: np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Speed class and delay class of the VP events of one departure in tst order.
+
+    Args:
+        drst: door status, NaN if missing
+        mean_spd: mean of the odometer and reported speeds
+        stop: stop of the event, 0 if none
+
+    Returns:
+        Tuple of sclass and dclass arrays.
+    """
+    # Speed classes
+    drst = np.where(np.isnan(drst), 2, drst)
+    doors_closed = drst == 0
+    sclass = np.select(
+        [
+            doors_closed & (mean_spd < SPEED_CLASSES["DELAY"]["DELAY_MAX"]),
+            doors_closed & (mean_spd >= SPEED_CLASSES["SLOW"]["SLOW_MIN"]) & (mean_spd <= SPEED_CLASSES["SLOW"]["SLOW_MAX"]),
+            doors_closed & (mean_spd > SPEED_CLASSES["FAST"]["FAST_MIN"]),
+            ~doors_closed & (mean_spd < 1),
+            ~doors_closed & (mean_spd >= 1),
+            drst == 2,
+        ],
+        ["DELAY", "SLOW", "FAST", "STOP", "SPD_ERR", "DRS_ERR"],
+        default="",
+    )
+
+    # Delay classes. Events of a stop where the doors were both opened and closed are
+    # "arr" before the doors opened for the first time, "dep" after they opened for the
+    # last time and "stop" in between.
+    # NOTE ajantasauksissa seisotaan paikoillaan ovet kiinni, niiden käsittely olisi oma hommansa, jota ei ole nyt huomioitu koodissa
+    position = np.arange(len(stop))
+    doors_by_stop = pd.DataFrame(
+        {
+            "stop": stop,
+            "closed": doors_closed,
+            "opened": drst == 1,
+            "unknown": drst == 2,
+            "opened_position": np.where(drst == 1, position, np.nan),
+        }
+    ).groupby("stop")
+    opened_and_closed = (
+        doors_by_stop["closed"].transform("any")
+        & doors_by_stop["opened"].transform("any")
+        & ~doors_by_stop["unknown"].transform("any")
+    ).to_numpy()
+    first_opened = doors_by_stop["opened_position"].transform("min").to_numpy()
+    last_opened = doors_by_stop["opened_position"].transform("max").to_numpy()
+    dclass = np.select(
+        [
+            stop == 0,
+            opened_and_closed & (position < first_opened),
+            opened_and_closed & (position > last_opened),
+            opened_and_closed,
+        ],
+        ["on_route", "arr", "dep", "stop"],
+        default="pass",
+    )
+    return sclass, dclass
+
+
+def preprocess_dataframe(
+    df: pd.DataFrame,
+    profiler: Optional[StageProfiler] = None,
+) -> Tuple[Optional[pd.DataFrame], Optional[pd.DataFrame]]:
+    """
+    Aggregation level 1 for one day of HFP data: quality checks, speed and delay classes
+    and DBSCAN of the delay events for every departure.
+
+    Runs with copy-on-write so that the per departure slices are views of the day's data
+    and are copied only when a column is actually modified.
+
+    Returns:
+        Tuple of first level clusters and departures. Either is None if nothing was found.
+    """
+    profiler = profiler or StageProfiler.disabled()
+    clusters = []  # tämä on aggregoinnin tason 1 output!,
+    departure_labels = []  # tämä on aggregoinnin tason 1 output!,
+
+    failed_in_quality_count = 0
+    timezone = pytz.timezone("Europe/Helsinki")
+
+    with pd.option_context("mode.copy_on_write", True):
+        with profiler.stage("parse"):
+            # Only positioned VP events are analyzed. Filter, deduplicate and sort them once
+            # for the whole day instead of separately for every departure.
+            df = df[df["loc"].isin(["GPS", "DR"]) & (df["event_type"] == "VP")]
+            df["oday"] = pd.to_datetime(df.oday)
+            df['stop'] = df['stop'].astype('Int32')
+            df["tst"] = pd.to_datetime(df.tst, format="ISO8601").dt.tz_convert(timezone)
+            df['time_group'] = make_time_groups(df, "oday", "start", TIME_GROUP_D)
+            df = df.drop_duplicates().sort_values(by="tst", kind="stable")
+
+        # for every departure:
+        g = df.groupby(
+            [
+                "route_id",
+                "direction_id",
+                "oday",
+                "start",
+                "vehicle_number",
+            ],
+            observed=True,
+        )  # veh number should not s_and_d_s_and_d_s_and_d_change during a departure but just to be careful keep it in!,
+        for key, vp_event_df in g:
+            with profiler.stage("quality_checks"):
+                # Helper variables
+                vp_event_df = tst_seconds_from_midnight(vp_event_df)
+                vp_event_df["diff_btwn_tsts"] = np.append([0], np.diff(vp_event_df["tst_seconds_from_midnight"]))
+                vp_event_df["diff_btwn_tsts"] = np.where(vp_event_df["diff_btwn_tsts"] == -60 * 60 * 24 + 1, 1, vp_event_df["diff_btwn_tsts"])
+                vp_event_df["hdg"] = vp_event_df["hdg"].ffill().bfill()
+                vp_event_df["diff_btwn_hdg"] = np.append([0], np.diff(vp_event_df["hdg"]))
+
+                errors = []
+                if (vp_event_df["drst"] == 0.0).all():
+                    errors.append('ERR_all_door_status_closed')
+                if (vp_event_df["drst"] == 1.0).all():
+                    errors.append('ERR_all_door_status_open')
+                if vp_event_df['drst'].isna().all():
+                    errors.append('ERR_all_door_status_NA')
+                if len(vp_event_df) <= 5:
+                    errors.append('ERR_too_few_VP')
+                if vp_event_df['stop'].isna().all():
+                    errors.append('ERR_no_route_stops')
+                if pd.isna(vp_event_df["odo"]).all():
+                    errors.append('ERR_all_odo_NA')
+                if pd.isna(vp_event_df["lat"]).all():
+                    errors.append('ERR_all_lat_NA')
+                if pd.isna(vp_event_df["long"]).all():
+                    errors.append('ERR_all_long_NA')
+                if (vp_event_df["lat"] == 0.0).all():
+                    errors.append('ERR_all_lat_0')
+                if (vp_event_df["long"] == 0.0).all():
+                    errors.append('ERR_all_long_0')
+                if any(vp_event_df.diff_btwn_tsts > MAX_TIME_GAP):
+                    errors.append('ERR_too_long_time_gap')
+                if any((np.abs(vp_event_df.diff_btwn_hdg).between(HDG_DIFF_LOWER_LIMIT, HDG_DIFF_UPPER_LIMIT, inclusive='both')) & (vp_event_df.spd > HDG_SPEED_LIMIT)):
+                    errors.append('ERR_heading_diff_error')
+                if errors:
+                    failed_in_quality_count += 1
+                    continue
+
+                # Remove data before first stop and after last stop
+                stop_positions = np.flatnonzero(vp_event_df["stop"].notna().to_numpy())
+                vp_event_df = vp_event_df.iloc[stop_positions[0] : stop_positions[-1] + 1]
+
+            departure_labels.append(vp_event_df.index[0])
+
+            with profiler.stage("classification"):
+                vp_event_df = vp_event_df.dropna(subset=["lat", "long"], how="all")
+                vp_event_df["odo_spd"] = np.append(np.nan, np.diff(vp_event_df["odo"]))
+                vp_event_df["odo_spd"] = vp_event_df["odo_spd"].rolling(window=5, min_periods=1).mean()
+                vp_event_df["odo_spd"] = vp_event_df["odo_spd"] / vp_event_df["diff_btwn_tsts"]
+                vp_event_df["odo_spd"] = vp_event_df["odo_spd"].ffill().bfill()
+                vp_event_df["mean_spd"] = vp_event_df[["odo_spd", "spd"]].mean(axis=1)
+
+                sclass, dclass = classify_events(
+                    vp_event_df["drst"].to_numpy(dtype="float64", na_value=np.nan),
+                    vp_event_df["mean_spd"].to_numpy(),
+                    vp_event_df["stop"].fillna(0).to_numpy(dtype="int64"),
+                )
+                vp_event_df["dclass"] = dclass
+
+                # NOTE: pysäkillä seisominen käsitetään matkustajapalveluksi tai pysäkkiajaksi, ei viiveeksi
+                delay_df = vp_event_df[(dclass != "stop") & np.isin(sclass, SPEEDS_IN_DELAY)]
+
+            # aggregation level 1
+            if not delay_df.empty:
+                with profiler.stage("dbscan"):
+                    groups = delay_df.groupby('dclass')
+                    for _, delay_class_df in groups:
+                        # vp_events_in_clusters.append(delay_class_df)
+                        EPSILON = EPS_DISTANCE_1 / EARHT_RADIUS_KM
+                        X = np.radians(delay_class_df[['lat', 'long']])
+                        dbscan = DBSCAN(eps=EPSILON, min_samples=MIN_DELAY_EVENTS, metric='haversine')
+                        delay_class_df['cluster'] = dbscan.fit_predict(X)
+                        delay_class_df = delay_class_df[delay_class_df['cluster'] != -1]
+
+                        if not delay_class_df.empty:
+                            my_vars = ['route_id', 'direction_id', 'dclass', 'oday', 'start', 'time_group', 'cluster']
+                            cluster_counts = delay_class_df.groupby(my_vars, observed=True).size().reset_index(name='weight')
+                            median_vars = delay_class_df.groupby(my_vars, observed=True)[['lat', 'long', 'tst', 'hdg']].median().reset_index()
+                            cluster_df = median_vars.merge(cluster_counts, on=my_vars, how='outer')
+                            cluster_df = cluster_df[['route_id', 'direction_id', 'hdg', 'dclass', 'oday', 'start', 'tst', 'weight', 'time_group', 'lat', 'long']].rename(
+                                columns={'tst': 'tst_median', 'hdg': 'hdg_median', 'lat': 'lat_median', 'long': 'long_median'}
+                            )
+                            clusters.append(cluster_df)
+
+        if failed_in_quality_count:
+            logger.debug(f"{failed_in_quality_count} departures failed in quality checks.")
+
+        clusters_df = pd.concat(clusters) if clusters else None
+        departures_df = df.loc[departure_labels, DEPARTURE_COLUMNS] if departure_labels else None
+
+    return clusters_df, departures_df
+
+
 async def preprocess(
     df: pd.DataFrame,
     route_id: str,
     oday: date,
+    profiler: Optional[StageProfiler] = None,
 ):
-    clusters = []  # tämä on aggregoinnin tason 1 output!,
-    departures = []  # tämä on aggregoinnin tason 1 output!,
-
-    failed_in_quality = []
-    timezone = pytz.timezone("Europe/Helsinki")
+    profiler = profiler or StageProfiler.disabled()
     counts = Counter(df.oday)
     if not counts:
         raise ValueError("No oday found. Skipping")
@@ -280,157 +561,11 @@ async def preprocess(
     else:
         logger.debug("No transport_mode found.")
 
-    df["oday"] = pd.to_datetime(df.oday)
-    df['stop'] = df['stop'].astype('Int64')
-    df.tst = pd.to_datetime(df.tst, format="ISO8601").dt.tz_convert(timezone)
-    df['time_group'] = make_time_groups(df, "oday", "start", TIME_GROUP_D)
-    # for every departure:
-    g = df.groupby(
-        [
-            "route_id",
-            "direction_id",
-            "oday",
-            "start",
-            "vehicle_number",
-        ]
-    )  # veh number should not s_and_d_s_and_d_s_and_d_change during a departure but just to be careful keep it in!,
-    for key, sub_df in g:
-        sub_df = sub_df.reset_index(drop=True)
-        
-        sub_df = sub_df[sub_df["loc"].isin(["GPS", "DR"])].reset_index(drop=True)
-        if sub_df.empty:
-            continue
-
-        vp_event_df = sub_df[(sub_df["event_type"] == "VP")]
-        if vp_event_df.empty:
-            continue
-
-        vp_event_df = vp_event_df.drop_duplicates().sort_values(by="tst").reset_index(drop=True)
-        # Helper variables
-        vp_event_df = tst_seconds_from_midnight(vp_event_df)
-        vp_event_df["diff_btwn_tsts"] = np.append([0], np.diff(vp_event_df["tst_seconds_from_midnight"]))
-        vp_event_df["diff_btwn_tsts"] = np.where(vp_event_df["diff_btwn_tsts"] == -60 * 60 * 24 + 1, 1, vp_event_df["diff_btwn_tsts"])
-        vp_event_df["hdg"] = vp_event_df["hdg"].ffill().bfill()
-        vp_event_df["diff_btwn_hdg"] = np.append([0], np.diff(vp_event_df["hdg"]))
-        vp_event_df = vp_event_df.reset_index(drop=True)
-
-        if (vp_event_df["drst"] == 0.0).all():
-            vp_event_df['ERR_all_door_status_closed'] = True
-        if (vp_event_df["drst"] == 1.0).all():
-            vp_event_df['ERR_all_door_status_open'] = True
-        if vp_event_df['drst'].isna().all():
-            vp_event_df['ERR_all_door_status_NA'] = True
-        if len(vp_event_df) <= 5:
-            vp_event_df['ERR_too_few_VP'] = True
-        if vp_event_df['stop'].isna().all():
-            vp_event_df['ERR_no_route_stops'] = True
-        if pd.isna(vp_event_df["odo"]).all():
-            vp_event_df['ERR_all_odo_NA'] = True
-        if pd.isna(vp_event_df["lat"]).all():
-            vp_event_df['ERR_all_lat_NA'] = True
-        if pd.isna(vp_event_df["long"]).all():
-            vp_event_df['ERR_all_long_NA'] = True
-        if (vp_event_df["lat"] == 0.0).all():
-            vp_event_df['ERR_all_lat_0'] = True
-        if (vp_event_df["long"] == 0.0).all():
-            vp_event_df['ERR_all_long_0'] = True
-        if any(vp_event_df.diff_btwn_tsts > MAX_TIME_GAP):
-            vp_event_df['ERR_too_long_time_gap'] = True
-        if any((np.abs(vp_event_df.diff_btwn_hdg).between(HDG_DIFF_LOWER_LIMIT, HDG_DIFF_UPPER_LIMIT, inclusive='both')) & (vp_event_df.spd > HDG_SPEED_LIMIT)):
-            vp_event_df['ERR_heading_diff_error'] = True
-        if [x for x in vp_event_df.columns if x.startswith('ERR')]:
-            failed_in_quality.append(vp_event_df)
-            continue
-
-        # Remove data before first stop and after last stop
-        vp_event_df = vp_event_df.loc[vp_event_df[pd.notna(vp_event_df.stop)].head(1).index.values[0] :,].reset_index(drop=True)
-        if vp_event_df.empty:
-            continue
-        vp_event_df = vp_event_df.loc[: vp_event_df[pd.notna(vp_event_df.stop)].tail(1).index.values[0],].reset_index(drop=True)
-        if vp_event_df.empty:
-            continue
-
-        departures.append(
-            vp_event_df.head(1).reset_index(drop=True)[['tst', 'event_type', 'route_id', 'direction_id', 'operator_id', 'oper', 'vehicle_number', 'transport_mode', 'oday', 'start', 'time_group']]
-        )
-
-        vp_event_df = vp_event_df.dropna(subset=["lat", "long"], how="all")
-        vp_event_df = vp_event_df.sort_values(by="tst").reset_index(drop=True)
-        vp_event_df["odo_spd"] = np.append(np.nan, np.diff(vp_event_df["odo"]))
-        vp_event_df["odo_spd"] = vp_event_df["odo_spd"].rolling(window=5, min_periods=1).mean()
-        vp_event_df["odo_spd"] = vp_event_df["odo_spd"] / vp_event_df["diff_btwn_tsts"]
-        vp_event_df["odo_spd"] = vp_event_df["odo_spd"].ffill().bfill()
-        vp_event_df["mean_spd"] = vp_event_df[["odo_spd", "spd"]].mean(axis=1)
-
-        # Speed classes
-        vp_event_df["drst"] = vp_event_df["drst"].fillna(2)
-        vp_event_df["sclass"] = ""
-        doors_closed = vp_event_df[vp_event_df["drst"] == 0]
-
-        for k, v in SPEED_CLASSES.items():
-            if "SLOW_MIN" in v:
-                doors_closed.loc[doors_closed["mean_spd"].between(v["SLOW_MIN"], v["SLOW_MAX"]), "sclass"] = k
-            elif "DELAY_MAX" in v:
-                doors_closed.loc[doors_closed["mean_spd"] < v["DELAY_MAX"], "sclass"] = k
-            else:
-                doors_closed.loc[doors_closed["mean_spd"] > v["FAST_MIN"], "sclass"] = k
-
-        doors_opened = vp_event_df[vp_event_df["drst"] != 0]
-        doors_opened.loc[doors_opened["drst"] == 2, "sclass"] = "DRS_ERR"
-        doors_opened.loc[doors_opened["mean_spd"] < 1, "sclass"] = "STOP"
-        doors_opened.loc[doors_opened["mean_spd"] >= 1, "sclass"] = "SPD_ERR"
-        
-        # Delay classes
-        vp_event_df = pd.concat([doors_closed, doors_opened], axis=0).sort_values(by="tst").reset_index(drop=True)
-        vp_event_df['stop'] = vp_event_df['stop'].fillna(0)
-        g = vp_event_df.groupby('stop')
-        dfs = []
-        for k, res in g:
-            if k == 0:
-                res['dclass'] = 'on_route'
-            elif set(res.drst) == {1, 0}:
-                idx_doors_open_first_time = res[res.drst == 1].sort_values(by='tst').head(1).index.values[0]
-                # NOTE ajantasauksissa seisotaan paikoillaan ovet kiinni, niiden käsittely olisi oma hommansa, jota ei ole nyt huomioitu koodissa
-                res['dclass'] = np.where((res.index < idx_doors_open_first_time) & (pd.notna(res.stop)), "arr", "stop")
-                idx_doors_close_last_time = res[res.drst == 1].sort_values(by='tst').tail(1).index.values[0]
-                res['dclass'] = np.where((res.index > idx_doors_close_last_time) & (pd.notna(res.stop)), "dep", res['dclass'])
-            else:
-                res['dclass'] = np.where(pd.notna(res.stop), "pass", "")
-            dfs.append(res)
-
-        dfs = pd.concat(dfs)
-        # NOTE: pysäkillä seisominen käsitetään matkustajapalveluksi tai pysäkkiajaksi, ei viiveeksi
-        dfs = dfs[dfs.dclass != "stop"]
-        vp_event_df = dfs.sort_values(by='tst').reset_index(drop=True)
-        # speed_in_location.append(vp_event_df)
-        delay_df = vp_event_df[vp_event_df['sclass'].isin(['DELAY', 'SLOW'])].copy()
-
-        # aggregation level 1
-        if not delay_df.empty:
-            groups = delay_df.groupby('dclass')
-            for _, delay_class_df in groups:
-                # vp_events_in_clusters.append(delay_class_df)
-                EPSILON = EPS_DISTANCE_1 / EARHT_RADIUS_KM
-                X = np.radians(delay_class_df[['lat', 'long']])
-                dbscan = DBSCAN(eps=EPSILON, min_samples=MIN_DELAY_EVENTS, metric='haversine')
-                delay_class_df['cluster'] = dbscan.fit_predict(X)
-                delay_class_df = delay_class_df[delay_class_df['cluster'] != -1]
-            
-                if not delay_class_df.empty:
-                    my_vars = ['route_id', 'direction_id', 'dclass', 'oday', 'start', 'time_group', 'cluster']
-                    cluster_counts = delay_class_df.groupby(my_vars).size().reset_index(name='weight')
-                    median_vars = delay_class_df.groupby(my_vars)[['lat', 'long', 'tst', 'hdg']].median().reset_index()
-                    cluster_df = median_vars.merge(cluster_counts, on=my_vars, how='outer')
-                    cluster_df = cluster_df[['route_id', 'direction_id', 'hdg', 'dclass', 'oday', 'start', 'tst', 'weight', 'time_group', 'lat', 'long']].rename(
-                        columns={'tst': 'tst_median', 'hdg': 'hdg_median', 'lat': 'lat_median', 'long': 'long_median'}
-                    )
-                    clusters.append(cluster_df)
-    
+    clusters_df, departures_df = preprocess_dataframe(df, profiler)
 
     flow_analytics_container_client = FlowAnalyticsContainerClient()
-    
-    if clusters:
-        clusters_df = pd.concat(clusters)
+
+    if clusters_df is not None:
         await store_compressed_csv(
             "preprocess_clusters",
             route_id,
@@ -438,9 +573,9 @@ async def preprocess(
             oday,
             clusters_df,
             flow_analytics_container_client=flow_analytics_container_client,
+            profiler=profiler,
         )
-    if departures:
-        departures_df = pd.concat(departures)
+    if departures_df is not None:
         await store_compressed_csv(
             "preprocess_departures",
             route_id,
@@ -448,12 +583,8 @@ async def preprocess(
             oday,
             departures_df,
             flow_analytics_container_client=flow_analytics_container_client,
+            profiler=profiler,
         )
     #if vp_events_in_clusters:
         #path = f"./HFP_vp_events_in_clusters_{str(key[0])}_{file_date}.csv"
         #pd.concat(vp_events_in_clusters).to_csv(path, sep=";", encoding="utf-8", index=False)
-    #if failed_in_quality:
-        #path = f"./failure_debug_data_{str(key[0])}_{file_date}.csv"
-        #pd.concat(failed_in_quality).to_csv(path, sep=";", encoding="utf-8", index=False)
-    # path = f"./auxillary/failed_in_quality/failure_debug_data_{k[0]}_{file_date}.csv"
-    # pd.concat(failed_in_quality).to_csv(path, sep=";", encoding="utf-8", index=False)"
@@ -0,0 +1,181 @@
+"""Opt-in stage profiling for the delay analysis jobs (preprocess and recluster)"""
+
+import logging
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from datetime import date
+from typing import Optional
+
+from common.config import PROFILING_ENABLED
+from common.database import pool
+
+logger = logging.getLogger("importer")
+
+
+# Interval of the RSS samples taken while stages run
+RSS_SAMPLE_INTERVAL_S = 0.05
+
+PAGE_SIZE_MB = os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+
+
+def get_rss_mb() -> float:
+    """Current resident set size of the process in megabytes, from /proc/self/statm."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * PAGE_SIZE_MB
+    except OSError:
+        # No procfs, e.g. on macOS: peak RSS of the process, ru_maxrss is in bytes there
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024)
+
+
+def get_children_cpu_s() -> float:
+    """CPU time of the terminated child processes, e.g. of a ProcessPoolExecutor shut down in a stage."""
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class RssSampler:
+    """
+    Thread sampling the RSS of the process while stages are open. Each open stage holds the
+    highest sample taken since it started, so concurrent and nested stages get their own peaks.
+    """
+
+    def __init__(self, interval_s: float = RSS_SAMPLE_INTERVAL_S):
+        self.interval_s = interval_s
+        self.lock = threading.Lock()
+        self.peaks: dict[int, float] = {}
+        self.thread: Optional[threading.Thread] = None
+        self.next_id = 0
+
+    def open(self, rss_mb: float) -> int:
+        with self.lock:
+            stage_id = self.next_id
+            self.next_id += 1
+            self.peaks[stage_id] = rss_mb
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+        return stage_id
+
+    def close(self, stage_id: int, rss_mb: float) -> float:
+        """Peak RSS of the stage, including rss_mb at its end."""
+        with self.lock:
+            return max(self.peaks.pop(stage_id), rss_mb)
+
+    def run(self) -> None:
+        while True:
+            rss_mb = get_rss_mb()
+            with self.lock:
+                if not self.peaks:
+                    self.thread = None
+                    return
+                for stage_id, peak in self.peaks.items():
+                    if rss_mb > peak:
+                        self.peaks[stage_id] = rss_mb
+            time.sleep(self.interval_s)
+
+
+rss_sampler = RssSampler()
+
+
+class StageProfiler:
+    """
+    Collects wall time, CPU time and RSS per named stage of a job.
+
+    CPU time includes the child processes that terminated during the stage, so the process
+    pools of the DBSCAN stage are counted. RSS is sampled by rss_sampler while the stage runs:
+    peak_rss_mb is the highest RSS during the stage and rss_delta_mb its growth over the RSS
+    at the start of the stage, the largest of all calls for both.
+
+    Stages entered several times, e.g. once per departure or per DBSCAN group, are summed up
+    and the number of calls is recorded. When profiling is disabled every method is a no-op,
+    so the stages can be wrapped unconditionally in the job code.
+
+    Usage:
+        profiler = StageProfiler("recluster", route_id="1057", from_oday=..., to_oday=...)
+        with profiler.stage("load"):
+            ...
+        await profiler.store()
+    """
+
+    def __init__(
+        self,
+        job: str,
+        route_id: str = "",
+        from_oday: Optional[date] = None,
+        to_oday: Optional[date] = None,
+        enabled: bool = PROFILING_ENABLED,
+    ):
+        self.job = job
+        self.route_id = route_id or ""
+        self.from_oday = from_oday
+        self.to_oday = to_oday
+        self.enabled = enabled
+        self.stages: dict[str, dict] = {}
+
+    @classmethod
+    def disabled(cls) -> "StageProfiler":
+        return cls("", enabled=False)
+
+    @contextmanager
+    def stage(self, name: str):
+        if not self.enabled:
+            yield
+            return
+
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time() + get_children_cpu_s()
+        rss_start = get_rss_mb()
+        sample_id = rss_sampler.open(rss_start)
+        try:
+            yield
+        finally:
+            peak_rss = rss_sampler.close(sample_id, get_rss_mb())
+            stats = self.stages.setdefault(
+                name,
+                {"calls": 0, "wall_s": 0.0, "cpu_s": 0.0, "peak_rss_mb": 0.0, "rss_delta_mb": 0.0},
+            )
+            stats["calls"] += 1
+            stats["wall_s"] += time.perf_counter() - wall_start
+            stats["cpu_s"] += time.process_time() + get_children_cpu_s() - cpu_start
+            stats["peak_rss_mb"] = max(stats["peak_rss_mb"], peak_rss)
+            stats["rss_delta_mb"] = max(stats["rss_delta_mb"], peak_rss - rss_start)
+
+    def summary(self) -> str:
+        return ", ".join(
+            f"{name}: {s['wall_s']:.2f}s wall, {s['cpu_s']:.2f}s cpu, {s['peak_rss_mb']:.0f}MB peak rss, +{s['rss_delta_mb']:.0f}MB ({s['calls']} calls)"
+            for name, s in self.stages.items()
+        )
+
+    async def store(self) -> None:
+        """Write collected stages to delay.stage_profile, one row per stage."""
+        if not self.enabled or not self.stages:
+            return
+
+        logger.debug(f"Stage profile for {self.job} {self.route_id}: {self.summary()}")
+
+        query = """
+            INSERT INTO delay.stage_profile (job, route_id, from_oday, to_oday, stage, calls, wall_s, cpu_s, peak_rss_mb, rss_delta_mb)
+            VALUES (%(job)s, %(route_id)s, %(from_oday)s, %(to_oday)s, %(stage)s, %(calls)s, %(wall_s)s, %(cpu_s)s, %(peak_rss_mb)s, %(rss_delta_mb)s)
+        """
+        rows = [
+            {
+                "job": self.job,
+                "route_id": self.route_id,
+                "from_oday": self.from_oday,
+                "to_oday": self.to_oday,
+                "stage": name,
+                **stats,
+            }
+            for name, stats in self.stages.items()
+        ]
+        try:
+            async with pool.connection() as conn:
+                async with conn.cursor() as cur:
+                    await cur.executemany(query, rows)
+        except Exception as e:
+            # Profiling must never fail the job itself
+            logger.debug(f"Could not store stage profile: {e}")
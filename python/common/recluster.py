@@ -2,20 +2,62 @@
 import asyncio
 import functools
 import gc
+import hashlib
 import io
+import itertools
+import json
 import logging
-from datetime import date, datetime
-from typing import Any, Dict, List, Optional
-
+import tempfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
+
+import common.constants as constants
 import geopandas as gpd
 import numpy as np
 import pandas as pd
 import zstandard as zstd
+from common.config import (
+    RECLUSTER_BACKEND,
+    RECLUSTER_GROUP_CACHE,
+    RECLUSTER_LOAD_WORKERS,
+    RECLUSTER_MAX_CONCURRENT_JOBS,
+    RECLUSTER_MAX_RUNNING_COST,
+    RECLUSTER_PARTITION_MIN_ROUTES,
+    RECLUSTER_PARTITIONS,
+    RECLUSTER_PREVIEW_DAYS,
+    RECLUSTER_PREVIEW_GROUP_ROWS,
+    RECLUSTER_WORKERS,
+)
 from common.container_client import FlowAnalyticsContainerClient
 from common.database import pool
 from common.enums import ReclusterStatus
+from common.file_cache import PreprocessFileCache, get_preprocess_file_cache
 from common.logger_util import CustomDbLogHandler
+from common.preprocess import store_departure_counts
+from common.profiler import StageProfiler
+from common.recluster_groups import (
+    GroupPlan,
+    fit_groups,
+    make_batches,
+    make_group_plan,
+    plan_column,
+)
+from common.spatial_clustering import match_nearest, weighted_dbscan_sweep
 from common.utils import get_season
+from psycopg import AsyncConnection
+from psycopg.types.json import Jsonb
 from sklearn.cluster import DBSCAN
 
 logger = logging.getLogger("api")
@@ -30,6 +72,8 @@ HDG_DIFF_LOWER_LIMIT = 170
 HDG_DIFF_UPPER_LIMIT = 190
 MIN_DELAY_EVENTS = 5
 MIN_WEIGHTED_SAMPLES = 60
+# Longest distance between the centers of the same cluster in two compared periods
+COMPARISON_MATCH_DISTANCE_M = 50
 SPEEDS_IN_DELAY = ["DELAY", "SLOW"]
 SPEED_CLASSES = {
     "DELAY": {
@@ -71,15 +115,95 @@ def get_routes_condition(column: str, values: list[str]) -> tuple[str, dict]:
     return condition, params
 
 
-# Refactor with load_compressed_departures_csv
-async def load_preprocess_files(
+PREPROCESS_CLUSTERS_DTYPES = {
+    "route_id": "object",
+    "direction_id": "int8",
+    "hdg_median": "float32",
+    "dclass": "object",
+    "weight": "int32",
+    "time_group": "object",
+    "lat_median": "float32",
+    "long_median": "float32",
+    "oday": "object",
+    "start": "object",
+    "tst_median": "object",
+}
+
+PREPROCESS_DEPARTURES_DTYPES = {
+    "event_type": "category",
+    "route_id": "object",
+    "direction_id": "int8",
+    "operator_id": "int16",
+    "oper": "int8",
+    "vehicle_number": "int16",
+    "transport_mode": "object",
+    "time_group": "object",
+    "oday": "object",
+    "start": "object",
+    "tst": "object",
+}
+
+
+DEPARTURE_COUNT_KEYS = ["route_id", "direction_id", "time_group"]
+# Second level DBSCAN groups of the recluster analysis
+RECLUSTER_GROUP_BY = ["route_id", "direction_id", "time_group", "dclass"]
+
+# Features or rows rendered at a time when a result is downloaded
+RENDER_BATCH_ROWS = 5000
+# Route-day files fetched per round trip when streaming preprocess files
+LOAD_FETCH_ROWS = 16
+# Zip of a result is built in memory up to this size, then in a temporary file
+ZIP_SPOOL_MAX_BYTES = 64 * 1024**2
+
+
+def parse_preprocess_file(compressed_data: bytes, dtypes: Dict[str, str]) -> pd.DataFrame:
+    """
+    Decompress and parse one route-day file of a preprocess table.
+    Runs in a worker thread, so a decompressor is created per call as they are not thread safe.
+    """
+    decompressed_csv = zstd.ZstdDecompressor().decompress(compressed_data)
+    return pd.read_csv(io.BytesIO(decompressed_csv), sep=";", dtype=dtypes)
+
+
+def parse_cached_file(
+    cache: PreprocessFileCache,
+    table: str,
+    route_id: str,
+    oday: date,
+    version: int,
+    dtypes: Dict[str, str],
+) -> Optional[pd.DataFrame]:
+    """parse_preprocess_file of a file in the preprocess file cache, None if it is not there."""
+    data = cache.read(table, route_id, oday, version)
+    if data is None:
+        return None
+    try:
+        return parse_preprocess_file(data, dtypes)
+    finally:
+        data.close()
+
+
+def cache_and_parse_file(
+    cache: PreprocessFileCache,
+    table: str,
+    route_id: str,
+    oday: date,
+    version: int,
+    compressed_data: bytes,
+    dtypes: Dict[str, str],
+) -> pd.DataFrame:
+    """Write a file loaded from the database to the preprocess file cache and parse it."""
+    cache.write(table, route_id, oday, version, compressed_data)
+    return parse_preprocess_file(compressed_data, dtypes)
+
+
+def get_window_conditions(
     route_ids: Optional[List[str]],
     from_oday: date,
     to_oday: date,
     exclude_dates: Optional[List[date]],
-    table: str,
-) -> bytes:
-    base_query = f"SELECT zst FROM delay.{table}"
+) -> Tuple[List[str], Dict[str, Any]]:
+    """WHERE conditions and params selecting the route-days of an analysis window."""
     conditions = []
     params = {}
     conditions.append("oday >= %(from_oday)s::date")
@@ -96,43 +220,177 @@ async def load_preprocess_files(
         conditions.append("oday <> ALL (%(exclude_dates)s::date[])")
         params["exclude_dates"] = exclude_dates
 
-    query = base_query
-    if conditions:
-        query += " WHERE " + " AND ".join(conditions)
+    return conditions, params
 
-    async with pool.connection() as conn:
-        cur = await conn.execute(query, params)
-        results = await cur.fetchall()
 
-    if not results:
-        return None
+async def load_cached_preprocess_files(
+    cache: PreprocessFileCache,
+    table: str,
+    where: str,
+    order_by: str,
+    params: Dict[str, Any],
+    dtypes: Dict[str, str],
+    executor: ThreadPoolExecutor,
+    profiler: StageProfiler,
+) -> List[pd.DataFrame]:
+    """
+    Parsed files of load_preprocess_files in row order, read from the preprocess file cache
+    where their current version is cached and from the database otherwise.
+    """
+    loop = asyncio.get_running_loop()
+    with profiler.stage("load"):
+        async with pool.connection() as conn:
+            cur = await conn.execute(
+                f"SELECT route_id, oday, version FROM delay.{table}{where}{order_by}",
+                params,
+            )
+            versions = await cur.fetchall()
+
+    parsed = [None] * len(versions)
+
+    async def load_from_db(file_nos: List[int]) -> None:
+        file_no_by_key = {versions[file_no][:2]: file_no for file_no in file_nos}
+        query = f"""
+            SELECT route_id, oday, version, zst
+            FROM delay.{table}
+            WHERE (route_id, oday) IN (SELECT * FROM unnest(%(route_day_ids)s::text[], %(route_day_odays)s::date[]))
+        """
+        async with pool.connection() as conn:
+            async with conn.cursor(name=f"load_{table}") as cur:
+                cur.itersize = LOAD_FETCH_ROWS
+                await cur.execute(
+                    query,
+                    {
+                        "route_day_ids": [route_id for route_id, _ in file_no_by_key],
+                        "route_day_odays": [oday for _, oday in file_no_by_key],
+                    },
+                )
+                async for route_id, oday, version, zst in cur:
+                    parsed[file_no_by_key[(route_id, oday)]] = loop.run_in_executor(
+                        executor,
+                        cache_and_parse_file,
+                        cache,
+                        table,
+                        route_id,
+                        oday,
+                        version,
+                        zst,
+                        dtypes,
+                    )
+
+    missing = []
+    for file_no, (route_id, oday, version) in enumerate(versions):
+        if cache.contains(table, route_id, oday, version):
+            parsed[file_no] = loop.run_in_executor(
+                executor, parse_cached_file, cache, table, route_id, oday, version, dtypes
+            )
+        else:
+            missing.append(file_no)
+    logger.debug(
+        f"{table} files from cache: {len(versions) - len(missing)}, to load: {len(missing)}"
+    )
+    if missing:
+        with profiler.stage("load"):
+            await load_from_db(missing)
+
+    with profiler.stage("decompress"):
+        dfs = [None if future is None else await future for future in parsed]
+
+    # Files evicted by another job after the check are loaded from the database after all
+    evicted = [
+        file_no
+        for file_no, (df, future) in enumerate(zip(dfs, parsed))
+        if df is None and future is not None
+    ]
+    if evicted:
+        parsed = [None] * len(versions)
+        with profiler.stage("load"):
+            await load_from_db(evicted)
+        with profiler.stage("decompress"):
+            for file_no in evicted:
+                if parsed[file_no] is not None:
+                    dfs[file_no] = await parsed[file_no]
+
+    await loop.run_in_executor(executor, cache.evict)
+    # Files removed from the table while loading are skipped
+    return [df for df in dfs if df is not None]
 
-    dfs = []
-    decompressor = zstd.ZstdDecompressor()
 
-    for r in results:
-        compressed_data = r[0]
-        decompressed_csv = decompressor.decompress(compressed_data)
-        df = pd.read_csv(io.BytesIO(decompressed_csv), sep=";")
-        if "tst_median" in df.columns:
-            df["tst_median"] = pd.to_datetime(
-                df["tst_median"], format="ISO8601"
-            ).dt.tz_convert("UTC")
-        dfs.append(df)
+async def load_preprocess_files(
+    route_ids: Optional[List[str]],
+    from_oday: date,
+    to_oday: date,
+    exclude_dates: Optional[List[date]],
+    table: str,
+    dtypes: Dict[str, str],
+    profiler: Optional[StageProfiler] = None,
+    route_days: Optional[List[Tuple[str, date]]] = None,
+) -> Optional[pd.DataFrame]:
+    """
+    Load the route-day files of a preprocess table as one typed dataframe.
+    Rows are streamed through a server-side cursor and every file is handed to the
+    worker threads for decompression and parsing as soon as it arrives.
+    route_days limits the window to the given (route_id, oday) pairs.
 
+    With the preprocess file cache enabled only the row versions are read first, and
+    only the files not found in the cache are loaded from the database.
+    """
+    profiler = profiler or StageProfiler.disabled()
+    conditions, params = get_window_conditions(
+        route_ids, from_oday, to_oday, exclude_dates
+    )
 
-    if not dfs:
-        return None
+    if route_days is not None:
+        conditions.append(
+            "(route_id, oday) IN (SELECT * FROM unnest(%(route_day_ids)s::text[], %(route_day_odays)s::date[]))"
+        )
+        params["route_day_ids"] = [route_id for route_id, _ in route_days]
+        params["route_day_odays"] = [oday for _, oday in route_days]
+
+    where = ""
+    if conditions:
+        where = " WHERE " + " AND ".join(conditions)
+    # Stable row order keeps the analysis results reproducible
+    order_by = " ORDER BY route_id, oday"
+
+    cache = get_preprocess_file_cache()
+    loop = asyncio.get_running_loop()
+    with ThreadPoolExecutor(max_workers=RECLUSTER_LOAD_WORKERS) as executor:
+        if cache is None:
+            parsed = []
+            with profiler.stage("load"):
+                async with pool.connection() as conn:
+                    async with conn.cursor(name=f"load_{table}") as cur:
+                        cur.itersize = LOAD_FETCH_ROWS
+                        await cur.execute(
+                            f"SELECT zst FROM delay.{table}{where}{order_by}", params
+                        )
+                        async for row in cur:
+                            parsed.append(
+                                loop.run_in_executor(
+                                    executor, parse_preprocess_file, row[0], dtypes
+                                )
+                            )
+            if not parsed:
+                return None
+
+            with profiler.stage("decompress"):
+                dfs = await asyncio.gather(*parsed)
+        else:
+            dfs = await load_cached_preprocess_files(
+                cache, table, where, order_by, params, dtypes, executor, profiler
+            )
+            if not dfs:
+                return None
 
-    combined_df = pd.concat(dfs, ignore_index=True)
+        with profiler.stage("decompress"):
+            combined_df = pd.concat(dfs, ignore_index=True)
+            del dfs
 
     if combined_df.empty:
         return None
 
-    buffer = io.BytesIO()
-    combined_df.to_csv(buffer, sep=";", index=False)
-    buffer.seek(0)
-    return buffer.getvalue()
+    return combined_df
 
 
 async def get_recluster_status(
@@ -171,6 +429,32 @@ async def get_recluster_status(
     }
 
 
+async def get_recluster_attempts(
+    route_id: List[str],
+    from_oday: date,
+    to_oday: date,
+    exclude_dates: List[date],
+) -> int:
+    """Number of times a job of delay.recluster_routes has been queued, 0 if never."""
+    query = """
+        SELECT attempts
+        FROM delay.recluster_routes
+        WHERE route_id = %(route_id)s AND from_oday = %(from_oday)s AND to_oday = %(to_oday)s AND days_excluded = %(exclude_dates)s
+    """
+    async with pool.connection() as conn:
+        cur = await conn.execute(
+            query,
+            {
+                "route_id": route_id,
+                "from_oday": from_oday,
+                "to_oday": to_oday,
+                "exclude_dates": exclude_dates,
+            },
+        )
+        row = await cur.fetchone()
+    return row[0] if row else 0
+
+
 async def set_recluster_status(
     table: str,
     from_oday: date,
@@ -224,6 +508,267 @@ async def update_recluster_progress(
         )
 
 
+def canonicalize_recluster_payload(payload: dict) -> dict:
+    """
+    Payload of a recluster request with its key parameters in canonical form, so that
+    equivalent requests share one job: route ids stripped, upper cased, deduplicated and
+    sorted, excluded days deduplicated, sorted and limited to the window. Other keys are kept.
+    """
+    from_oday = date.fromisoformat(str(payload["from_oday"]))
+    to_oday = date.fromisoformat(str(payload["to_oday"]))
+    route_ids = {str(r).strip().upper() for r in payload.get("route_ids", [])}
+    days_excluded = {date.fromisoformat(str(d)) for d in payload.get("days_excluded", [])}
+    return {
+        **payload,
+        "route_ids": sorted(r for r in route_ids if r),
+        "from_oday": from_oday.isoformat(),
+        "to_oday": to_oday.isoformat(),
+        "days_excluded": [
+            d.isoformat() for d in sorted(days_excluded) if from_oday <= d <= to_oday
+        ],
+    }
+
+
+async def estimate_recluster_cost(
+    route_ids: List[str], from_oday: date, to_oday: date, days_excluded: List[date]
+) -> int:
+    """Estimated cost of a recluster job as the number of preprocessed route-days in its window."""
+    conditions, params = get_window_conditions(route_ids, from_oday, to_oday, days_excluded)
+    query = f"""
+        SELECT count(*)
+        FROM delay.preprocess_clusters
+        WHERE {" AND ".join(conditions)}
+    """
+    async with pool.connection() as conn:
+        cur = await conn.execute(query, params)
+        return (await cur.fetchone())[0]
+
+
+async def enqueue_recluster_jobs(
+    jobs: List[Tuple[List[str], date, date, List[date]]],
+    queue_payload: Optional[Dict[str, Any]] = None,
+) -> None:
+    """
+    Add recluster jobs (route_ids, from_oday, to_oday, days_excluded) to the end of the queue
+    with their estimated costs, see dispatch_recluster_jobs. With queue_payload the jobs are
+    one entry of the queue, e.g. the scopes of a batch, admitted with their summed cost and
+    started together as that orchestrator payload.
+    """
+    costs = await asyncio.gather(
+        *[estimate_recluster_cost(*job) for job in jobs]
+    )
+    query = """
+        INSERT INTO delay.recluster_routes (route_id, from_oday, to_oday, days_excluded, status, cost, queue_payload, attempts)
+        VALUES (%(route_id)s, %(from_oday)s, %(to_oday)s, %(days_excluded)s, %(status)s, %(cost)s, %(queue_payload)s, 1)
+        ON CONFLICT (route_id, from_oday, to_oday, days_excluded)
+        DO UPDATE
+          SET status        = EXCLUDED.status,
+              cost          = EXCLUDED.cost,
+              queue_payload = EXCLUDED.queue_payload,
+              attempts      = delay.recluster_routes.attempts + 1,
+              createdAt     = now();
+    """
+    rows = [
+        {
+            "route_id": route_ids,
+            "from_oday": from_oday,
+            "to_oday": to_oday,
+            "days_excluded": days_excluded,
+            "status": ReclusterStatus.QUEUED.value,
+            "cost": cost,
+            "queue_payload": None if queue_payload is None else Jsonb(queue_payload),
+        }
+        for (route_ids, from_oday, to_oday, days_excluded), cost in zip(jobs, costs)
+    ]
+    # One transaction, so the jobs of an entry get the same place in the queue
+    async with pool.connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.executemany(query, rows)
+
+
+async def enqueue_recluster_job(
+    route_ids: List[str], from_oday: date, to_oday: date, days_excluded: List[date]
+) -> None:
+    """Add a recluster job to the end of the queue with its estimated cost, see dispatch_recluster_jobs."""
+    await enqueue_recluster_jobs([(route_ids, from_oday, to_oday, days_excluded)])
+
+
+# Identifies a queue entry: the jobs queued with the same queue_payload, or a single job
+QUEUE_ENTRY_SQL = "coalesce(queue_payload::text, concat_ws('/', route_id, from_oday, to_oday, days_excluded))"
+
+
+async def dispatch_recluster_jobs(client) -> int:
+    """
+    Start queued recluster jobs in queue order while there is room for them, with the durable
+    orchestration client given. Returns the number of queue entries started.
+
+    At most RECLUSTER_MAX_CONCURRENT_JOBS queue entries are PENDING or RUNNING at once, and
+    their estimated cost may not exceed RECLUSTER_MAX_RUNNING_COST unless the entry is the only
+    one. An entry is a single job or the jobs queued together with a queue_payload, e.g. a batch,
+    whose cost is the sum of its jobs. The queue is not reordered, so a large entry at the head
+    waits for room instead of being passed by smaller ones. Jobs are marked PENDING under an
+    advisory lock, so concurrent callers do not start the same job twice.
+    """
+    # Jobs without a status change in an hour are stale, as in httpStart
+    active_query = f"""
+        SELECT count(DISTINCT {QUEUE_ENTRY_SQL}), coalesce(sum(cost), 0)
+        FROM delay.recluster_routes
+        WHERE status IN ('PENDING', 'RUNNING') AND createdAt > now() - interval '1 hour'
+    """
+    queued_query = """
+        SELECT route_id::text[], from_oday, to_oday, days_excluded, coalesce(cost, 0), queue_payload
+        FROM delay.recluster_routes
+        WHERE status = 'QUEUED'
+        ORDER BY createdAt, route_id
+    """
+    entries = []
+    async with pool.connection() as conn:
+        async with conn.transaction():
+            await conn.execute(
+                "SELECT pg_advisory_xact_lock(%s)", (constants.RECLUSTER_QUEUE_LOCK_ID,)
+            )
+            cur = await conn.execute(active_query)
+            n_active, active_cost = await cur.fetchone()
+            if n_active >= RECLUSTER_MAX_CONCURRENT_JOBS:
+                return 0
+
+            cur = await conn.execute(queued_query)
+            queued = {}
+            for route_ids, from_oday, to_oday, days_excluded, cost, queue_payload in await cur.fetchall():
+                job = (route_ids, from_oday, to_oday, days_excluded)
+                if queue_payload is None:
+                    entry_key = repr(job)
+                    queue_payload = {
+                        "route_ids": route_ids,
+                        "from_oday": str(from_oday),
+                        "to_oday": str(to_oday),
+                        "days_excluded": [str(d) for d in days_excluded],
+                    }
+                else:
+                    entry_key = json.dumps(queue_payload, sort_keys=True)
+                entry = queued.setdefault(
+                    entry_key, {"payload": queue_payload, "jobs": [], "cost": 0}
+                )
+                entry["jobs"].append(job)
+                entry["cost"] += cost
+
+            for entry in queued.values():
+                if n_active >= RECLUSTER_MAX_CONCURRENT_JOBS:
+                    break
+                if n_active and active_cost + entry["cost"] > RECLUSTER_MAX_RUNNING_COST:
+                    break
+                n_active += 1
+                active_cost += entry["cost"]
+                entries.append(entry)
+                async with conn.cursor() as cur:
+                    await cur.executemany(
+                        """
+                        UPDATE delay.recluster_routes
+                        SET status = 'PENDING', createdAt = now()
+                        WHERE route_id = %(route_id)s AND from_oday = %(from_oday)s AND to_oday = %(to_oday)s AND days_excluded = %(days_excluded)s
+                        """,
+                        [
+                            {
+                                "route_id": route_ids,
+                                "from_oday": from_oday,
+                                "to_oday": to_oday,
+                                "days_excluded": days_excluded,
+                            }
+                            for route_ids, from_oday, to_oday, days_excluded in entry["jobs"]
+                        ],
+                    )
+
+    started = 0
+    for entry in entries:
+        try:
+            await client.start_new("orchestrator", None, entry["payload"])
+            started += 1
+        except Exception:
+            logger.exception(f"Could not start recluster job {entry['payload']}, queueing it again")
+            for route_ids, from_oday, to_oday, days_excluded in entry["jobs"]:
+                await set_recluster_status(
+                    "recluster_routes",
+                    from_oday,
+                    to_oday,
+                    route_ids,
+                    days_excluded,
+                    ReclusterStatus.QUEUED,
+                )
+    return started
+
+
+async def get_queue_position(
+    route_ids: List[str], from_oday: date, to_oday: date, days_excluded: List[date]
+) -> Optional[int]:
+    """
+    1-based position of the queue entry of a QUEUED recluster job in the queue,
+    None if the job is not queued.
+    """
+    query = f"""
+        SELECT count(DISTINCT {QUEUE_ENTRY_SQL})
+        FROM delay.recluster_routes
+        WHERE status = 'QUEUED' AND createdAt <= (
+            SELECT createdAt
+            FROM delay.recluster_routes
+            WHERE route_id = %(route_id)s AND from_oday = %(from_oday)s AND to_oday = %(to_oday)s
+              AND days_excluded = %(days_excluded)s AND status = 'QUEUED'
+        )
+    """
+    async with pool.connection() as conn:
+        cur = await conn.execute(
+            query,
+            {
+                "route_id": route_ids,
+                "from_oday": from_oday,
+                "to_oday": to_oday,
+                "days_excluded": days_excluded,
+            },
+        )
+        position = (await cur.fetchone())[0]
+    return position or None
+
+
+def get_precompute_requests(
+    yesterday: date, window_days: List[int], route_ids: List[str]
+) -> List[Dict[str, Any]]:
+    """
+    Orchestrator payloads of the standard windows ending yesterday, for all routes and
+    for every given route. The payloads are built like /hfp/delay_analytics builds them,
+    so a matching API request finds the result with the same key.
+    """
+    scopes = [[]] + [[route_id] for route_id in sorted(route_ids)]
+    return [
+        {
+            "route_ids": scope,
+            "from_oday": str(yesterday - timedelta(days=days - 1)),
+            "to_oday": str(yesterday),
+            "days_excluded": [],
+        }
+        for days in window_days
+        for scope in scopes
+    ]
+
+
+async def is_preprocess_ready(oday: date) -> bool:
+    """
+    True if the preprocessed files of oday exist and preprocessing is not running,
+    i.e. the importer lock is free.
+    """
+    async with pool.connection() as conn:
+        cur = await conn.execute(
+            "SELECT is_lock_enabled(%s)", (constants.IMPORTER_LOCK_ID,)
+        )
+        row = await cur.fetchone()
+        if row[0]:
+            return False
+        cur = await conn.execute(
+            "SELECT EXISTS (SELECT 1 FROM delay.preprocess_clusters WHERE oday = %(oday)s)",
+            {"oday": oday},
+        )
+        row = await cur.fetchone()
+        return row[0]
+
+
 async def load_recluster_geojson(
     table: str,
     from_oday: date,
@@ -292,7 +837,75 @@ async def load_recluster_csv(
     return decompressed_geojson
 
 
-async def store_compressed_geojson(
+def format_datetime_columns(gdf: gpd.GeoDataFrame) -> None:
+    """Datetime columns of a result as strings, in place, as they are stored and downloaded."""
+    for col in gdf.columns:
+        if pd.api.types.is_datetime64_any_dtype(gdf[col]):
+            gdf[col] = gdf[col].dt.strftime("%Y-%m-%d %H:%M:%S")
+
+
+async def store_recluster_clusters(
+    conn: AsyncConnection,
+    route_id: list,
+    from_oday: date,
+    to_oday: date,
+    days_excluded: List[date],
+    gdf: gpd.GeoDataFrame,
+) -> None:
+    """
+    Replace the rows of a recluster_routes result in delay.recluster_route_clusters
+    with the rows of gdf, on the connection that stores the result.
+    """
+    key = {
+        "route_id": route_id,
+        "from_oday": from_oday,
+        "to_oday": to_oday,
+        "days_excluded": days_excluded,
+    }
+    key_condition = """
+        route_id = %(route_id)s::text AND from_oday = %(from_oday)s
+        AND to_oday = %(to_oday)s AND days_excluded = %(days_excluded)s::date[]
+    """
+    await conn.execute(
+        f"DELETE FROM delay.recluster_route_clusters WHERE {key_condition}", key
+    )
+    if gdf.empty:
+        return
+
+    properties = pd.DataFrame(gdf.drop(columns=gdf.geometry.name)).to_json(
+        orient="records", lines=True, double_precision=15
+    )
+    q_50_category = gdf["q_50_category"].astype(object)
+    query = """
+        INSERT INTO delay.recluster_route_clusters (
+            route_id, from_oday, to_oday, days_excluded, cluster_no, cluster_route_id,
+            direction_id, time_group, dclass, q_50_category, latitude, longitude, properties
+        )
+        SELECT %(route_id)s::text, %(from_oday)s, %(to_oday)s, %(days_excluded)s::date[], u.*
+        FROM unnest(
+            %(cluster_nos)s::integer[], %(cluster_route_ids)s::text[], %(direction_ids)s::smallint[],
+            %(time_groups)s::text[], %(dclasses)s::text[], %(q_50_categories)s::text[],
+            %(latitudes)s::float8[], %(longitudes)s::float8[], %(properties)s::jsonb[]
+        ) AS u
+    """
+    await conn.execute(
+        query,
+        {
+            **key,
+            "cluster_nos": list(range(len(gdf))),
+            "cluster_route_ids": gdf["route_id"].astype(str).tolist(),
+            "direction_ids": gdf["direction_id"].astype(int).tolist(),
+            "time_groups": gdf["time_group"].astype(str).tolist(),
+            "dclasses": gdf["dclass"].astype(str).tolist(),
+            "q_50_categories": q_50_category.where(q_50_category.notna(), None).tolist(),
+            "latitudes": gdf["latitude"].astype(float).tolist(),
+            "longitudes": gdf["longitude"].astype(float).tolist(),
+            "properties": properties.splitlines(),
+        },
+    )
+
+
+async def store_recluster_result(
     table: str,
     route_id: list,
     from_oday: date,
@@ -300,68 +913,206 @@ async def store_compressed_geojson(
     gdf: gpd.GeoDataFrame,
     days_excluded: Optional[List[date]],
     flow_analytics_container_client: FlowAnalyticsContainerClient,
+    profiler: Optional[StageProfiler] = None,
 ):
     """
-    Convert the GeoDataFrame to GeoJSON and compress with zstd.
-    Saves compressed data to database and to blob storage
+    Store the result GeoDataFrame once as GeoParquet to database and to blob storage.
+    GeoJSON and CSV are rendered from it when the result is downloaded,
+    see iter_recluster_geojson and iter_recluster_csv. Results of recluster_routes
+    are also stored as rows of delay.recluster_route_clusters for spatial queries.
     """
+    profiler = profiler or StageProfiler.disabled()
 
     if not days_excluded:
         days_excluded = []
 
-    for col in gdf.columns:
-        if pd.api.types.is_datetime64_any_dtype(gdf[col]):
-            gdf[col] = gdf[col].dt.strftime("%Y-%m-%d %H:%M:%S")
-
-    geojson_str = gdf.to_json()
-    geojson_bytes = geojson_str.encode("utf-8")
-    del geojson_str
-    compressed_data = zstd.ZstdCompressor().compress(geojson_bytes)
-    del geojson_bytes
+    with profiler.stage("encoding"):
+        format_datetime_columns(gdf)
 
-    csv_str = gdf.to_csv(index=False)
-    csv_bytes = csv_str.encode("utf-8")
-    del csv_str
-    compressed_csv_data = zstd.ZstdCompressor().compress(csv_bytes)
-    del csv_bytes
+        buffer = io.BytesIO()
+        gdf.to_parquet(buffer, compression="zstd")
+        result = buffer.getvalue()
+        del buffer
 
     table_name = f"delay.{table}"
 
+    # zst and csv_zst hold the results stored before GeoParquet
     query = f"""
-        INSERT INTO {table_name} (route_id, from_oday, to_oday, days_excluded, zst, csv_zst)
-        VALUES (%(route_id)s, %(from_oday)s, %(to_oday)s, %(days_excluded)s, %(zst)s, %(csv_zst)s)
+        INSERT INTO {table_name} (route_id, from_oday, to_oday, days_excluded, result)
+        VALUES (%(route_id)s, %(from_oday)s, %(to_oday)s, %(days_excluded)s, %(result)s)
         ON CONFLICT (route_id, from_oday, to_oday, days_excluded) DO UPDATE
-            SET zst = EXCLUDED.zst,
-                csv_zst  = EXCLUDED.csv_zst,
+            SET result = EXCLUDED.result,
+                zst = NULL,
+                csv_zst = NULL,
+                zip = NULL,
                 status = 'DONE',
                 modifiedAt = now();
     """
 
+    with profiler.stage("store"):
+        async with pool.connection() as conn:
+            await conn.execute(
+                query,
+                {
+                    "route_id": route_id,
+                    "from_oday": from_oday,
+                    "to_oday": to_oday,
+                    "days_excluded": days_excluded,
+                    "result": result,
+                },
+            )
+            if table == "recluster_routes":
+                await store_recluster_clusters(
+                    conn, route_id, from_oday, to_oday, days_excluded, gdf
+                )
+
+        recluster_type = table.split("_")[1]
+
+        await flow_analytics_container_client.save_cluster_data(
+            recluster_type=recluster_type,
+            compressed_data=result,
+            from_oday=from_oday.strftime("%Y-%m-%d"),
+            to_oday=to_oday.strftime("%Y-%m-%d"),
+            route_id=",".join(route_id) if isinstance(route_id, list) else route_id,
+            file_extension=".parquet",
+        )
+
+    del result
+    gc.collect()
+
+
+async def load_recluster_result(
+    table: str,
+    from_oday: date,
+    to_oday: date,
+    days_excluded: list[date],
+    route_id: list = [],
+) -> Optional[gpd.GeoDataFrame]:
+    """Result GeoDataFrame stored by store_recluster_result, None if not found."""
+    table_name = f"delay.{table}"
+    query = f"""
+        SELECT result
+        FROM {table_name}
+        WHERE route_id = %(route_id)s AND from_oday = %(from_oday)s AND to_oday = %(to_oday)s AND days_excluded = %(days_excluded)s
+    """
     async with pool.connection() as conn:
-        await conn.execute(
+        row = await conn.execute(
             query,
             {
                 "route_id": route_id,
                 "from_oday": from_oday,
                 "to_oday": to_oday,
                 "days_excluded": days_excluded,
-                "zst": compressed_data,
-                "csv_zst": compressed_csv_data,
             },
         )
+        result = await row.fetchone()
+        if not result or not result[0]:
+            return None
 
-    recluster_type = table.split("_")[1]
+        data = result[0]
 
-    await flow_analytics_container_client.save_cluster_data(
-        recluster_type=recluster_type,
-        compressed_data=compressed_data,
-        from_oday=from_oday.strftime("%Y-%m-%d"),
-        to_oday=to_oday.strftime("%Y-%m-%d"),
-        route_id=",".join(route_id) if isinstance(route_id, list) else route_id,
-    )
+    return gpd.read_parquet(io.BytesIO(data))
 
-    del compressed_data, compressed_csv_data
-    gc.collect()
+
+def iter_recluster_geojson(
+    gdf: gpd.GeoDataFrame, batch_rows: int = RENDER_BATCH_ROWS
+) -> Iterator[bytes]:
+    """GeoJSON FeatureCollection of gdf in chunks of batch_rows features. Same output as gdf.to_json()."""
+    yield b'{"type": "FeatureCollection", "features": ['
+    for start in range(0, len(gdf), batch_rows):
+        features = ", ".join(
+            json.dumps(feature)
+            for feature in gdf.iloc[start : start + batch_rows].iterfeatures(na="null")
+        )
+        yield ((", " if start else "") + features).encode("utf-8")
+    yield b"]}"
+
+
+def iter_recluster_csv(
+    gdf: gpd.GeoDataFrame, batch_rows: int = RENDER_BATCH_ROWS
+) -> Iterator[bytes]:
+    """CSV of gdf in chunks of batch_rows rows. Same output as gdf.to_csv(index=False)."""
+    if gdf.empty:
+        yield gdf.to_csv(index=False).encode("utf-8")
+    for start in range(0, len(gdf), batch_rows):
+        yield (
+            gdf.iloc[start : start + batch_rows]
+            .to_csv(index=False, header=start == 0)
+            .encode("utf-8")
+        )
+
+
+def build_recluster_zip(files: Dict[str, Iterable[bytes]]) -> bytes:
+    """
+    Deflated zip of the given files, e.g. {"routecluster.geojson": iter_recluster_geojson(gdf)}.
+    Files are written chunk by chunk through a temporary file that spills to disk when large.
+    """
+    with tempfile.SpooledTemporaryFile(max_size=ZIP_SPOOL_MAX_BYTES) as spool:
+        with zipfile.ZipFile(spool, "w", compression=zipfile.ZIP_DEFLATED) as zip_file:
+            for name, chunks in files.items():
+                with zip_file.open(name, "w") as file:
+                    for chunk in chunks:
+                        file.write(chunk)
+        spool.seek(0)
+        return spool.read()
+
+
+async def load_recluster_zip(
+    table: str,
+    from_oday: date,
+    to_oday: date,
+    days_excluded: list[date],
+    route_id: list = [],
+) -> Optional[bytes]:
+    table_name = f"delay.{table}"
+    query = f"""
+        SELECT zip
+        FROM {table_name}
+        WHERE route_id = %(route_id)s AND from_oday = %(from_oday)s AND to_oday = %(to_oday)s AND days_excluded = %(days_excluded)s
+    """
+    async with pool.connection() as conn:
+        row = await conn.execute(
+            query,
+            {
+                "route_id": route_id,
+                "from_oday": from_oday,
+                "to_oday": to_oday,
+                "days_excluded": days_excluded,
+            },
+        )
+        result = await row.fetchone()
+
+    if not result or not result[0]:
+        return None
+    return result[0]
+
+
+async def store_recluster_zip(
+    table: str,
+    from_oday: date,
+    to_oday: date,
+    days_excluded: list[date],
+    route_id: list,
+    zip_data: bytes,
+) -> None:
+    """Persist the zip served on download, so it is built only once per result."""
+    table_name = f"delay.{table}"
+    query = f"""
+        UPDATE {table_name}
+        SET zip = %(zip)s
+        WHERE route_id = %(route_id)s AND from_oday = %(from_oday)s AND to_oday = %(to_oday)s AND days_excluded = %(days_excluded)s
+    """
+    async with pool.connection() as conn:
+        await conn.execute(
+            query,
+            {
+                "route_id": route_id,
+                "from_oday": from_oday,
+                "to_oday": to_oday,
+                "days_excluded": days_excluded,
+                "zip": zip_data,
+            },
+        )
 
 
 def make_geo_df_WGS84(
@@ -448,7 +1199,9 @@ def recluster(
 
 
 def calculate_cluster_features(
-    df: pd.DataFrame, cluster_id_vars_on_2nd_level: list
+    df: pd.DataFrame,
+    cluster_id_vars_on_2nd_level: list,
+    group_vars: Optional[list] = None,
 ) -> pd.DataFrame:
     """Calculate additional features for the identified clusters: medians for location and time and descriptive
     values for the deviation of the delay.
@@ -459,6 +1212,9 @@ def calculate_cluster_features(
     Args:
         df (pd.DataFrame): Input dataframe containing cluster data.
         cluster_id_vars_on_2nd_level (list, optional): List of columns to group by for the second level of clustering. Defaults to ['route_id','direction_id','time_group','dclass','cluster_on_reclustered_level'].
+        group_vars (list, optional): Columns of the DBSCAN groups when df holds the clusters of many groups,
+            e.g. ['route_id','direction_id','time_group','dclass']. Features are then calculated for all groups in one pass.
+            If not given, df is a single group.
 
     Returns:
         pd.DataFrame: clusters with descriptive variables
@@ -476,15 +1232,16 @@ def calculate_cluster_features(
     else:
         df["tst_median_ns"] = pd.Series(index=df.index, dtype="float64")
 
-    clust_counts = df.drop_duplicates(
-        subset=[
-            "route_id",
-            "direction_id",
-            "oday",
-            "start",
-            "cluster_on_reclustered_level",
-        ]
-    )
+    departure_vars = [
+        "route_id",
+        "direction_id",
+        "oday",
+        "start",
+        "cluster_on_reclustered_level",
+    ]
+    # Cluster labels are only unique within a group
+    departure_vars += [c for c in group_vars or [] if c not in departure_vars]
+    clust_counts = df.drop_duplicates(subset=departure_vars)
     clust_counts = (
         clust_counts.groupby(cluster_id_vars_on_2nd_level, observed=False)
         .size()
@@ -520,8 +1277,16 @@ def calculate_cluster_features(
     res = median_vars.merge(clust_counts, on=cluster_id_vars_on_2nd_level, how="outer")
     res = res.merge(clust_delay_feats, on=cluster_id_vars_on_2nd_level, how="outer")
 
-    res["oday_min"] = df["oday"].min()
-    res["oday_max"] = df["oday"].max()
+    if group_vars:
+        oday_range = (
+            df.groupby(group_vars, observed=False)["oday"]
+            .agg(oday_min="min", oday_max="max")
+            .reset_index()
+        )
+        res = res.merge(oday_range, on=group_vars, how="left")
+    else:
+        res["oday_min"] = df["oday"].min()
+        res["oday_max"] = df["oday"].max()
 
     return res
 
@@ -571,81 +1336,174 @@ def ui_related_var_modifications(
     return df
 
 
-async def get_preprocessed_departures(
-    route_ids: [str], from_oday: date, to_oday: date, days_to_exclude: list[date]
-):
-    departures_data = await load_preprocess_files(
-        route_ids, from_oday, to_oday, days_to_exclude, "preprocess_departures"
-    )
-    if not departures_data:
-        logger.debug(f"No preprocessed departures ZST found for route_id={route_ids}")
-        return None
+def is_weekday_time_group(time_group: pd.Series) -> pd.Series:
+    """Time groups that belong to 0_weekday_all, i.e. all but the weekend ones."""
+    return ~time_group.str.contains("weekend", case=False, na=False)
 
-    departure_types = {
-        "event_type": "category",
-        "route_id": "object",
-        "direction_id": "int8",
-        "operator_id": "int16",
-        "oper": "int8",
-        "vehicle_number": "int16",
-        "transport_mode": "object",
-        "time_group": "object",
-        "oday": "object",
-        "start": "object",
-        "tst": "object",
-    }
 
-    preprocessed_departures = pd.read_csv(
-        io.BytesIO(departures_data), sep=";", dtype=departure_types
+def count_day_departures(
+    route_days: List[Tuple[str, date]], departures: Optional[pd.DataFrame]
+) -> List[Dict[str, Any]]:
+    """
+    Departures by direction and time group of every route-day,
+    as rows of delay.preprocess_departure_counts.
+    """
+    counts = {route_day: ([], [], []) for route_day in route_days}
+    if departures is not None:
+        # oday is a string column in the files, possibly with a time part
+        grouped = departures.groupby(
+            [
+                departures["route_id"],
+                departures["oday"].str[:10],
+                departures["direction_id"],
+                departures["time_group"],
+            ],
+            observed=True,
+        ).size()
+        for (route_id, oday, direction_id, time_group), n in grouped.items():
+            route_day = (route_id, date.fromisoformat(oday))
+            if route_day in counts:
+                direction_ids, time_groups, departure_counts = counts[route_day]
+                direction_ids.append(int(direction_id))
+                time_groups.append(time_group)
+                departure_counts.append(int(n))
+
+    return [
+        {
+            "route_id": route_id,
+            "oday": oday,
+            "direction_ids": direction_ids,
+            "time_groups": time_groups,
+            "departure_counts": departure_counts,
+        }
+        for (route_id, oday), (direction_ids, time_groups, departure_counts) in counts.items()
+    ]
+
+
+def count_departures_analyzed(departure_counts: pd.DataFrame) -> pd.DataFrame:
+    """Number of departures by route, direction and time group, 0_weekday_all included."""
+    n_departures_analyzed = departure_counts.groupby(
+        DEPARTURE_COUNT_KEYS, as_index=False
+    )["n_departures"].sum()
+    weekday_all = (
+        n_departures_analyzed[is_weekday_time_group(n_departures_analyzed["time_group"])]
+        .groupby(["route_id", "direction_id"], as_index=False)["n_departures"]
+        .sum()
+        .assign(time_group="0_weekday_all")
     )
+    return pd.concat(
+        [n_departures_analyzed, weekday_all], ignore_index=True
+    ).rename(columns={"n_departures": "n_departures_analyzed"})
+
 
-    week_days_df = preprocessed_departures[
-        ~preprocessed_departures["time_group"].str.contains(
-            "weekend", case=False, na=False
+async def get_departure_counts(
+    route_ids: List[str],
+    from_oday: date,
+    to_oday: date,
+    days_to_exclude: List[date],
+    profiler: Optional[StageProfiler] = None,
+) -> Optional[pd.DataFrame]:
+    """
+    Number of departures by route, direction and time group in a window, summed from
+    the per route-day counts in delay.preprocess_departure_counts.
+
+    The counts are written by preprocessing. Route-days that do not have them, e.g.
+    ones restored from blob storage or preprocessed before the counts existed, are
+    counted from preprocess_departures once and stored.
+    """
+    profiler = profiler or StageProfiler.disabled()
+    conditions, params = get_window_conditions(
+        route_ids, from_oday, to_oday, days_to_exclude
+    )
+    where = " AND ".join(conditions)
+
+    missing_query = f"""
+        SELECT route_id, oday
+        FROM delay.preprocess_departures d
+        LEFT JOIN delay.preprocess_departure_counts c USING (route_id, oday)
+        WHERE {where} AND c.route_id IS NULL
+        ORDER BY route_id, oday
+    """
+    with profiler.stage("load"):
+        async with pool.connection() as conn:
+            cur = await conn.execute(missing_query, params)
+            missing = await cur.fetchall()
+
+    if missing:
+        logger.debug(f"Counting departures of {len(missing)} route days")
+    # One route at a time, so that only the departures of a single route are in memory
+    for route_id, route_missing in itertools.groupby(missing, key=lambda r: r[0]):
+        route_missing = list(route_missing)
+        departures = await load_preprocess_files(
+            [route_id],
+            from_oday,
+            to_oday,
+            days_to_exclude,
+            "preprocess_departures",
+            PREPROCESS_DEPARTURES_DTYPES,
+            profiler,
+            route_days=route_missing,
         )
-    ].copy()
-    week_days_df["time_group"] = "0_weekday_all"
+        with profiler.stage("departure_counts"):
+            await store_departure_counts(count_day_departures(route_missing, departures))
+        del departures
+
+    sum_query = f"""
+        SELECT c.route_id, u.direction_id, u.time_group, sum(u.n_departures)
+        FROM delay.preprocess_departure_counts c
+        CROSS JOIN LATERAL unnest(c.direction_ids, c.time_groups, c.departure_counts)
+            AS u(direction_id, time_group, n_departures)
+        WHERE {where}
+        GROUP BY c.route_id, u.direction_id, u.time_group
+    """
+    with profiler.stage("load"):
+        async with pool.connection() as conn:
+            cur = await conn.execute(sum_query, params)
+            rows = await cur.fetchall()
 
-    preprocessed_departures = pd.concat(
-        [preprocessed_departures, week_days_df], axis=0
-    ).reset_index(drop=True)
+    if not rows:
+        return None
 
-    return preprocessed_departures
+    departure_counts = pd.DataFrame(
+        rows, columns=[*DEPARTURE_COUNT_KEYS, "n_departures"]
+    ).astype({"direction_id": "int8", "n_departures": "int64"})
+    return count_departures_analyzed(departure_counts)
 
 
-async def get_preprocessed_clusters(
-    route_ids: [str], from_oday: date, to_oday: date, days_to_exclude: list[date]
-):
-    cluster_data = await load_preprocess_files(
-        route_ids, from_oday, to_oday, days_to_exclude, "preprocess_clusters"
+async def get_recluster_input(
+    route_ids: List[str],
+    from_oday: date,
+    to_oday: date,
+    days_to_exclude: List[date],
+    profiler: Optional[StageProfiler] = None,
+) -> Tuple[Optional[pd.DataFrame], Optional[pd.DataFrame]]:
+    """
+    First level clusters and n_departures_analyzed (0_weekday_all included) of a window.
+    Clusters and departure counts are loaded concurrently on their own connections.
+    """
+    clusters, n_departures_analyzed = await asyncio.gather(
+        load_preprocess_files(
+            route_ids,
+            from_oday,
+            to_oday,
+            days_to_exclude,
+            "preprocess_clusters",
+            PREPROCESS_CLUSTERS_DTYPES,
+            profiler,
+        ),
+        get_departure_counts(
+            route_ids, from_oday, to_oday, days_to_exclude, profiler
+        ),
     )
-    if not cluster_data:
+    if clusters is None:
         logger.debug(f"No preprocessed cluster ZST found for route_id={route_ids}")
-        return None
-
-    clusters_dtypes = {
-        "route_id": "object",
-        "direction_id": "int8",
-        "hdg_median": "float32",
-        "dclass": "object",
-        "weight": "int32",
-        "time_group": "object",
-        "lat_median": "float32",
-        "long_median": "float32",
-        "oday": "object",
-        "start": "object",
-        "tst_median": "object",
-    }
+        return None, None
 
-    clusters = pd.read_csv(io.BytesIO(cluster_data), sep=";", dtype=clusters_dtypes)
-
-    week_days_df = clusters[
-        ~clusters["time_group"].str.contains("weekend", case=False, na=False)
-    ].copy()
-    week_days_df["time_group"] = "0_weekday_all"
+    if n_departures_analyzed is None:
+        logger.debug(f"No preprocessed departures ZST found for route_id={route_ids}")
+        return None, None
 
-    clusters = pd.concat([clusters, week_days_df], axis=0).reset_index(drop=True)
-    return clusters
+    return clusters, n_departures_analyzed
 
 
 def run_asyncio_task(coro_fn, *args, **kwargs):
@@ -687,165 +1545,475 @@ async def run_analysis_and_set_status(
             gc.collect()
 
 
-async def recluster_analysis(
-    route_ids: list[str], from_oday: date, to_oday: date, days_to_exclude: list[date]
-):
-    with CustomDbLogHandler("api"):
-        logger.debug("Fetch data for recluster")
-        start_time = datetime.now()
-        clusters = await get_preprocessed_clusters(
-            route_ids, from_oday, to_oday, days_to_exclude
-        )
-        preprocessed_departures = await get_preprocessed_departures(
-            route_ids, from_oday, to_oday, days_to_exclude
-        )
-        end_time = datetime.now()
-        logger.debug(
-            f"Data fetched for recluster {route_ids}, {from_oday}, {to_oday} in {end_time - start_time}"
+def group_cache_key(
+    key: tuple,
+    coords: np.ndarray,
+    weights: np.ndarray,
+    epsilon: float,
+    min_weighted_samples: int,
+) -> str:
+    """Content address of a DBSCAN group: its key, the parameters and the input rows."""
+    digest = hashlib.sha256()
+    digest.update(json.dumps([[str(k) for k in key], epsilon, min_weighted_samples]).encode())
+    digest.update(np.ascontiguousarray(coords, dtype=np.float64).tobytes())
+    digest.update(np.ascontiguousarray(weights, dtype=np.int64).tobytes())
+    return digest.hexdigest()
+
+
+async def load_group_labels(cache_keys: List[str]) -> Dict[str, np.ndarray]:
+    """Cached DBSCAN labels by cache key. Keys that are not cached are left out."""
+    if not cache_keys:
+        return {}
+    query = """
+        SELECT cache_key, labels
+        FROM delay.recluster_group_cache
+        WHERE cache_key = ANY(%(cache_keys)s)
+    """
+    async with pool.connection() as conn:
+        cur = await conn.execute(query, {"cache_keys": cache_keys})
+        rows = await cur.fetchall()
+
+    decompressor = zstd.ZstdDecompressor()
+    return {
+        cache_key: np.frombuffer(decompressor.decompress(labels), dtype=np.int32).astype(
+            np.int64
         )
+        for cache_key, labels in rows
+    }
 
-        if clusters is None or preprocessed_departures is None:
-            raise RuntimeError(
-                "Missing clusters or departures zst for recluster_analysis"
+
+async def store_group_labels(labels_by_key: Dict[str, np.ndarray]) -> None:
+    if not labels_by_key:
+        return
+    query = """
+        INSERT INTO delay.recluster_group_cache (cache_key, labels)
+        VALUES (%(cache_key)s, %(labels)s)
+        ON CONFLICT (cache_key) DO NOTHING
+    """
+    compressor = zstd.ZstdCompressor()
+    rows = [
+        {
+            "cache_key": cache_key,
+            "labels": compressor.compress(labels.astype(np.int32).tobytes()),
+        }
+        for cache_key, labels in labels_by_key.items()
+    ]
+    async with pool.connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.executemany(query, rows)
+
+
+async def fit_groups_cached(
+    coords: np.ndarray,
+    weights: np.ndarray,
+    plan: GroupPlan,
+    epsilon: float,
+    min_weighted_samples: int,
+    profiler: StageProfiler,
+    on_progress: Optional[Callable[[int, int], Awaitable[None]]] = None,
+) -> List[np.ndarray]:
+    """
+    fit_groups with the labels of previously fitted groups taken from delay.recluster_group_cache.
+    Only the missing groups are fitted, and the ones that were fitted are added to the cache.
+    """
+    if not RECLUSTER_GROUP_CACHE:
+        with profiler.stage("dbscan"):
+            return await fit_groups(
+                coords,
+                weights,
+                plan,
+                epsilon,
+                min_weighted_samples,
+                RECLUSTER_WORKERS,
+                backend=RECLUSTER_BACKEND,
+                earth_radius_km=EARHT_RADIUS_KM,
+                on_progress=on_progress,
             )
 
-        start_time = datetime.now()
-        logger.debug("Start recluster for routes")
+    with profiler.stage("group_cache"):
+        # Groups with too little weight are all noise without fitting, no need to cache them
+        cache_keys = {
+            group_no: group_cache_key(
+                key, coords[idx], weights[idx], epsilon, min_weighted_samples
+            )
+            for group_no, (key, idx) in enumerate(plan)
+            if weights[idx].sum() >= min_weighted_samples
+        }
+        cached = await load_group_labels(list(cache_keys.values()))
+
+    missing = [
+        group_no
+        for group_no in range(len(plan))
+        if cache_keys.get(group_no) not in cached
+    ]
+    logger.debug(
+        f"DBSCAN groups from cache: {len(plan) - len(missing)}, to fit: {len(missing)}"
+    )
 
-        vars_to_group_level_one_clusters_by = [
-            "route_id",
-            "direction_id",
-            "time_group",
-            "dclass",
-        ]
-        cluster_id_vars_on_2nd_level = [
-            "route_id",
-            "direction_id",
-            "time_group",
-            "dclass",
-            "cluster_on_reclustered_level",
-        ]
+    with profiler.stage("dbscan"):
+        fitted = await fit_groups(
+            coords,
+            weights,
+            [plan[group_no] for group_no in missing],
+            epsilon,
+            min_weighted_samples,
+            RECLUSTER_WORKERS,
+            backend=RECLUSTER_BACKEND,
+            earth_radius_km=EARHT_RADIUS_KM,
+            on_progress=on_progress,
+        )
 
-        # This section same as in recluster(). Consider removing recluster() if not used in future
-        # Start of recluster()
-        g = clusters.groupby(vars_to_group_level_one_clusters_by, observed=False)
+    group_labels = [cached.get(cache_keys.get(group_no)) for group_no in range(len(plan))]
+    for group_no, labels in zip(missing, fitted):
+        group_labels[group_no] = labels
 
-        dep_clusters = []
-        reclustered_clusters = []
-        EPSILON = EPS_DISTANCE_2 / EARHT_RADIUS_KM
-        min_weighted_samples = MIN_WEIGHTED_SAMPLES
-        group_count = g.ngroups
-        logger.debug(
-            f"Data to be processed with DBSCAN. Rows: {clusters.shape[0]}, groups: {group_count}"
+    with profiler.stage("group_cache"):
+        await store_group_labels(
+            {
+                cache_keys[group_no]: labels
+                for group_no, labels in zip(missing, fitted)
+                if group_no in cache_keys
+            }
         )
-        for i, (group_key, sub) in enumerate(g, start=1):
-            sub = sub.rename(columns={"cluster": "cluster_on_departure_level"})
-            X = np.radians(sub[["lat_median", "long_median"]])
+    return group_labels
+
+
+async def list_window_routes(
+    from_oday: date, to_oday: date, days_to_exclude: List[date]
+) -> List[str]:
+    """Routes that have preprocessed clusters in a window, in sorted order."""
+    conditions, params = get_window_conditions([], from_oday, to_oday, days_to_exclude)
+    query = f"""
+        SELECT DISTINCT route_id
+        FROM delay.preprocess_clusters
+        WHERE {" AND ".join(conditions)}
+        ORDER BY route_id
+    """
+    async with pool.connection() as conn:
+        cur = await conn.execute(query, params)
+        rows = await cur.fetchall()
+    return [r[0] for r in rows]
 
-            clusterer = DBSCAN(
-                eps=EPSILON,
-                min_samples=min_weighted_samples,  # The number of samples (or total weight) in a neighborhood for a point to be considered as a core point.
-                metric="haversine",
-            )
 
-            sub["cluster_on_reclustered_level"] = clusterer.fit_predict(
-                X, sample_weight=sub["weight"]
+def make_recluster_plan(clusters: pd.DataFrame) -> GroupPlan:
+    """
+    Second level DBSCAN groups of first level clusters. Weekday rows are clustered again
+    as 0_weekday_all through a view in the plan.
+    """
+    return make_group_plan(
+        clusters,
+        RECLUSTER_GROUP_BY,
+        virtual_groups=[
+            (
+                "time_group",
+                "0_weekday_all",
+                is_weekday_time_group(clusters["time_group"]).to_numpy(),
             )
-            sub = sub[sub["cluster_on_reclustered_level"] != -1]
-            if sub.empty:
-                continue
+        ],
+    )
 
-            dep_clusters.append(sub)
-            sub = calculate_cluster_features(sub, cluster_id_vars_on_2nd_level)
-            reclustered_clusters.append(sub)
 
-            if i % 1000 == 0:
-                del sub
-                gc.collect()
-                await update_recluster_progress(
-                    route_ids, from_oday, to_oday, days_to_exclude, f"{i}/{group_count}"
-                )
-                logger.debug(f"DBSCAN processed {i}/{group_count} groups")
+async def recluster_partition(
+    clusters: pd.DataFrame,
+    n_departures_analyzed: pd.DataFrame,
+    profiler: StageProfiler,
+    on_progress: Optional[Callable[[int, int], Awaitable[None]]] = None,
+) -> Optional[pd.DataFrame]:
+    """
+    Route level clusters with the UI variables from the first level clusters of a set of routes.
+    DBSCAN groups never span routes, so routes can be clustered separately or together
+    with the same result. Returns None if no clusters are found.
+    """
+    clusters = clusters.rename(columns={"cluster": "cluster_on_departure_level"})
+    plan = make_recluster_plan(clusters)
 
-        await update_recluster_progress(
-            route_ids,
-            from_oday,
-            to_oday,
-            days_to_exclude,
-            f"{group_count}/{group_count}",
-        )
-        departure_clusters = pd.concat(dep_clusters)
-        route_clusters = pd.concat(reclustered_clusters)
-        # End of recluster()
+    EPSILON = EPS_DISTANCE_2 / EARHT_RADIUS_KM
+    min_weighted_samples = MIN_WEIGHTED_SAMPLES
+    group_count = len(plan)
+    logger.debug(
+        f"Data to be processed with DBSCAN. Rows: {clusters.shape[0]}, groups: {group_count}, backend: {RECLUSTER_BACKEND}"
+    )
+
+    group_labels = await fit_groups_cached(
+        np.radians(clusters[["lat_median", "long_median"]].to_numpy()),
+        clusters["weight"].to_numpy(),
+        plan,
+        EPSILON,
+        min_weighted_samples,
+        profiler,
+        on_progress=on_progress,
+    )
+
+    labels = np.concatenate(group_labels) if group_labels else np.empty(0, int)
+    del group_labels
+    route_clusters = make_route_clusters(
+        clusters, plan, labels, n_departures_analyzed, profiler
+    )
+    if on_progress:
+        await on_progress(group_count, group_count)
+    return route_clusters
 
-        n_departures_analyzed = (
-            preprocessed_departures.groupby(
-                ["route_id", "direction_id", "time_group"], observed=False
+
+async def recluster_windows_partition(
+    window_clusters: List[pd.DataFrame],
+    window_departures_analyzed: List[Optional[pd.DataFrame]],
+    profiler: StageProfiler,
+) -> List[Optional[pd.DataFrame]]:
+    """
+    recluster_partition of the same routes over several windows. The groups of all windows
+    are fitted in one pass, so with the kdtree backend they share one spatial index where
+    the group code tells the windows apart. Returns the route level clusters of every window,
+    None for a window without clusters.
+    """
+    window_clusters = [
+        clusters.rename(columns={"cluster": "cluster_on_departure_level"})
+        if n_departures_analyzed is not None
+        else clusters.iloc[:0]
+        for clusters, n_departures_analyzed in zip(window_clusters, window_departures_analyzed)
+    ]
+    window_plans = [
+        make_recluster_plan(clusters) if len(clusters) else [] for clusters in window_clusters
+    ]
+    offsets = np.cumsum([0] + [len(clusters) for clusters in window_clusters])
+    # Group keys are kept as is, cache keys address the rows of the group and not the window
+    plan = [
+        (key, idx + offset)
+        for window_plan, offset in zip(window_plans, offsets)
+        for key, idx in window_plan
+    ]
+    all_clusters = pd.concat(window_clusters, ignore_index=True)
+    logger.debug(
+        f"Data to be processed with DBSCAN. Windows: {len(window_clusters)}, rows: {all_clusters.shape[0]}, groups: {len(plan)}, backend: {RECLUSTER_BACKEND}"
+    )
+
+    group_labels = await fit_groups_cached(
+        np.radians(all_clusters[["lat_median", "long_median"]].to_numpy()),
+        all_clusters["weight"].to_numpy(),
+        plan,
+        EPS_DISTANCE_2 / EARHT_RADIUS_KM,
+        MIN_WEIGHTED_SAMPLES,
+        profiler,
+    )
+    del all_clusters, plan
+
+    results = []
+    group_offsets = np.cumsum([0] + [len(window_plan) for window_plan in window_plans])
+    for clusters, window_plan, n_departures_analyzed, first_group in zip(
+        window_clusters, window_plans, window_departures_analyzed, group_offsets
+    ):
+        if not window_plan:
+            results.append(None)
+            continue
+        labels = np.concatenate(group_labels[first_group:first_group + len(window_plan)])
+        results.append(
+            make_route_clusters(
+                clusters, window_plan, labels, n_departures_analyzed, profiler
             )
-            .size()
-            .to_frame()
-            .reset_index()
-            .rename(columns={0: "n_departures_analyzed"})
-        )
-        route_clusters = route_clusters[
-            route_clusters["q_50"] >= MIN_MEDIAN_DELAY_IN_CLUSTER
-        ]
-        route_clusters = route_clusters.merge(
-            n_departures_analyzed,
-            how="left",
-            on=["route_id", "direction_id", "time_group"],
-        )
-        route_clusters["share_of_departures"] = (
-            route_clusters["n_departures"]
-            / route_clusters["n_departures_analyzed"]
-            * 100
         )
+    return results
 
-        departure_clusters = route_clusters[
-            [
-                "route_id",
-                "direction_id",
-                "time_group",
-                "dclass",
-                "cluster_on_reclustered_level",
-            ]
-        ].merge(
+
+def make_route_clusters(
+    clusters: pd.DataFrame,
+    plan: GroupPlan,
+    labels: np.ndarray,
+    n_departures_analyzed: pd.DataFrame,
+    profiler: StageProfiler,
+    sample_fraction: float = 1.0,
+    group_fractions: Optional[pd.DataFrame] = None,
+) -> Optional[pd.DataFrame]:
+    """
+    Route level clusters with the UI variables from the second level DBSCAN labels of the
+    rows of the plan, in plan order. Returns None if no clusters are found.
+
+    sample_fraction is the share of the window's days the input covers, and group_fractions
+    the share of the rows of each group kept in a preview sample (RECLUSTER_GROUP_BY columns
+    and row_fraction). Departure counts are scaled up by them.
+    """
+    rows = np.concatenate([idx for _, idx in plan]) if plan else np.empty(0, int)
+    in_cluster = labels != -1
+    if not in_cluster.any():
+        return None
+
+    # This section same as in recluster(). Consider removing recluster() if not used in future
+    departure_clusters = clusters.iloc[rows[in_cluster]].copy()
+    departure_clusters["time_group"] = plan_column(
+        plan, RECLUSTER_GROUP_BY, "time_group"
+    )[in_cluster]
+    departure_clusters["cluster_on_reclustered_level"] = labels[in_cluster]
+    del rows, in_cluster
+
+    with profiler.stage("features"):
+        route_clusters = calculate_cluster_features(
             departure_clusters,
-            on=[
-                "route_id",
-                "direction_id",
-                "time_group",
-                "dclass",
-                "cluster_on_reclustered_level",
-            ],
-            how="inner",
+            RECLUSTER_GROUP_BY + ["cluster_on_reclustered_level"],
+            group_vars=RECLUSTER_GROUP_BY,
         )
-
-        route_clusters = ui_related_var_modifications(
-            route_clusters, SEASON_MONTHS, DEPARTURE_THRESHOLD
+    del departure_clusters
+    # End of recluster()
+
+    route_clusters = route_clusters[
+        route_clusters["q_50"] >= MIN_MEDIAN_DELAY_IN_CLUSTER
+    ]
+    if sample_fraction < 1 or group_fractions is not None:
+        fraction = sample_fraction
+        if group_fractions is not None:
+            fraction = fraction * route_clusters[RECLUSTER_GROUP_BY].merge(
+                group_fractions, how="left", on=RECLUSTER_GROUP_BY
+            )["row_fraction"].fillna(1).to_numpy()
+        route_clusters = route_clusters.assign(
+            n_departures=(route_clusters["n_departures"] / fraction).round().astype("int64")
         )
+        n_departures_analyzed = n_departures_analyzed.assign(
+            n_departures_analyzed=(
+                n_departures_analyzed["n_departures_analyzed"] / sample_fraction
+            ).round().astype("int64")
+        )
+    route_clusters = route_clusters.merge(
+        n_departures_analyzed,
+        how="left",
+        on=["route_id", "direction_id", "time_group"],
+    )
+    route_clusters["share_of_departures"] = (
+        route_clusters["n_departures"]
+        / route_clusters["n_departures_analyzed"]
+        * 100
+    )
 
-        route_clusters["route_dir"] = (
-            route_clusters["route_id"].astype(str)
-            + " S"
-            + route_clusters["direction_id"].astype(str)
+    route_clusters = ui_related_var_modifications(
+        route_clusters, SEASON_MONTHS, DEPARTURE_THRESHOLD
+    )
+
+    route_clusters["route_dir"] = (
+        route_clusters["route_id"].astype(str)
+        + " S"
+        + route_clusters["direction_id"].astype(str)
+    )
+    bins = list(range(0, 101, 20))
+    labs = []
+    for i in range(len(bins) - 1):
+        label = str(bins[i]) + "_" + str(bins[i + 1])
+        labs.append(label)
+
+    route_clusters["shares_category"] = pd.cut(
+        route_clusters["share_of_departures"],
+        bins=bins,
+        labels=labs,
+        include_lowest=True,
+    )
+    route_clusters["share_of_departures"] = round(
+        route_clusters["share_of_departures"], 1
+    )
+    return route_clusters.drop("cluster_on_reclustered_level", axis=1)
+
+
+async def recluster_routes_one_by_one(
+    route_ids: List[str],
+    from_oday: date,
+    to_oday: date,
+    days_to_exclude: List[date],
+    profiler: StageProfiler,
+    on_route_done: Optional[Callable[[int], Awaitable[None]]] = None,
+) -> List[pd.DataFrame]:
+    """
+    Route level clusters of the given routes, one route at a time.
+    Only the input of a single route is in memory at once, so peak memory depends on
+    the largest route instead of all of them. on_route_done is called with the number of
+    routes done after every route.
+    """
+    results = []
+    for done, route_id in enumerate(route_ids, start=1):
+        clusters, n_departures_analyzed = await get_recluster_input(
+            [route_id], from_oday, to_oday, days_to_exclude, profiler
         )
-        bins = list(range(0, 101, 20))
-        labs = []
-        for i in range(len(bins) - 1):
-            label = str(bins[i]) + "_" + str(bins[i + 1])
-            labs.append(label)
+        if clusters is not None and n_departures_analyzed is not None:
+            route_clusters = await recluster_partition(
+                clusters, n_departures_analyzed, profiler
+            )
+            if route_clusters is not None:
+                results.append(route_clusters)
+        del clusters, n_departures_analyzed
+
+        if on_route_done:
+            await on_route_done(done)
+
+    return results
 
-        route_clusters["shares_category"] = pd.cut(
-            route_clusters["share_of_departures"],
-            bins=bins,
-            labels=labs,
-            include_lowest=True,
+
+async def recluster_all_routes(
+    from_oday: date,
+    to_oday: date,
+    days_to_exclude: List[date],
+    profiler: StageProfiler,
+) -> List[pd.DataFrame]:
+    """Route level clusters of every route in a window, one route at a time. Progress is reported in routes."""
+    route_ids = await list_window_routes(from_oday, to_oday, days_to_exclude)
+    logger.debug(f"Recluster all routes one route at a time: {len(route_ids)} routes")
+
+    async def report_progress(done: int):
+        await update_recluster_progress(
+            [], from_oday, to_oday, days_to_exclude, f"{done}/{len(route_ids)}"
         )
-        route_clusters["share_of_departures"] = round(
-            route_clusters["share_of_departures"], 1
+
+    return await recluster_routes_one_by_one(
+        route_ids, from_oday, to_oday, days_to_exclude, profiler, report_progress
+    )
+
+
+async def recluster_analysis(
+    route_ids: list[str], from_oday: date, to_oday: date, days_to_exclude: list[date]
+):
+    """
+    Recluster the first level clusters of a window and store the route level clusters.
+    Without route_ids all routes are analyzed, one route at a time.
+    """
+    with CustomDbLogHandler("api"):
+        profiler = StageProfiler(
+            "recluster",
+            route_id=",".join(route_ids),
+            from_oday=from_oday,
+            to_oday=to_oday,
         )
-        route_clusters = route_clusters.drop("cluster_on_reclustered_level", axis=1)
+        start_time = datetime.now()
+
+        if route_ids:
+            logger.debug("Fetch data for recluster")
+            clusters, n_departures_analyzed = await get_recluster_input(
+                route_ids, from_oday, to_oday, days_to_exclude, profiler
+            )
+            end_time = datetime.now()
+            logger.debug(
+                f"Data fetched for recluster {route_ids}, {from_oday}, {to_oday} in {end_time - start_time}"
+            )
+
+            if clusters is None or n_departures_analyzed is None:
+                raise RuntimeError(
+                    "Missing clusters or departures zst for recluster_analysis"
+                )
+
+            start_time = datetime.now()
+            logger.debug("Start recluster for routes")
+
+            async def report_progress(done: int, total: int):
+                await update_recluster_progress(
+                    route_ids, from_oday, to_oday, days_to_exclude, f"{done}/{total}"
+                )
+                logger.debug(f"DBSCAN processed {done}/{total} groups")
+
+            route_clusters = await recluster_partition(
+                clusters, n_departures_analyzed, profiler, on_progress=report_progress
+            )
+            del clusters, n_departures_analyzed
+            if route_clusters is None:
+                raise RuntimeError("No clusters found in recluster_analysis")
+        else:
+            results = await recluster_all_routes(
+                from_oday, to_oday, days_to_exclude, profiler
+            )
+            if not results:
+                raise RuntimeError("No clusters found in recluster_analysis")
+            route_clusters = pd.concat(results, ignore_index=True)
+            del results
 
         route_clusters = make_geo_df_WGS84(
             route_clusters, lat_col="latitude", lon_col="longitude", crs="EPSG:4326"
@@ -860,7 +2028,7 @@ async def recluster_analysis(
         end_time = datetime.now()
         logger.debug(f"Recluster analysis for routes done in {end_time - start_time}")
 
-        await store_compressed_geojson(
+        await store_recluster_result(
             "recluster_routes",
             db_route_id,
             from_oday,
@@ -868,9 +2036,11 @@ async def recluster_analysis(
             route_clusters,
             days_to_exclude,
             flow_analytics_container_client=flow_analytics_container_client,
+            profiler=profiler,
         )
+        await profiler.store()
 
-        del route_clusters, departure_clusters, clusters, preprocessed_departures
+        del route_clusters
         gc.collect()
         return
         # Modes cluster disabled for now
@@ -935,3 +2105,809 @@ async def recluster_analysis(
         )
         end_time = datetime.now()
         logger.debug(f"Recluster modes stored to db {end_time - start_time}.")"""
+
+
+async def recluster_batch_analysis(
+    scopes: List[List[str]],
+    from_oday: date,
+    to_oday: date,
+    days_to_exclude: List[date],
+):
+    """
+    Recluster several route scopes of the same window, e.g. some routes one by one and all of
+    them together, and store a result for every scope.
+
+    The union of the routes is loaded and clustered once. DBSCAN groups never span routes, so
+    the result of a scope is the rows of its routes in the result of the union. A scope
+    without clusters is marked FAILED, the others are stored.
+    """
+    with CustomDbLogHandler("api"):
+        profiler = StageProfiler(
+            "recluster_batch",
+            route_id=";".join(",".join(scope) for scope in scopes),
+            from_oday=from_oday,
+            to_oday=to_oday,
+        )
+        start_time = datetime.now()
+
+        if any(not scope for scope in scopes):
+            results = await recluster_all_routes(
+                from_oday, to_oday, days_to_exclude, profiler
+            )
+            route_clusters = (
+                pd.concat(results, ignore_index=True) if results else None
+            )
+            del results
+        else:
+            route_ids = sorted({route_id for scope in scopes for route_id in scope})
+            clusters, n_departures_analyzed = await get_recluster_input(
+                route_ids, from_oday, to_oday, days_to_exclude, profiler
+            )
+
+            async def report_progress(done: int, total: int):
+                await asyncio.gather(
+                    *[
+                        update_recluster_progress(
+                            scope, from_oday, to_oday, days_to_exclude, f"{done}/{total}"
+                        )
+                        for scope in scopes
+                    ]
+                )
+
+            route_clusters = None
+            if clusters is not None and n_departures_analyzed is not None:
+                route_clusters = await recluster_partition(
+                    clusters, n_departures_analyzed, profiler, on_progress=report_progress
+                )
+            del clusters, n_departures_analyzed
+
+        logger.debug(
+            f"Recluster of {len(scopes)} scopes done in {datetime.now() - start_time}"
+        )
+
+        flow_analytics_container_client = FlowAnalyticsContainerClient()
+        for scope in scopes:
+            scope_clusters = None
+            if route_clusters is not None:
+                scope_clusters = (
+                    route_clusters[route_clusters["route_id"].isin(scope)].reset_index(
+                        drop=True
+                    )
+                    if scope
+                    else route_clusters
+                )
+
+            if scope_clusters is None or scope_clusters.empty:
+                logger.debug(f"No clusters found for {scope}. Setting status as FAILED")
+                await set_recluster_status(
+                    "recluster_routes",
+                    from_oday,
+                    to_oday,
+                    scope,
+                    days_to_exclude,
+                    ReclusterStatus.FAILED,
+                )
+                continue
+
+            await store_recluster_result(
+                "recluster_routes",
+                scope,
+                from_oday,
+                to_oday,
+                make_geo_df_WGS84(
+                    scope_clusters, lat_col="latitude", lon_col="longitude", crs="EPSG:4326"
+                ),
+                days_to_exclude,
+                flow_analytics_container_client=flow_analytics_container_client,
+                profiler=profiler,
+            )
+        await profiler.store()
+
+        del route_clusters
+        gc.collect()
+
+
+async def plan_recluster_partitions(
+    route_ids: List[str],
+    from_oday: date,
+    to_oday: date,
+    days_to_exclude: List[date],
+) -> List[List[str]]:
+    """
+    Split the routes of a recluster job into partitions analyzed by separate activities,
+    see merge_recluster_partitions. Without route_ids all routes of the window are split.
+
+    Partitions are balanced by the compressed size of the preprocessed clusters of their
+    routes, which follows the number of first level clusters. A job is split into at most
+    RECLUSTER_PARTITIONS partitions of at least RECLUSTER_PARTITION_MIN_ROUTES routes, so a
+    single partition means that the job is run in one activity. Partition results left by an
+    earlier run of the job are removed.
+    """
+    conditions, params = get_window_conditions(
+        route_ids, from_oday, to_oday, days_to_exclude
+    )
+    query = f"""
+        SELECT route_id, sum(octet_length(zst))
+        FROM delay.preprocess_clusters
+        WHERE {" AND ".join(conditions)}
+        GROUP BY route_id
+        ORDER BY route_id
+    """
+    delete_query = """
+        DELETE FROM delay.recluster_partitions
+        WHERE route_id = %(route_id)s AND from_oday = %(from_oday)s AND to_oday = %(to_oday)s AND days_excluded = %(days_excluded)s
+    """
+    async with pool.connection() as conn:
+        cur = await conn.execute(query, params)
+        sizes = await cur.fetchall()
+        await conn.execute(
+            delete_query,
+            {
+                "route_id": route_ids,
+                "from_oday": from_oday,
+                "to_oday": to_oday,
+                "days_excluded": days_to_exclude,
+            },
+        )
+
+    n_partitions = min(RECLUSTER_PARTITIONS, len(sizes) // RECLUSTER_PARTITION_MIN_ROUTES)
+    if n_partitions <= 1:
+        return [[route_id for route_id, _ in sizes]]
+
+    batches = make_batches([size or 0 for _, size in sizes], n_partitions)
+    return [sorted(sizes[i][0] for i in batch) for batch in batches]
+
+
+async def recluster_partition_analysis(
+    route_ids: List[str],
+    partition_no: int,
+    partition_route_ids: List[str],
+    n_routes: int,
+    from_oday: date,
+    to_oday: date,
+    days_to_exclude: List[date],
+) -> None:
+    """
+    Route level clusters of one partition of a recluster job, one route at a time.
+    The clusters are stored as Parquet to delay.recluster_partitions under the job's key,
+    NULL if the partition has none. Progress of the job is reported in routes of the
+    partitions done, n_routes being the number of routes of the whole job.
+    """
+    with CustomDbLogHandler("api"):
+        profiler = StageProfiler(
+            "recluster_partition",
+            route_id=",".join(partition_route_ids),
+            from_oday=from_oday,
+            to_oday=to_oday,
+        )
+        start_time = datetime.now()
+
+        results = await recluster_routes_one_by_one(
+            partition_route_ids, from_oday, to_oday, days_to_exclude, profiler
+        )
+        result = None
+        if results:
+            with profiler.stage("encoding"):
+                buffer = io.BytesIO()
+                pd.concat(results, ignore_index=True).to_parquet(
+                    buffer, compression="zstd"
+                )
+                result = buffer.getvalue()
+                del buffer
+        del results
+
+        insert_query = """
+            INSERT INTO delay.recluster_partitions (route_id, from_oday, to_oday, days_excluded, partition_no, route_ids, result)
+            VALUES (%(route_id)s, %(from_oday)s, %(to_oday)s, %(days_excluded)s, %(partition_no)s, %(route_ids)s, %(result)s)
+            ON CONFLICT (route_id, from_oday, to_oday, days_excluded, partition_no) DO UPDATE
+                SET route_ids = EXCLUDED.route_ids,
+                    result = EXCLUDED.result,
+                    createdAt = now();
+        """
+        done_query = """
+            SELECT sum(cardinality(route_ids))
+            FROM delay.recluster_partitions
+            WHERE route_id = %(route_id)s AND from_oday = %(from_oday)s AND to_oday = %(to_oday)s AND days_excluded = %(days_excluded)s
+        """
+        params = {
+            "route_id": route_ids,
+            "from_oday": from_oday,
+            "to_oday": to_oday,
+            "days_excluded": days_to_exclude,
+            "partition_no": partition_no,
+            "route_ids": partition_route_ids,
+            "result": result,
+        }
+        with profiler.stage("store"):
+            async with pool.connection() as conn:
+                await conn.execute(insert_query, params)
+                cur = await conn.execute(done_query, params)
+                routes_done = (await cur.fetchone())[0]
+
+        await update_recluster_progress(
+            route_ids, from_oday, to_oday, days_to_exclude, f"{routes_done}/{n_routes}"
+        )
+        logger.debug(
+            f"Recluster partition {partition_no} of {len(partition_route_ids)} routes done in {datetime.now() - start_time}"
+        )
+        await profiler.store()
+
+        del result
+        gc.collect()
+
+
+async def merge_recluster_partitions(
+    route_ids: List[str],
+    n_partitions: int,
+    from_oday: date,
+    to_oday: date,
+    days_to_exclude: List[date],
+) -> None:
+    """
+    Store the result of a recluster job split by plan_recluster_partitions from the results
+    of its partitions, and remove them. The rows are in route order, as in the result of a
+    job run in one activity.
+    """
+    with CustomDbLogHandler("api"):
+        profiler = StageProfiler(
+            "recluster",
+            route_id=",".join(route_ids),
+            from_oday=from_oday,
+            to_oday=to_oday,
+        )
+        params = {
+            "route_id": route_ids,
+            "from_oday": from_oday,
+            "to_oday": to_oday,
+            "days_excluded": days_to_exclude,
+        }
+        job_condition = "route_id = %(route_id)s AND from_oday = %(from_oday)s AND to_oday = %(to_oday)s AND days_excluded = %(days_excluded)s"
+
+        with profiler.stage("load"):
+            async with pool.connection() as conn:
+                cur = await conn.execute(
+                    f"""
+                    SELECT result
+                    FROM delay.recluster_partitions
+                    WHERE {job_condition}
+                    ORDER BY partition_no
+                    """,
+                    params,
+                )
+                rows = await cur.fetchall()
+
+        if len(rows) != n_partitions:
+            raise RuntimeError(
+                f"Expected {n_partitions} recluster partitions, found {len(rows)}"
+            )
+
+        with profiler.stage("decompress"):
+            results = [pd.read_parquet(io.BytesIO(r[0])) for r in rows if r[0] is not None]
+        del rows
+        if not results:
+            raise RuntimeError("No clusters found in recluster_analysis")
+
+        route_clusters = pd.concat(results, ignore_index=True)
+        del results
+        order = np.argsort(route_clusters["route_id"].to_numpy(), kind="stable")
+        route_clusters = route_clusters.iloc[order].reset_index(drop=True)
+
+        route_clusters = make_geo_df_WGS84(
+            route_clusters, lat_col="latitude", lon_col="longitude", crs="EPSG:4326"
+        )
+        await store_recluster_result(
+            "recluster_routes",
+            route_ids,
+            from_oday,
+            to_oday,
+            route_clusters,
+            days_to_exclude,
+            flow_analytics_container_client=FlowAnalyticsContainerClient(),
+            profiler=profiler,
+        )
+        async with pool.connection() as conn:
+            await conn.execute(
+                f"DELETE FROM delay.recluster_partitions WHERE {job_condition}", params
+            )
+        await profiler.store()
+
+        del route_clusters
+        gc.collect()
+
+
+def get_window_days(
+    from_oday: date,
+    to_oday: date,
+    days_to_exclude: List[date],
+    max_days: Optional[int] = None,
+) -> List[date]:
+    """
+    Days of a window without the excluded days. With max_days, at most that many
+    evenly spaced days of them.
+    """
+    excluded = set(days_to_exclude)
+    days = [
+        from_oday + timedelta(days=i)
+        for i in range((to_oday - from_oday).days + 1)
+        if from_oday + timedelta(days=i) not in excluded
+    ]
+    if max_days is None or len(days) <= max_days:
+        return days
+    step = len(days) / max_days
+    return [days[int(i * step)] for i in range(max_days)]
+
+
+def has_preview(from_oday: date, to_oday: date, days_to_exclude: List[date]) -> bool:
+    """Whether a preview samples the days of a window, i.e. the window has more than RECLUSTER_PREVIEW_DAYS days."""
+    return len(get_window_days(from_oday, to_oday, days_to_exclude)) > RECLUSTER_PREVIEW_DAYS
+
+
+def sample_recluster_plan(
+    clusters: pd.DataFrame,
+    plan: GroupPlan,
+    max_rows: int,
+    seed: int = 0,
+) -> Tuple[pd.DataFrame, GroupPlan, np.ndarray, pd.DataFrame]:
+    """
+    Coreset of the DBSCAN groups of a plan with at most max_rows first level clusters per group.
+    Larger groups keep a random sample of their rows, whose DBSCAN weights are scaled up by the
+    inverse of the share kept, so that the weight of the group stays about the same.
+
+    Returns the sampled rows, the plan over them, their DBSCAN weights and the share of rows kept
+    per group as group_fractions for make_route_clusters.
+    """
+    rng = np.random.default_rng(seed)
+    weights = clusters["weight"].to_numpy()
+    rows = []
+    sample_weights = []
+    sample_plan = []
+    fractions = []
+    n_rows = 0
+    for key, idx in plan:
+        if len(idx) > max_rows:
+            fraction = max_rows / len(idx)
+            idx = np.sort(rng.choice(idx, max_rows, replace=False))
+        else:
+            fraction = 1.0
+        rows.append(idx)
+        sample_weights.append(weights[idx] / fraction)
+        sample_plan.append((key, np.arange(n_rows, n_rows + len(idx))))
+        fractions.append((*key, fraction))
+        n_rows += len(idx)
+
+    rows = np.concatenate(rows) if rows else np.empty(0, int)
+    return (
+        clusters.iloc[rows].reset_index(drop=True),
+        sample_plan,
+        np.concatenate(sample_weights) if sample_weights else np.empty(0),
+        pd.DataFrame(fractions, columns=[*RECLUSTER_GROUP_BY, "row_fraction"]),
+    )
+
+
+async def recluster_preview_partition(
+    clusters: pd.DataFrame,
+    n_departures_analyzed: pd.DataFrame,
+    sample_fraction: float,
+) -> Optional[pd.DataFrame]:
+    """
+    Route level clusters of a preview from the first level clusters of a sample of days,
+    clustered as a coreset of at most RECLUSTER_PREVIEW_GROUP_ROWS rows per DBSCAN group.
+    The groups are fitted in a thread without the group cache, whose labels are those of the
+    exact analysis only. Returns None if no clusters are found.
+    """
+    clusters = clusters.rename(columns={"cluster": "cluster_on_departure_level"})
+    clusters, plan, weights, group_fractions = sample_recluster_plan(
+        clusters, make_recluster_plan(clusters), RECLUSTER_PREVIEW_GROUP_ROWS
+    )
+    logger.debug(f"Preview data to be processed with DBSCAN. Rows: {clusters.shape[0]}, groups: {len(plan)}")
+
+    # One worker: the preview runs in the request, beside the exact jobs
+    group_labels = await asyncio.to_thread(
+        run_asyncio_task,
+        fit_groups,
+        np.radians(clusters[["lat_median", "long_median"]].to_numpy()),
+        weights,
+        plan,
+        EPS_DISTANCE_2 / EARHT_RADIUS_KM,
+        MIN_WEIGHTED_SAMPLES * sample_fraction,
+        1,
+        backend=RECLUSTER_BACKEND,
+        earth_radius_km=EARHT_RADIUS_KM,
+    )
+    labels = np.concatenate(group_labels) if group_labels else np.empty(0, int)
+    return await asyncio.to_thread(
+        make_route_clusters,
+        clusters,
+        plan,
+        labels,
+        n_departures_analyzed,
+        StageProfiler.disabled(),
+        sample_fraction,
+        group_fractions,
+    )
+
+
+async def recluster_preview(
+    route_ids: List[str],
+    from_oday: date,
+    to_oday: date,
+    days_to_exclude: List[date],
+) -> Optional[gpd.GeoDataFrame]:
+    """
+    Approximate result of a window from a sample of RECLUSTER_PREVIEW_DAYS of its days and at
+    most RECLUSTER_PREVIEW_GROUP_ROWS first level clusters per DBSCAN group, so its cost does
+    not grow with the length of the window. All routes are previewed one route at a time.
+    Same columns as the stored result, plus approximate = True. Nothing is stored, see
+    recluster_preview_analysis. Returns None if no clusters are found.
+    """
+    window_days = get_window_days(from_oday, to_oday, days_to_exclude)
+    sampled_days = get_window_days(
+        from_oday, to_oday, days_to_exclude, RECLUSTER_PREVIEW_DAYS
+    )
+    if not sampled_days:
+        return None
+    sampled = set(sampled_days)
+    preview_exclude = sorted(set(days_to_exclude) | {d for d in window_days if d not in sampled})
+    sample_fraction = len(sampled_days) / len(window_days)
+
+    start_time = datetime.now()
+    if route_ids:
+        scopes = [route_ids]
+    else:
+        scopes = [[route_id] for route_id in await list_window_routes(from_oday, to_oday, preview_exclude)]
+
+    results = []
+    for scope in scopes:
+        clusters, n_departures_analyzed = await get_recluster_input(
+            scope, from_oday, to_oday, preview_exclude
+        )
+        if clusters is not None and n_departures_analyzed is not None:
+            route_clusters = await recluster_preview_partition(
+                clusters, n_departures_analyzed, sample_fraction
+            )
+            if route_clusters is not None:
+                results.append(route_clusters)
+        del clusters, n_departures_analyzed
+
+    if not results:
+        return None
+
+    route_clusters = pd.concat(results, ignore_index=True)
+    del results
+    route_clusters["approximate"] = True
+    route_clusters = make_geo_df_WGS84(
+        route_clusters, lat_col="latitude", lon_col="longitude", crs="EPSG:4326"
+    )
+    format_datetime_columns(route_clusters)
+    logger.debug(
+        f"Recluster preview of {route_ids} from {len(sampled_days)}/{len(window_days)} days done in {datetime.now() - start_time}"
+    )
+    return route_clusters
+
+
+async def store_recluster_preview(
+    route_ids: List[str],
+    from_oday: date,
+    to_oday: date,
+    days_excluded: List[date],
+    gdf: Optional[gpd.GeoDataFrame],
+) -> None:
+    """Store a preview as GeoParquet to delay.recluster_previews and set it DONE. gdf is None if it has no clusters."""
+    result = None
+    if gdf is not None:
+        buffer = io.BytesIO()
+        gdf.to_parquet(buffer, compression="zstd")
+        result = buffer.getvalue()
+        del buffer
+
+    query = """
+        INSERT INTO delay.recluster_previews (route_id, from_oday, to_oday, days_excluded, result, status)
+        VALUES (%(route_id)s, %(from_oday)s, %(to_oday)s, %(days_excluded)s, %(result)s, 'DONE')
+        ON CONFLICT (route_id, from_oday, to_oday, days_excluded) DO UPDATE
+            SET result = EXCLUDED.result,
+                status = 'DONE',
+                modifiedAt = now();
+    """
+    async with pool.connection() as conn:
+        await conn.execute(
+            query,
+            {
+                "route_id": route_ids,
+                "from_oday": from_oday,
+                "to_oday": to_oday,
+                "days_excluded": days_excluded,
+                "result": result,
+            },
+        )
+
+
+async def recluster_preview_analysis(
+    route_ids: List[str],
+    from_oday: date,
+    to_oday: date,
+    days_to_exclude: List[date],
+) -> None:
+    """Compute the preview of a window with recluster_preview and store it, see store_recluster_preview."""
+    result = await recluster_preview(route_ids, from_oday, to_oday, days_to_exclude)
+    await store_recluster_preview(route_ids, from_oday, to_oday, days_to_exclude, result)
+    del result
+    gc.collect()
+
+
+async def recluster_sweep(
+    route_ids: List[str],
+    from_oday: date,
+    to_oday: date,
+    days_to_exclude: List[date],
+    settings: List[Tuple[float, float]],
+) -> Tuple[Optional[pd.DataFrame], pd.DataFrame]:
+    """
+    Route level clusters of a window for several second level DBSCAN settings in one pass,
+    for tuning EPS_DISTANCE_2 and MIN_WEIGHTED_SAMPLES. settings are pairs of eps distance
+    in km and min weighted samples.
+
+    The input is loaded once and the neighbour pairs are searched once for the largest eps,
+    see weighted_dbscan_sweep. The labels of every setting are the same as those of a
+    recluster job run with it. Nothing is stored.
+
+    Returns the route clusters of all settings with eps_distance_km and min_weighted_samples
+    columns, None if no setting finds clusters, and a summary with a row per setting.
+    """
+    profiler = StageProfiler.disabled()
+    clusters, n_departures_analyzed = await get_recluster_input(
+        route_ids, from_oday, to_oday, days_to_exclude, profiler
+    )
+    if clusters is None or n_departures_analyzed is None:
+        raise RuntimeError("Missing clusters or departures zst for recluster_sweep")
+
+    start_time = datetime.now()
+    clusters = clusters.rename(columns={"cluster": "cluster_on_departure_level"})
+    plan = make_recluster_plan(clusters)
+    rows = np.concatenate([idx for _, idx in plan]) if plan else np.empty(0, int)
+    group_codes = np.repeat(np.arange(len(plan)), [len(idx) for _, idx in plan])
+    weights = clusters["weight"].to_numpy()[rows]
+    all_labels = weighted_dbscan_sweep(
+        np.radians(clusters[["lat_median", "long_median"]].to_numpy())[rows],
+        weights,
+        group_codes,
+        [(eps_km / EARHT_RADIUS_KM, min_weight) for eps_km, min_weight in settings],
+        EARHT_RADIUS_KM,
+    )
+    logger.debug(
+        f"DBSCAN sweep of {len(settings)} settings over {len(plan)} groups done in {datetime.now() - start_time}"
+    )
+
+    results = []
+    summary = []
+    for (eps_km, min_weight), labels in zip(settings, all_labels):
+        in_cluster = labels != -1
+        route_clusters = make_route_clusters(
+            clusters, plan, labels, n_departures_analyzed, profiler
+        )
+        summary.append(
+            {
+                "eps_distance_km": eps_km,
+                "min_weighted_samples": min_weight,
+                "clustered_weight_share": round(
+                    weights[in_cluster].sum() / max(weights.sum(), 1) * 100, 1
+                ),
+                "second_level_clusters": len(
+                    np.unique(np.column_stack([group_codes, labels])[in_cluster], axis=0)
+                ),
+                "route_clusters": 0 if route_clusters is None else len(route_clusters),
+                "median_q_50": None
+                if route_clusters is None
+                else route_clusters["q_50"].median(),
+                "median_share_of_departures": None
+                if route_clusters is None
+                else route_clusters["share_of_departures"].median(),
+            }
+        )
+        if route_clusters is not None:
+            results.append(
+                route_clusters.assign(
+                    eps_distance_km=eps_km, min_weighted_samples=min_weight
+                )
+            )
+
+    route_clusters = pd.concat(results, ignore_index=True) if results else None
+    return route_clusters, pd.DataFrame(summary)
+
+
+# Route level cluster variables compared between periods
+COMPARISON_VARS = ["q_50", "n_departures", "share_of_departures"]
+
+
+def compare_route_clusters(
+    clusters_a: Optional[pd.DataFrame],
+    clusters_b: Optional[pd.DataFrame],
+    match_distance_m: float = COMPARISON_MATCH_DISTANCE_M,
+) -> Optional[gpd.GeoDataFrame]:
+    """
+    Route level clusters of period A matched to those of period B.
+
+    Clusters of the same route, direction, time group and delay class match if their centers
+    are within match_distance_m of each other, see spatial_clustering.match_nearest. A row has
+    the COMPARISON_VARS of both periods with suffixes _a and _b and their delta b - a, and change
+    "matched", "new" (only in B) or "gone" (only in A). The location is the one of B if the
+    cluster is in B. Returns None if neither period has clusters.
+    """
+    key = RECLUSTER_GROUP_BY
+    columns = key + ["latitude", "longitude"] + COMPARISON_VARS
+    periods = [
+        (df if df is not None else pd.DataFrame(columns=columns))[columns].reset_index(drop=True)
+        for df in [clusters_a, clusters_b]
+    ]
+    if all(df.empty for df in periods):
+        return None
+    a, b = periods
+
+    # Group codes shared by both periods
+    codes = pd.concat([a[key], b[key]], ignore_index=True).astype(str).apply(tuple, axis=1)
+    codes = pd.factorize(codes)[0]
+    idx_a, idx_b, distance = match_nearest(
+        a[["latitude", "longitude"]].to_numpy(dtype=float),
+        codes[: len(a)],
+        b[["latitude", "longitude"]].to_numpy(dtype=float),
+        codes[len(a) :],
+        match_distance_m,
+    )
+
+    matched = pd.concat(
+        [
+            b.iloc[idx_b].reset_index(drop=True),
+            a.iloc[idx_a][COMPARISON_VARS].add_suffix("_a").reset_index(drop=True),
+        ],
+        axis=1,
+    ).rename(columns={var: f"{var}_b" for var in COMPARISON_VARS})
+    matched["match_distance_m"] = distance.round(1)
+    matched["change"] = "matched"
+
+    new = b.drop(index=idx_b).rename(columns={var: f"{var}_b" for var in COMPARISON_VARS})
+    new["change"] = "new"
+    gone = a.drop(index=idx_a).rename(columns={var: f"{var}_a" for var in COMPARISON_VARS})
+    gone["change"] = "gone"
+
+    comparison = pd.concat([matched, new, gone], ignore_index=True)
+    for var in COMPARISON_VARS:
+        comparison[f"{var}_delta"] = comparison[f"{var}_b"] - comparison[f"{var}_a"]
+    comparison = comparison[
+        key
+        + ["latitude", "longitude", "change", "match_distance_m"]
+        + [f"{var}_{s}" for var in COMPARISON_VARS for s in ["a", "b", "delta"]]
+    ]
+    comparison = comparison.sort_values(key, kind="stable").reset_index(drop=True)
+    return make_geo_df_WGS84(
+        comparison, lat_col="latitude", lon_col="longitude", crs="EPSG:4326"
+    )
+
+
+async def recluster_windows_analysis(
+    route_ids: List[str],
+    windows: List[Tuple[date, date, List[date]]],
+):
+    """
+    Recluster the same routes over several windows, e.g. two periods to compare, and store
+    the result of every window like a single request would. A window without clusters is
+    marked FAILED.
+
+    The first level clusters of the union of the windows' days are loaded once and sliced
+    per window, so a day shared by overlapping windows is fetched only once. The DBSCAN groups
+    of all windows are then fitted together, see recluster_windows_partition. Without route_ids
+    all routes are analyzed one route at a time over all windows, and progress is reported
+    in routes.
+    """
+    with CustomDbLogHandler("api"):
+        profiler = StageProfiler(
+            "recluster_windows",
+            route_id=",".join(route_ids),
+            from_oday=windows[0][0],
+            to_oday=windows[0][1],
+        )
+        start_time = datetime.now()
+
+        window_days = [set(get_window_days(*window)) for window in windows]
+        union_from = min(from_oday for from_oday, _, _ in windows)
+        union_to = max(to_oday for _, to_oday, _ in windows)
+        union_days = set().union(*window_days)
+        union_exclude = [
+            oday for oday in get_window_days(union_from, union_to, []) if oday not in union_days
+        ]
+
+        async def recluster_windows(window_route_ids: List[str]) -> List[Optional[pd.DataFrame]]:
+            clusters = await load_preprocess_files(
+                window_route_ids,
+                union_from,
+                union_to,
+                union_exclude,
+                "preprocess_clusters",
+                PREPROCESS_CLUSTERS_DTYPES,
+                profiler,
+            )
+            if clusters is None:
+                logger.debug(f"No preprocessed cluster ZST found for route_id={window_route_ids}")
+                return [None] * len(windows)
+
+            # One window at a time, so that route-days without stored counts are counted once
+            departures_analyzed = []
+            for from_oday, to_oday, days_excluded in windows:
+                departures_analyzed.append(
+                    await get_departure_counts(
+                        window_route_ids, from_oday, to_oday, days_excluded, profiler
+                    )
+                )
+
+            odays = pd.to_datetime(clusters["oday"]).dt.date
+            window_clusters = [
+                clusters[odays.isin(days).to_numpy()].reset_index(drop=True)
+                for days in window_days
+            ]
+            del clusters, odays
+            return await recluster_windows_partition(
+                window_clusters, departures_analyzed, profiler
+            )
+
+        if route_ids:
+            window_results = await recluster_windows(route_ids)
+        else:
+            all_route_ids = sorted(
+                set().union(*[await list_window_routes(*window) for window in windows])
+            )
+            results_by_window: List[List[pd.DataFrame]] = [[] for _ in windows]
+            for done, route_id in enumerate(all_route_ids, start=1):
+                for results, route_clusters in zip(
+                    results_by_window, await recluster_windows([route_id])
+                ):
+                    if route_clusters is not None:
+                        results.append(route_clusters)
+                await asyncio.gather(
+                    *[
+                        update_recluster_progress(
+                            [], from_oday, to_oday, days_excluded, f"{done}/{len(all_route_ids)}"
+                        )
+                        for from_oday, to_oday, days_excluded in windows
+                    ]
+                )
+            window_results = [
+                pd.concat(results, ignore_index=True) if results else None
+                for results in results_by_window
+            ]
+            del results_by_window
+
+        logger.debug(
+            f"Recluster of {len(windows)} windows done in {datetime.now() - start_time}"
+        )
+
+        flow_analytics_container_client = FlowAnalyticsContainerClient()
+        for (from_oday, to_oday, days_excluded), route_clusters in zip(windows, window_results):
+            if route_clusters is None:
+                logger.debug(
+                    f"No clusters found for {route_ids} {from_oday} - {to_oday}. Setting status as FAILED"
+                )
+                await set_recluster_status(
+                    "recluster_routes",
+                    from_oday,
+                    to_oday,
+                    route_ids,
+                    days_excluded,
+                    ReclusterStatus.FAILED,
+                )
+                continue
+
+            await store_recluster_result(
+                "recluster_routes",
+                route_ids,
+                from_oday,
+                to_oday,
+                make_geo_df_WGS84(
+                    route_clusters, lat_col="latitude", lon_col="longitude", crs="EPSG:4326"
+                ),
+                days_excluded,
+                flow_analytics_container_client=flow_analytics_container_client,
+                profiler=profiler,
+            )
+        await profiler.store()
+
+        del window_results
+        gc.collect()
+
@@ -0,0 +1,210 @@
+"""
+Second level DBSCAN of the recluster analysis, fitted group by group.
+
+Two backends give the same labels:
+- "sklearn": groups are independent of each other, so they are fitted with sklearn DBSCAN
+  in a process pool. Only the coordinates and weights of a group are sent to the workers,
+  and this module imports nothing from the database side so that worker processes stay light.
+- "kdtree": all groups are fitted at once with common.spatial_clustering.
+"""
+
+import asyncio
+import heapq
+from concurrent.futures import ProcessPoolExecutor
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from sklearn.cluster import DBSCAN
+
+from common.spatial_clustering import weighted_dbscan
+
+BACKENDS = ["sklearn", "kdtree"]
+
+# Groups are fitted in the calling process when there are fewer than this many to fit
+MIN_GROUPS_FOR_POOL = 50
+# Batches per worker. More batches balance the load better and report progress more often.
+BATCHES_PER_WORKER = 4
+# Fixed cost of fitting a group, in rows. Makes many tiny groups weigh in when balancing batches.
+GROUP_OVERHEAD_ROWS = 100
+PROGRESS_INTERVAL = 1000
+
+GroupPlan = List[Tuple[tuple, np.ndarray]]
+ProgressCallback = Callable[[int, int], Awaitable[None]]
+VirtualGroup = Tuple[str, object, np.ndarray]
+
+
+def make_group_plan(
+    df: pd.DataFrame,
+    group_by: List[str],
+    virtual_groups: Optional[List[VirtualGroup]] = None,
+) -> GroupPlan:
+    """
+    Group keys with positional row indices of the group, in sorted group key order.
+
+    virtual_groups are (column, value, mask) views: the rows selected by mask are grouped
+    once more as if column had the given value, without copying the rows. The same row can
+    thus belong to several groups of the plan.
+    """
+    indices = dict(df.groupby(group_by, observed=True, sort=True).indices)
+    for column, value, mask in virtual_groups or []:
+        positions = np.flatnonzero(mask)
+        keys = pd.DataFrame(
+            {
+                c: np.full(len(positions), value, dtype=object)
+                if c == column
+                else df[c].to_numpy()[positions]
+                for c in group_by
+            }
+        )
+        for key, idx in keys.groupby(group_by, observed=True, sort=True).indices.items():
+            indices[key] = positions[idx]
+    return sorted(indices.items(), key=lambda item: item[0])
+
+
+def plan_column(plan: GroupPlan, group_by: List[str], column: str) -> np.ndarray:
+    """Value of a group key column for every row of the plan, in plan row order."""
+    position = group_by.index(column)
+    return np.repeat(
+        np.array([key[position] for key, _ in plan], dtype=object),
+        [len(idx) for _, idx in plan],
+    )
+
+
+def fit_dbscan_group(
+    X: np.ndarray, weights: np.ndarray, epsilon: float, min_weighted_samples: int
+) -> np.ndarray:
+    """Cluster labels of one group, -1 for noise. X is [lat, long] in radians."""
+    clusterer = DBSCAN(
+        eps=epsilon,
+        min_samples=min_weighted_samples,  # The number of samples (or total weight) in a neighborhood for a point to be considered as a core point.
+        metric="haversine",
+    )
+    return clusterer.fit_predict(X, sample_weight=weights)
+
+
+def fit_dbscan_batch(
+    batch: List[Tuple[int, np.ndarray, np.ndarray]],
+    epsilon: float,
+    min_weighted_samples: int,
+) -> List[Tuple[int, np.ndarray]]:
+    """Fit a batch of (group number, X, weights) in a worker process."""
+    return [
+        (group_no, fit_dbscan_group(X, weights, epsilon, min_weighted_samples))
+        for group_no, X, weights in batch
+    ]
+
+
+def make_batches(costs: List[int], n_batches: int) -> List[List[int]]:
+    """
+    Split items into batches of about equal total cost, assigning the most expensive item
+    first to the least loaded batch. Batches are returned from the heaviest to the lightest
+    so that the long running ones are started first.
+    """
+    n_batches = max(1, min(n_batches, len(costs)))
+    order = sorted(range(len(costs)), key=lambda i: (-costs[i], i))
+    loads = [(0, b) for b in range(n_batches)]
+    batches: List[List[int]] = [[] for _ in range(n_batches)]
+    for i in order:
+        load, b = heapq.heappop(loads)
+        batches[b].append(i)
+        heapq.heappush(loads, (load + costs[i], b))
+    batch_loads = {b: load for load, b in loads}
+    return [batches[b] for b in sorted(batch_loads, key=lambda b: (-batch_loads[b], b))]
+
+
+async def fit_groups(
+    coords: np.ndarray,
+    weights: np.ndarray,
+    plan: GroupPlan,
+    epsilon: float,
+    min_weighted_samples: int,
+    workers: int,
+    backend: str = "sklearn",
+    earth_radius_km: float = 6371,
+    on_progress: Optional[ProgressCallback] = None,
+) -> List[np.ndarray]:
+    """
+    Fit DBSCAN for every group of the plan. Returns the labels of each group in plan order,
+    regardless of the order in which the workers finish.
+
+    A point can only be a core point if the weight of its neighbourhood reaches
+    min_weighted_samples, so a group with less total weight is all noise and is not fitted.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown recluster backend {backend}, expected one of {BACKENDS}")
+
+    group_count = len(plan)
+    labels: List[Optional[np.ndarray]] = [None] * group_count
+    to_fit = []
+    for group_no, (_, idx) in enumerate(plan):
+        if weights[idx].sum() < min_weighted_samples:
+            labels[group_no] = np.full(len(idx), -1, dtype=np.int64)
+        else:
+            to_fit.append(group_no)
+
+    done = group_count - len(to_fit)
+    reported = done // PROGRESS_INTERVAL
+
+    async def report(n_done: int):
+        nonlocal reported
+        if on_progress and n_done // PROGRESS_INTERVAL > reported:
+            reported = n_done // PROGRESS_INTERVAL
+            await on_progress(n_done, group_count)
+
+    if backend == "kdtree":
+        if to_fit:
+            sizes = [len(plan[group_no][1]) for group_no in to_fit]
+            rows = np.concatenate([plan[group_no][1] for group_no in to_fit])
+            group_codes = np.repeat(np.arange(len(to_fit)), sizes)
+            fitted = weighted_dbscan(
+                coords[rows],
+                weights[rows],
+                group_codes,
+                epsilon,
+                min_weighted_samples,
+                earth_radius_km,
+            )
+            for group_no, group_labels in zip(
+                to_fit, np.split(fitted, np.cumsum(sizes)[:-1])
+            ):
+                labels[group_no] = group_labels
+        await report(group_count)
+        return labels
+
+    if workers <= 1 or len(to_fit) < MIN_GROUPS_FOR_POOL:
+        for group_no in to_fit:
+            idx = plan[group_no][1]
+            labels[group_no] = fit_dbscan_group(
+                coords[idx], weights[idx], epsilon, min_weighted_samples
+            )
+            done += 1
+            await report(done)
+        return labels
+
+    costs = [len(plan[group_no][1]) + GROUP_OVERHEAD_ROWS for group_no in to_fit]
+    batches = make_batches(costs, workers * BATCHES_PER_WORKER)
+
+    loop = asyncio.get_running_loop()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for batch in batches:
+            payload = []
+            for i in batch:
+                group_no = to_fit[i]
+                idx = plan[group_no][1]
+                payload.append((group_no, coords[idx], weights[idx]))
+            futures.append(
+                loop.run_in_executor(
+                    executor, fit_dbscan_batch, payload, epsilon, min_weighted_samples
+                )
+            )
+
+        for future in asyncio.as_completed(futures):
+            batch_labels = await future
+            for group_no, group_labels in batch_labels:
+                labels[group_no] = group_labels
+            done += len(batch_labels)
+            await report(done)
+
+    return labels
@@ -0,0 +1,263 @@
+"""
+Weighted DBSCAN for the recluster analysis on projected coordinates.
+
+Gives the same labels as sklearn DBSCAN(metric="haversine", sample_weight=...) fitted
+separately for every group, but fits all groups at once:
+
+- Points are projected to ETRS-TM35FIN (EPSG:3067) and put into one KD-tree. Groups are
+  kept apart by shifting each group far away on the x axis, so no pair crosses groups.
+- Candidate pairs are searched with a slightly larger radius and then filtered with the
+  haversine distance, so the neighbourhoods are exactly the ones sklearn uses.
+- Core points are those whose neighbourhood weight (self included) reaches
+  min_weighted_samples. Clusters are connected components of core points.
+- Like sklearn, clusters are numbered within the group by their first core point and a
+  border point gets the label of the first cluster that reaches it.
+"""
+
+from typing import List, Optional, Tuple
+
+import numpy as np
+from pyproj import Transformer
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+
+PROJECTED_CRS = "EPSG:3067"
+# Distance between groups on the x axis of the shared KD-tree, in metres
+GROUP_OFFSET_M = 1e7
+# Extra search radius covering the difference between projected and haversine distances
+CANDIDATE_MARGIN = 0.02
+
+_transformer = None
+
+
+def _get_transformer() -> Transformer:
+    global _transformer
+    if _transformer is None:
+        _transformer = Transformer.from_crs("EPSG:4326", PROJECTED_CRS, always_xy=True)
+    return _transformer
+
+
+def haversine(
+    lat_1: np.ndarray, lon_1: np.ndarray, lat_2: np.ndarray, lon_2: np.ndarray
+) -> np.ndarray:
+    """Great circle distance in radians between points given in radians."""
+    sin_lat = np.sin((lat_2 - lat_1) / 2)
+    sin_lon = np.sin((lon_2 - lon_1) / 2)
+    a = sin_lat**2 + np.cos(lat_1) * np.cos(lat_2) * sin_lon**2
+    return 2 * np.arcsin(np.sqrt(a))
+
+
+def neighbour_pairs(
+    coords: np.ndarray,
+    group_codes: np.ndarray,
+    epsilon: float,
+    earth_radius_km: float,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Pairs (i, j), i < j, of points in the same group within epsilon of each other.
+
+    Args:
+        coords: [lat, long] in radians, shape (n, 2)
+        group_codes: group number of every point
+        epsilon: DBSCAN eps in radians
+        earth_radius_km: radius used to turn epsilon into metres for the candidate search
+
+    Returns:
+        i, j and the haversine distance of every pair in radians
+    """
+    coords = np.asarray(coords, dtype=np.float64)
+    lat = coords[:, 0]
+    lon = coords[:, 1]
+    x, y = _get_transformer().transform(np.degrees(lon), np.degrees(lat))
+    points = np.column_stack([x + group_codes * GROUP_OFFSET_M, y])
+
+    radius_m = epsilon * earth_radius_km * 1000 * (1 + CANDIDATE_MARGIN)
+    pairs = cKDTree(points).query_pairs(radius_m, output_type="ndarray")
+    i = pairs[:, 0]
+    j = pairs[:, 1]
+
+    distance = haversine(lat[i], lon[i], lat[j], lon[j])
+    within = distance <= epsilon
+    return i[within], j[within], distance[within]
+
+
+def get_neighbourhood_weight(
+    n: int, i: np.ndarray, j: np.ndarray, weights: np.ndarray
+) -> np.ndarray:
+    """Total weight of the neighbourhood of every point, self included."""
+    weights = np.asarray(weights, dtype=np.float64)
+    return (
+        weights
+        + np.bincount(i, weights=weights[j], minlength=n)
+        + np.bincount(j, weights=weights[i], minlength=n)
+    )
+
+
+def label_clusters(
+    n: int,
+    i: np.ndarray,
+    j: np.ndarray,
+    weights: np.ndarray,
+    group_codes: np.ndarray,
+    min_weighted_samples: float,
+    neighbourhood_weight: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """
+    DBSCAN labels from neighbour pairs. Labels are numbered from 0 within each group,
+    -1 is noise. neighbourhood_weight of the pairs can be given if already computed.
+    """
+    if neighbourhood_weight is None:
+        neighbourhood_weight = get_neighbourhood_weight(n, i, j, weights)
+    is_core = neighbourhood_weight >= min_weighted_samples
+
+    labels = np.full(n, -1, dtype=np.int64)
+    if not is_core.any():
+        return labels
+
+    core_edges = is_core[i] & is_core[j]
+    graph = coo_matrix(
+        (np.ones(core_edges.sum(), dtype=np.int8), (i[core_edges], j[core_edges])),
+        shape=(n, n),
+    )
+    _, component = connected_components(graph, directed=False)
+
+    # Number the clusters of a group in the order of their first core point
+    core_idx = np.flatnonzero(is_core)
+    core_component = component[core_idx]
+    first_core = np.full(component.max() + 1, n, dtype=np.int64)
+    np.minimum.at(first_core, core_component, core_idx)
+    cluster_components = np.unique(core_component)
+    starts = first_core[cluster_components]
+    order = np.lexsort((starts, group_codes[starts]))
+    ordered_groups = group_codes[starts[order]]
+    is_first_of_group = np.r_[True, ordered_groups[1:] != ordered_groups[:-1]]
+    group_start = np.maximum.accumulate(
+        np.where(is_first_of_group, np.arange(len(order)), 0)
+    )
+    component_label = np.full(component.max() + 1, -1, dtype=np.int64)
+    component_label[cluster_components[order]] = np.arange(len(order)) - group_start
+    labels[core_idx] = component_label[core_component]
+
+    # Border points join the earliest created cluster among their core neighbours
+    border_label = np.full(n, np.iinfo(np.int64).max, dtype=np.int64)
+    to_border = is_core[i] & ~is_core[j]
+    np.minimum.at(border_label, j[to_border], labels[i[to_border]])
+    to_border = is_core[j] & ~is_core[i]
+    np.minimum.at(border_label, i[to_border], labels[j[to_border]])
+    is_border = ~is_core & (border_label != np.iinfo(np.int64).max)
+    labels[is_border] = border_label[is_border]
+    return labels
+
+
+def weighted_dbscan(
+    coords: np.ndarray,
+    weights: np.ndarray,
+    group_codes: np.ndarray,
+    epsilon: float,
+    min_weighted_samples: float,
+    earth_radius_km: float,
+) -> np.ndarray:
+    """
+    DBSCAN labels of all points, clustered separately within each group.
+
+    Args:
+        coords: [lat, long] in radians, shape (n, 2)
+        weights: sample weight of every point
+        group_codes: group number of every point, 0..n_groups-1
+        epsilon: DBSCAN eps in radians, as for sklearn with metric="haversine"
+        min_weighted_samples: DBSCAN min_samples as total weight
+        earth_radius_km: radius that was used to compute epsilon
+    """
+    n = len(weights)
+    if n == 0:
+        return np.empty(0, dtype=np.int64)
+    group_codes = np.asarray(group_codes, dtype=np.int64)
+    i, j, _ = neighbour_pairs(coords, group_codes, epsilon, earth_radius_km)
+    return label_clusters(n, i, j, weights, group_codes, min_weighted_samples)
+
+
+def weighted_dbscan_sweep(
+    coords: np.ndarray,
+    weights: np.ndarray,
+    group_codes: np.ndarray,
+    settings: List[Tuple[float, float]],
+    earth_radius_km: float,
+) -> List[np.ndarray]:
+    """
+    weighted_dbscan labels for several (epsilon, min_weighted_samples) settings.
+
+    The neighbour pairs are searched once for the largest epsilon. The pairs of a smaller
+    epsilon are those within it by haversine distance, so every setting gets the same labels
+    as a separate weighted_dbscan call.
+    """
+    n = len(weights)
+    if n == 0 or not settings:
+        return [np.empty(0, dtype=np.int64) for _ in settings]
+    group_codes = np.asarray(group_codes, dtype=np.int64)
+    max_epsilon = max(epsilon for epsilon, _ in settings)
+    i, j, distance = neighbour_pairs(coords, group_codes, max_epsilon, earth_radius_km)
+
+    labels = [None] * len(settings)
+    for epsilon in sorted({epsilon for epsilon, _ in settings}):
+        within = distance <= epsilon
+        eps_i, eps_j = (i, j) if within.all() else (i[within], j[within])
+        # Neighbourhoods depend on epsilon only, core points on min_weighted_samples too
+        neighbourhood_weight = get_neighbourhood_weight(n, eps_i, eps_j, weights)
+        for setting_no, (setting_epsilon, min_weighted_samples) in enumerate(settings):
+            if setting_epsilon == epsilon:
+                labels[setting_no] = label_clusters(
+                    n,
+                    eps_i,
+                    eps_j,
+                    weights,
+                    group_codes,
+                    min_weighted_samples,
+                    neighbourhood_weight,
+                )
+    return labels
+
+
+def match_nearest(
+    coords_a: np.ndarray,
+    group_codes_a: np.ndarray,
+    coords_b: np.ndarray,
+    group_codes_b: np.ndarray,
+    max_distance_m: float,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    One to one matching of points b to the nearest points a of the same group.
+
+    Points a are put into one KD-tree with the groups kept apart like in neighbour_pairs,
+    and every point b is matched to its nearest point a within max_distance_m. If several
+    points b have the same nearest point a, the nearest of them is matched and the others
+    stay unmatched.
+
+    Args:
+        coords_a, coords_b: [lat, long] in degrees, shape (n, 2)
+        group_codes_a, group_codes_b: group number of every point, comparable between a and b
+        max_distance_m: longest matching distance in metres
+
+    Returns:
+        indices of the matched points a and b and their distance in metres
+    """
+    def project(coords: np.ndarray, group_codes: np.ndarray) -> np.ndarray:
+        coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+        x, y = _get_transformer().transform(coords[:, 1], coords[:, 0])
+        return np.column_stack([x + np.asarray(group_codes) * GROUP_OFFSET_M, y])
+
+    empty = np.empty(0, dtype=np.int64)
+    if len(coords_a) == 0 or len(coords_b) == 0:
+        return empty, empty, np.empty(0)
+
+    distance, idx_a = cKDTree(project(coords_a, group_codes_a)).query(
+        project(coords_b, group_codes_b), distance_upper_bound=max_distance_m
+    )
+    # Points without a match get the index len(coords_a)
+    idx_b = np.flatnonzero(idx_a < len(coords_a))
+    idx_a, distance = idx_a[idx_b], distance[idx_b]
+
+    order = np.lexsort((idx_b, distance))
+    _, first = np.unique(idx_a[order], return_index=True)
+    keep = np.sort(order[first])
+    return idx_a[keep], idx_b[keep], distance[keep]
@@ -1,23 +1,444 @@
-import io
 import json
 import logging
-import zipfile
-from datetime import datetime, timedelta, timezone
+from datetime import date, datetime, timedelta, timezone
 
 import azure.durable_functions as durableFunc
 import azure.functions as func
 from common.enums import ReclusterStatus
 from common.logger_util import CustomDbLogHandler
 from common.recluster import (
+    build_recluster_zip,
+    canonicalize_recluster_payload,
+    compare_route_clusters,
+    dispatch_recluster_jobs,
+    enqueue_recluster_job,
+    enqueue_recluster_jobs,
+    get_queue_position,
     get_recluster_status,
+    has_preview,
+    iter_recluster_csv,
+    iter_recluster_geojson,
     load_recluster_csv,
     load_recluster_geojson,
+    load_recluster_result,
+    load_recluster_zip,
     set_recluster_status,
+    store_recluster_zip,
 )
 from fastapi import status as status_code
 
 logger = logging.getLogger("importer")
 
+# Minutes after which a preview that is not done is started again
+PREVIEW_STALE_MINUTES = 10
+
+
+async def build_and_store_zip(
+    table: str,
+    from_oday: str,
+    to_oday: str,
+    days_excluded: list,
+    route_ids: list,
+) -> bytes:
+    """Build the download zip of a finished analysis and persist it for later polls."""
+    result = await load_recluster_result(
+        table,
+        from_oday,
+        to_oday,
+        days_excluded,
+        route_ids
+    )
+    if result is not None:
+        files = {
+            "routecluster.geojson": iter_recluster_geojson(result),
+            "routecluster.csv": iter_recluster_csv(result),
+        }
+    else:
+        # Results stored before GeoParquet
+        files = {}
+        geojson_bytes = await load_recluster_geojson(
+            table,
+            from_oday,
+            to_oday,
+            days_excluded,
+            route_ids
+        )
+        if geojson_bytes is not None:
+            files["routecluster.geojson"] = [geojson_bytes]
+        csv_bytes = await load_recluster_csv(
+            table,
+            from_oday,
+            to_oday,
+            days_excluded,
+            route_ids
+        )
+        if csv_bytes is not None:
+            files["routecluster.csv"] = [csv_bytes]
+
+    zip_bytes = build_recluster_zip(files)
+    del result, files
+
+    await store_recluster_zip(
+        table,
+        from_oday,
+        to_oday,
+        days_excluded,
+        route_ids,
+        zip_bytes
+    )
+    return zip_bytes
+
+
+async def get_queued_status(
+    table: str,
+    from_oday: str,
+    to_oday: str,
+    route_ids: list,
+    days_excluded: list,
+) -> dict:
+    """Status and progress of a job that is not done, with its position in the queue while it is QUEUED."""
+    analysis_status = await get_recluster_status(
+        table,
+        from_oday,
+        to_oday,
+        route_ids,
+        days_excluded
+    )
+    status: ReclusterStatus = analysis_status.get("status") or ReclusterStatus.CREATED
+    queue_position = None
+    if status == ReclusterStatus.QUEUED:
+        queue_position = await get_queue_position(
+            route_ids,
+            from_oday,
+            to_oday,
+            days_excluded
+        )
+    return {
+        "status": status.value,
+        "progress": analysis_status.get("progress"),
+        "queue_position": queue_position,
+    }
+
+
+async def start_batch(payload: dict, starter: str) -> func.HttpResponse:
+    """
+    Queue the analysis of the scopes of a batch that are not done or in progress as one entry,
+    started as one orchestration that loads their routes once. Responds with the status of
+    every scope, the results are downloaded one scope at a time like single requests.
+    """
+    payload = canonicalize_recluster_payload(payload)
+    scopes: list = [
+        canonicalize_recluster_payload({**payload, "route_ids": scope})["route_ids"]
+        for scope in payload.get("scopes", [])
+    ]
+    from_oday: str = payload.get("from_oday")
+    to_oday: str = payload.get("to_oday")
+    days_excluded: list = payload.get("days_excluded", [])
+
+    table = "recluster_routes"
+    stale_cutoff = datetime.now(timezone.utc) - timedelta(hours=1)
+
+    scope_statuses = []
+    to_start = []
+    for scope in scopes:
+        analysis_status = await get_recluster_status(
+            table,
+            from_oday,
+            to_oday,
+            scope,
+            days_excluded
+        )
+        status: ReclusterStatus | None = analysis_status.get("status")
+        created_at = analysis_status.get("createdAt")
+        if status in (ReclusterStatus.RUNNING, ReclusterStatus.PENDING) and created_at and created_at < stale_cutoff:
+            status = ReclusterStatus.FAILED
+
+        if status not in (
+            ReclusterStatus.DONE,
+            ReclusterStatus.RUNNING,
+            ReclusterStatus.QUEUED,
+            ReclusterStatus.PENDING,
+        ):
+            to_start.append(scope)
+            status = ReclusterStatus.QUEUED
+
+        scope_statuses.append(
+            {
+                "route_ids": scope,
+                "status": status.value,
+                "progress": analysis_status.get("progress"),
+            }
+        )
+
+    if to_start:
+        # The scopes are queued as one entry, started as one orchestration
+        await enqueue_recluster_jobs(
+            [(scope, from_oday, to_oday, days_excluded) for scope in to_start],
+            {**payload, "scopes": to_start},
+        )
+    await dispatch_recluster_jobs(durableFunc.DurableOrchestrationClient(starter))
+
+    for scope_status in scope_statuses:
+        if scope_status["status"] != ReclusterStatus.DONE.value:
+            scope_status.update(
+                await get_queued_status(
+                    table,
+                    from_oday,
+                    to_oday,
+                    scope_status["route_ids"],
+                    days_excluded
+                )
+            )
+
+    all_done = all(s["status"] == ReclusterStatus.DONE.value for s in scope_statuses)
+    return func.HttpResponse(
+        body=json.dumps({"scopes": scope_statuses, "params": payload}),
+        status_code=status_code.HTTP_200_OK if all_done else status_code.HTTP_202_ACCEPTED,
+        mimetype="application/json",
+    )
+
+
+async def start_comparison(payload: dict, starter: str) -> func.HttpResponse:
+    """
+    Compare the route level clusters of the same routes in two periods. Once both are done,
+    responds with the matched clusters and their deltas as clusters_comparison.zip. Otherwise
+    queues the periods that are not done or in progress as one entry, started as one
+    orchestration, and responds with the status of both.
+    """
+    payload = canonicalize_recluster_payload(payload)
+    route_ids: list = payload["route_ids"]
+    compare = canonicalize_recluster_payload({**payload["compare"], "route_ids": route_ids})
+    windows = [
+        {key: payload[key] for key in ["from_oday", "to_oday", "days_excluded"]},
+        {key: compare[key] for key in ["from_oday", "to_oday", "days_excluded"]},
+    ]
+    payload["compare"] = windows[1]
+
+    table = "recluster_routes"
+    stale_cutoff = datetime.now(timezone.utc) - timedelta(hours=1)
+
+    window_statuses = []
+    results = []
+    to_start = []
+    for window in windows:
+        analysis_status = await get_recluster_status(
+            table,
+            window["from_oday"],
+            window["to_oday"],
+            route_ids,
+            window["days_excluded"]
+        )
+        status: ReclusterStatus | None = analysis_status.get("status")
+        created_at = analysis_status.get("createdAt")
+        if status in (ReclusterStatus.RUNNING, ReclusterStatus.PENDING) and created_at and created_at < stale_cutoff:
+            status = ReclusterStatus.FAILED
+
+        result = None
+        if status == ReclusterStatus.DONE:
+            result = await load_recluster_result(
+                table,
+                window["from_oday"],
+                window["to_oday"],
+                window["days_excluded"],
+                route_ids
+            )
+            # Results stored before GeoParquet are analyzed again
+            if result is None:
+                status = None
+        results.append(result)
+
+        if status not in (
+            ReclusterStatus.DONE,
+            ReclusterStatus.RUNNING,
+            ReclusterStatus.QUEUED,
+            ReclusterStatus.PENDING,
+        ):
+            to_start.append(window)
+            status = ReclusterStatus.QUEUED
+
+        window_statuses.append(
+            {
+                **window,
+                "status": status.value,
+                "progress": analysis_status.get("progress"),
+            }
+        )
+
+    if to_start:
+        # The periods are queued as one entry, started as one orchestration
+        await enqueue_recluster_jobs(
+            [
+                (route_ids, window["from_oday"], window["to_oday"], window["days_excluded"])
+                for window in to_start
+            ],
+            {"route_ids": route_ids, "windows": to_start},
+        )
+    await dispatch_recluster_jobs(durableFunc.DurableOrchestrationClient(starter))
+
+    for window_status in window_statuses:
+        if window_status["status"] != ReclusterStatus.DONE.value:
+            window_status.update(
+                await get_queued_status(
+                    table,
+                    window_status["from_oday"],
+                    window_status["to_oday"],
+                    route_ids,
+                    window_status["days_excluded"]
+                )
+            )
+
+    if any(s["status"] != ReclusterStatus.DONE.value for s in window_statuses):
+        return func.HttpResponse(
+            body=json.dumps({"windows": window_statuses, "params": payload}),
+            status_code=status_code.HTTP_202_ACCEPTED,
+            mimetype="application/json",
+        )
+
+    comparison = compare_route_clusters(*results)
+    del results
+    if comparison is None:
+        return func.HttpResponse(status_code=status_code.HTTP_204_NO_CONTENT)
+
+    zip_bytes = build_recluster_zip(
+        {
+            "routecluster_comparison.geojson": iter_recluster_geojson(comparison),
+            "routecluster_comparison.csv": iter_recluster_csv(comparison),
+        }
+    )
+    return func.HttpResponse(
+        body=zip_bytes,
+        status_code=200,
+        mimetype="application/zip",
+        headers={
+            "Content-Disposition": 'attachment; filename="clusters_comparison.zip"'
+        }
+    )
+
+
+async def respond_preview(payload: dict, starter: str, queue_exact: bool) -> func.HttpResponse:
+    """
+    Approximate result of a sample of the days while the exact one is not done. The preview
+    is computed by a short orchestration and stored to recluster_previews, so later polls get
+    it without computing it again. Responds 202 until the preview is done.
+    With queue_exact the exact analysis is queued like a normal request.
+    """
+    route_ids: list = payload.get("route_ids", [])
+    from_oday: str = payload.get("from_oday")
+    to_oday: str = payload.get("to_oday")
+    days_excluded: list = payload.get("days_excluded", [])
+
+    client = durableFunc.DurableOrchestrationClient(starter)
+    if queue_exact:
+        await enqueue_recluster_job(route_ids, from_oday, to_oday, days_excluded)
+        await dispatch_recluster_jobs(client)
+
+    table = "recluster_previews"
+    preview_status = await get_recluster_status(
+        table,
+        from_oday,
+        to_oday,
+        route_ids,
+        days_excluded
+    )
+    status: ReclusterStatus | None = preview_status.get("status")
+    created_at = preview_status.get("createdAt")
+    # Previews are short, one not done in PREVIEW_STALE_MINUTES is started again
+    stale_cutoff = datetime.now(timezone.utc) - timedelta(minutes=PREVIEW_STALE_MINUTES)
+    if status in (ReclusterStatus.RUNNING, ReclusterStatus.PENDING) and created_at and created_at < stale_cutoff:
+        status = ReclusterStatus.FAILED
+
+    if status == ReclusterStatus.DONE:
+        result = await load_recluster_result(
+            table,
+            from_oday,
+            to_oday,
+            days_excluded,
+            route_ids
+        )
+        if result is None:
+            return func.HttpResponse(status_code=status_code.HTTP_204_NO_CONTENT)
+
+        zip_bytes = build_recluster_zip(
+            {
+                "routecluster.geojson": iter_recluster_geojson(result),
+                "routecluster.csv": iter_recluster_csv(result),
+            }
+        )
+        return func.HttpResponse(
+            body=zip_bytes,
+            status_code=200,
+            mimetype="application/zip",
+            headers={
+                "Content-Disposition": 'attachment; filename="clusters_preview.zip"'
+            }
+        )
+
+    if status not in (ReclusterStatus.RUNNING, ReclusterStatus.PENDING):
+        await set_recluster_status(
+            table=table,
+            from_oday=from_oday,
+            to_oday=to_oday,
+            route_id=route_ids,
+            days_excluded=days_excluded,
+            status=ReclusterStatus.PENDING
+        )
+        try:
+            await client.start_new("orchestrator", None, {**payload, "preview": True})
+        except Exception as e:
+            logger.debug(f"Error starting preview: {e}")
+            await set_recluster_status(
+                table=table,
+                from_oday=from_oday,
+                to_oday=to_oday,
+                route_id=route_ids,
+                days_excluded=days_excluded,
+                status=ReclusterStatus.FAILED
+            )
+            return func.HttpResponse(
+                body=f"Could not start preview: {e}",
+                status_code=500
+            )
+        status = ReclusterStatus.PENDING
+
+    return func.HttpResponse(
+        body=json.dumps({
+            "status": status.value,
+            "progress": preview_status.get("progress"),
+            "preview": True,
+            "params": payload
+        }),
+        status_code=status_code.HTTP_202_ACCEPTED,
+        mimetype="application/json"
+    )
+
+
+async def respond_in_queue(payload: dict, starter: str) -> func.HttpResponse:
+    """
+    Start the queued jobs there is room for, then report the status of the requested job,
+    with its position in the queue while it is QUEUED. Polling requests thus also move the
+    queue forward.
+    """
+    route_ids: list = payload.get("route_ids", [])
+    from_oday: str = payload.get("from_oday")
+    to_oday: str = payload.get("to_oday")
+    days_excluded: list = payload.get("days_excluded", [])
+
+    await dispatch_recluster_jobs(durableFunc.DurableOrchestrationClient(starter))
+
+    queued_status = await get_queued_status(
+        "recluster_routes",
+        from_oday,
+        to_oday,
+        route_ids,
+        days_excluded
+    )
+    return func.HttpResponse(
+        body=json.dumps({**queued_status, "params": payload}),
+        status_code=status_code.HTTP_202_ACCEPTED,
+        mimetype="application/json"
+    )
+
+
 async def main(req: func.HttpRequest, starter: str) -> func.HttpResponse:
     with CustomDbLogHandler("importer"):
         try:
@@ -25,6 +446,41 @@ async def main(req: func.HttpRequest, starter: str) -> func.HttpResponse:
         except Exception:
             payload = {}
 
+        if "scopes" in payload:
+            try:
+                return await start_batch(payload, starter)
+            except Exception as e:
+                logger.debug(f"Error starting batch in HttpStart: {e}")
+                return func.HttpResponse(
+                    body=json.dumps({"error": f"Could not start batch: {e}"}),
+                    status_code=500,
+                    mimetype="application/json"
+                )
+
+        if "compare" in payload:
+            try:
+                return await start_comparison(payload, starter)
+            except Exception as e:
+                logger.debug(f"Error comparing periods in HttpStart: {e}")
+                return func.HttpResponse(
+                    body=json.dumps({"error": f"Could not compare periods: {e}"}),
+                    status_code=500,
+                    mimetype="application/json"
+                )
+
+        # Preview options are not part of the analysis key
+        preview: bool = payload.pop("preview", False)
+        queue_exact: bool = payload.pop("queue_exact", True)
+
+        try:
+            payload = canonicalize_recluster_payload(payload)
+        except (KeyError, TypeError, ValueError) as e:
+            return func.HttpResponse(
+                body=json.dumps({"error": f"Invalid parameters: {e}"}),
+                status_code=status_code.HTTP_400_BAD_REQUEST,
+                mimetype="application/json"
+            )
+
         route_ids: list = payload.get("route_ids", [])
         from_oday: str = payload.get("from_oday")
         to_oday: str = payload.get("to_oday")
@@ -57,7 +513,7 @@ async def main(req: func.HttpRequest, starter: str) -> func.HttpResponse:
             stale_cutoff = now - timedelta(hours=1)
             is_stale = created_at < stale_cutoff
 
-        if is_stale and status == ReclusterStatus.RUNNING:
+        if is_stale and status in (ReclusterStatus.RUNNING, ReclusterStatus.PENDING):
             try:
                 await set_recluster_status(
                     table=table,
@@ -75,50 +531,57 @@ async def main(req: func.HttpRequest, starter: str) -> func.HttpResponse:
                     mimetype="application/json"
                 )
 
-        if status == ReclusterStatus.RUNNING or status == ReclusterStatus.QUEUED or status == ReclusterStatus.PENDING:
-            return func.HttpResponse(
-                body=json.dumps({
-                    "status": status.value,
-                    "progress": progress,
-                    "params": payload
-                }),
-                status_code=202,
-                mimetype="application/json"
-            )
+        in_progress = status in (ReclusterStatus.RUNNING, ReclusterStatus.QUEUED, ReclusterStatus.PENDING)
 
-        if status == ReclusterStatus.DONE:
+        # A window no longer than the preview sample is analyzed exactly, as a normal request
+        if preview and status != ReclusterStatus.DONE and has_preview(
+            date.fromisoformat(from_oday),
+            date.fromisoformat(to_oday),
+            [date.fromisoformat(d) for d in days_excluded],
+        ):
+            return await respond_preview(payload, starter, queue_exact=queue_exact and not in_progress)
+
+        if in_progress:
             try:
-                geojson_bytes = await load_recluster_geojson(
-                    "recluster_routes",
-                    from_oday,
-                    to_oday,
-                    days_excluded,
-                    route_ids
+                return await respond_in_queue(payload, starter)
+            except Exception as e:
+                logger.debug(f"Error dispatching queued analyses: {e}")
+                return func.HttpResponse(
+                    body=json.dumps({
+                        "status": status.value,
+                        "progress": progress,
+                        "params": payload
+                    }),
+                    status_code=202,
+                    mimetype="application/json"
                 )
-                csv_bytes = await load_recluster_csv(
-                    "recluster_routes",
+
+        if status == ReclusterStatus.DONE:
+            try:
+                zip_bytes = await load_recluster_zip(
+                    table,
                     from_oday,
                     to_oday,
                     days_excluded,
                     route_ids
                 )
+                if zip_bytes is None:
+                    zip_bytes = await build_and_store_zip(
+                        table,
+                        from_oday,
+                        to_oday,
+                        days_excluded,
+                        route_ids
+                    )
             except Exception as e:
                 logger.debug(f"Error loading results: {e}")
                 return func.HttpResponse(
                     body=f"Could not load results: {e}",
                     status_code=500
                 )
-            parent_buffer = io.BytesIO()
-            with zipfile.ZipFile(parent_buffer, "w") as parent_zip:
-                if geojson_bytes is not None:
-                    parent_zip.writestr("routecluster.geojson", geojson_bytes)
-                if csv_bytes is not None:
-                    parent_zip.writestr("routecluster.csv", csv_bytes)
-
-            parent_buffer.seek(0)
 
             return func.HttpResponse(
-                body=parent_buffer.getvalue(),
+                body=zip_bytes,
                 status_code=200,
                 mimetype="application/zip",
                 headers={
@@ -127,13 +590,11 @@ async def main(req: func.HttpRequest, starter: str) -> func.HttpResponse:
             )
 
         try:
-            await set_recluster_status(
-                table=table,
-                from_oday=from_oday,
-                to_oday=to_oday,
-                route_id=route_ids,
-                days_excluded=days_excluded,
-                status=ReclusterStatus.QUEUED
+            await enqueue_recluster_job(
+                route_ids,
+                from_oday,
+                to_oday,
+                days_excluded
             )
         except Exception as e:
             logger.debug(f"Error setting status QUEUED: {e}")
@@ -143,16 +604,4 @@ async def main(req: func.HttpRequest, starter: str) -> func.HttpResponse:
                 mimetype="application/json"
             )
 
-        client = durableFunc.DurableOrchestrationClient(starter)
-        await client.start_new("orchestrator", None, payload)
-        status_msg = status
-        if status_msg is None:
-            status_msg = ReclusterStatus.CREATED
-        
-        return func.HttpResponse(
-            body=json.dumps(
-                {"status": status_msg.value, "progress": progress, "params": payload}
-            ),
-            status_code=status_code.HTTP_202_ACCEPTED,
-            mimetype="application/json",
-        )
+        return await respond_in_queue(payload, starter)
@@ -15,11 +15,91 @@ def orchestrator_function(context: durableFunc.DurableOrchestrationContext):
         to_oday: str = input_payload.get("to_oday")
         days_excluded: list = input_payload.get("days_excluded", [])
 
+        scopes: list | None = input_payload.get("scopes")
+        windows: list | None = input_payload.get("windows")
+
         logger.debug(
             f"Orchestrator started with: "
             f"route_ids={route_ids}, from_oday={from_oday}, to_oday={to_oday}, days_excluded={days_excluded}"
         )
 
+        if input_payload.get("preview"):
+            # Approximate result of a sample of the window, stored to recluster_previews.
+            # Its cost is bounded, so it is started right away instead of being queued.
+            logger.debug("Orchestrator preview")
+            job = {
+                "table": "recluster_previews",
+                "route_ids": route_ids,
+                "from_oday": from_oday,
+                "to_oday": to_oday,
+                "days_excluded": days_excluded,
+            }
+            yield context.call_activity(
+                "setStatusActivity", {**job, "status": ReclusterStatus.RUNNING.value}
+            )
+            yield context.call_activity("reclusterAnalysisActivity", {**job, "preview": True})
+            return {"status": ReclusterStatus.DONE.value}
+
+        if scopes is not None:
+            # Batch of route scopes over one window. httpStart has queued only the scopes
+            # that need to be analyzed. Results are stored, and statuses set, per scope.
+            logger.debug(f"Orchestrator batch of scopes {scopes}")
+            for scope in scopes:
+                yield context.call_activity(
+                    "setStatusActivity",
+                    {
+                        "table": "recluster_routes",
+                        "route_ids": scope,
+                        "from_oday": from_oday,
+                        "to_oday": to_oday,
+                        "days_excluded": days_excluded,
+                        "status": ReclusterStatus.RUNNING.value,
+                    },
+                )
+
+            yield context.call_activity(
+                "reclusterAnalysisActivity",
+                {
+                    "table": "recluster_routes",
+                    "scopes": scopes,
+                    "from_oday": from_oday,
+                    "to_oday": to_oday,
+                    "days_excluded": days_excluded,
+                },
+            )
+            return {"status": ReclusterStatus.DONE.value}
+
+        if windows is not None:
+            # Same routes over several windows, e.g. two periods to compare. httpStart has
+            # queued only the windows that need to be analyzed. Results are stored, and
+            # statuses set, per window.
+            logger.debug(f"Orchestrator windows {windows}")
+            for window in windows:
+                yield context.call_activity(
+                    "setStatusActivity",
+                    {
+                        "table": "recluster_routes",
+                        "route_ids": route_ids,
+                        "from_oday": window["from_oday"],
+                        "to_oday": window["to_oday"],
+                        "days_excluded": window["days_excluded"],
+                        "status": ReclusterStatus.RUNNING.value,
+                    },
+                )
+
+            yield context.call_activity(
+                "reclusterAnalysisActivity",
+                {
+                    "table": "recluster_routes",
+                    "route_ids": route_ids,
+                    "windows": windows,
+                    "from_oday": windows[0]["from_oday"],
+                    "to_oday": windows[0]["to_oday"],
+                    "days_excluded": windows[0]["days_excluded"],
+                },
+            )
+            return {"status": ReclusterStatus.DONE.value}
+
         status_check = yield context.call_activity(
             "getStatusActivity",
             {
@@ -33,9 +113,10 @@ def orchestrator_function(context: durableFunc.DurableOrchestrationContext):
 
         status = status_check.get("status")
 
-        if status is None or ReclusterStatus[status] == ReclusterStatus.QUEUED:
+        # Jobs are started PENDING by the queue dispatcher, QUEUED ones are started directly
+        if status is None or ReclusterStatus[status] in (ReclusterStatus.QUEUED, ReclusterStatus.PENDING):
             logger.debug(
-                f"Orchestrator: status is {ReclusterStatus.QUEUED.value} or not found. Set status to {ReclusterStatus.RUNNING.value}"
+                f"Orchestrator: status is {status} or not found. Set status to {ReclusterStatus.RUNNING.value}"
             )
             yield context.call_activity(
                 "setStatusActivity",
@@ -49,10 +130,9 @@ def orchestrator_function(context: durableFunc.DurableOrchestrationContext):
                 },
             )
 
-            yield context.call_activity(
-                "reclusterAnalysisActivity",
+            partitions = yield context.call_activity(
+                "reclusterPlanActivity",
                 {
-                    "table": "recluster_routes",
                     "route_ids": route_ids,
                     "from_oday": from_oday,
                     "to_oday": to_oday,
@@ -60,6 +140,52 @@ def orchestrator_function(context: durableFunc.DurableOrchestrationContext):
                 },
             )
 
+            if len(partitions) <= 1:
+                yield context.call_activity(
+                    "reclusterAnalysisActivity",
+                    {
+                        "table": "recluster_routes",
+                        "route_ids": route_ids,
+                        "from_oday": from_oday,
+                        "to_oday": to_oday,
+                        "days_excluded": days_excluded,
+                    },
+                )
+            else:
+                # Fan out the partitions to activities that can run on separate workers,
+                # then merge their results into the result of the job
+                logger.debug(f"Orchestrator: split into {len(partitions)} partitions")
+                n_routes = sum(len(partition) for partition in partitions)
+                yield context.task_all(
+                    [
+                        context.call_activity(
+                            "reclusterPartitionActivity",
+                            {
+                                "table": "recluster_routes",
+                                "route_ids": route_ids,
+                                "partition_no": partition_no,
+                                "partition_route_ids": partition,
+                                "n_routes": n_routes,
+                                "from_oday": from_oday,
+                                "to_oday": to_oday,
+                                "days_excluded": days_excluded,
+                            },
+                        )
+                        for partition_no, partition in enumerate(partitions)
+                    ]
+                )
+                yield context.call_activity(
+                    "reclusterMergeActivity",
+                    {
+                        "table": "recluster_routes",
+                        "route_ids": route_ids,
+                        "n_partitions": len(partitions),
+                        "from_oday": from_oday,
+                        "to_oday": to_oday,
+                        "days_excluded": days_excluded,
+                    },
+                )
+
             yield context.call_activity(
                 "setStatusActivity",
                 {
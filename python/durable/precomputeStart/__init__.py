@@ -0,0 +1,83 @@
+import logging
+from datetime import datetime, timedelta, timezone
+
+import azure.durable_functions as durableFunc
+import azure.functions as func
+from common.config import (
+    RECLUSTER_PRECOMPUTE_ATTEMPTS,
+    RECLUSTER_PRECOMPUTE_DAYS,
+    RECLUSTER_PRECOMPUTE_ROUTES,
+)
+from common.enums import ReclusterStatus
+from common.logger_util import CustomDbLogHandler
+from common.recluster import (
+    canonicalize_recluster_payload,
+    dispatch_recluster_jobs,
+    enqueue_recluster_job,
+    get_precompute_requests,
+    get_recluster_attempts,
+    get_recluster_status,
+    is_preprocess_ready,
+)
+from common.utils import get_target_oday
+
+logger = logging.getLogger("importer")
+
+
+async def main(timer: func.TimerRequest, starter: str) -> None:
+    """
+    Queue the standard delay analytics windows of the day once yesterday has been preprocessed.
+    Runs every hour. Windows that already have a status are not queued again, except
+    failed ones and ones stuck RUNNING or PENDING, which are retried until they have been
+    queued RECLUSTER_PRECOMPUTE_ATTEMPTS times.
+    """
+    with CustomDbLogHandler("importer"):
+        yesterday = get_target_oday()
+
+        if not await is_preprocess_ready(yesterday):
+            logger.debug(f"Preprocessing of {yesterday} not ready. Skipping precompute.")
+            return
+
+        client = durableFunc.DurableOrchestrationClient(starter)
+        stale_cutoff = datetime.now(timezone.utc) - timedelta(hours=1)
+        queued = 0
+        for payload in get_precompute_requests(
+            yesterday, RECLUSTER_PRECOMPUTE_DAYS, RECLUSTER_PRECOMPUTE_ROUTES
+        ):
+            payload = canonicalize_recluster_payload(payload)
+            analysis_status = await get_recluster_status(
+                "recluster_routes",
+                payload["from_oday"],
+                payload["to_oday"],
+                payload["route_ids"],
+                payload["days_excluded"],
+            )
+            status: ReclusterStatus | None = analysis_status.get("status")
+            created_at = analysis_status.get("createdAt")
+            if status in (ReclusterStatus.RUNNING, ReclusterStatus.PENDING) and created_at and created_at < stale_cutoff:
+                status = ReclusterStatus.FAILED
+
+            if status == ReclusterStatus.FAILED:
+                attempts = await get_recluster_attempts(
+                    payload["route_ids"],
+                    payload["from_oday"],
+                    payload["to_oday"],
+                    payload["days_excluded"],
+                )
+                if attempts >= RECLUSTER_PRECOMPUTE_ATTEMPTS:
+                    continue
+                logger.debug(f"Retrying failed precompute of {payload}, attempt {attempts + 1}")
+            elif status is not None:
+                continue
+
+            await enqueue_recluster_job(
+                payload["route_ids"],
+                payload["from_oday"],
+                payload["to_oday"],
+                payload["days_excluded"],
+            )
+            queued += 1
+
+        if queued:
+            logger.info(f"Precompute queued {queued} delay analytics windows ending {yesterday}.")
+            await dispatch_recluster_jobs(client)
@@ -5,14 +5,24 @@ from datetime import date
 
 from common.enums import ReclusterStatus
 from common.logger_util import CustomDbLogHandler
-from common.recluster import recluster_analysis, run_asyncio_task, set_recluster_status
+from common.recluster import (
+    recluster_analysis,
+    recluster_batch_analysis,
+    recluster_preview_analysis,
+    recluster_windows_analysis,
+    run_asyncio_task,
+    set_recluster_status,
+)
 
 logger = logging.getLogger("importer")
 
 async def main(input: dict) -> None:
     with CustomDbLogHandler("importer"):
         table: str = input["table"]
-        route_ids: list = input["route_ids"]
+        route_ids: list = input.get("route_ids", [])
+        scopes: list | None = input.get("scopes")
+        windows: list | None = input.get("windows")
+        preview: bool = input.get("preview", False)
         from_oday_str: str = input["from_oday"]
         to_oday_str: str = input["to_oday"]
         days_excluded_str: list = input.get("days_excluded", [])
@@ -28,30 +38,75 @@ async def main(input: dict) -> None:
             logger.debug(f"Invalid date format in ReclusterAnalysisActivity: {e}")
             raise
 
-        logger.debug(f"ReclusterAnalysisActivity starting: {route_ids}, {from_oday}, {to_oday}, {days_excluded}")
+        # Windows set FAILED for every scope if the analysis fails
+        failed_windows = [(from_oday, to_oday, days_excluded)]
 
-        try:
-            await asyncio.to_thread(
-                functools.partial(
-                    run_asyncio_task,
-                    recluster_analysis,
-                    route_ids,
-                    from_oday,
-                    to_oday,
-                    days_excluded
+        if windows is not None:
+            windows = [
+                (
+                    date.fromisoformat(w["from_oday"]),
+                    date.fromisoformat(w["to_oday"]),
+                    [date.fromisoformat(d_str) for d_str in w.get("days_excluded", [])],
                 )
+                for w in windows
+            ]
+            failed_windows = windows
+            scopes = [route_ids]
+            logger.debug(f"ReclusterAnalysisActivity starting windows: {route_ids}, {windows}")
+            analysis = functools.partial(
+                run_asyncio_task,
+                recluster_windows_analysis,
+                route_ids,
+                windows
+            )
+        elif preview:
+            logger.debug(f"ReclusterAnalysisActivity starting preview: {route_ids}, {from_oday}, {to_oday}, {days_excluded}")
+            scopes = [route_ids]
+            analysis = functools.partial(
+                run_asyncio_task,
+                recluster_preview_analysis,
+                route_ids,
+                from_oday,
+                to_oday,
+                days_excluded
+            )
+        elif scopes is not None:
+            logger.debug(f"ReclusterAnalysisActivity starting batch: {scopes}, {from_oday}, {to_oday}, {days_excluded}")
+            analysis = functools.partial(
+                run_asyncio_task,
+                recluster_batch_analysis,
+                scopes,
+                from_oday,
+                to_oday,
+                days_excluded
             )
+        else:
+            logger.debug(f"ReclusterAnalysisActivity starting: {route_ids}, {from_oday}, {to_oday}, {days_excluded}")
+            scopes = [route_ids]
+            analysis = functools.partial(
+                run_asyncio_task,
+                recluster_analysis,
+                route_ids,
+                from_oday,
+                to_oday,
+                days_excluded
+            )
+
+        try:
+            await asyncio.to_thread(analysis)
 
             logger.debug("ReclusterAnalysisActivity completed successfully.")
 
         except Exception as e:
             logger.exception("ReclusterAnalysisActivity error")
-            await set_recluster_status(
-                table,
-                from_oday,
-                to_oday,
-                route_ids,
-                days_excluded,
-                ReclusterStatus.FAILED
-            )
+            for scope in scopes:
+                for window_from_oday, window_to_oday, window_days_excluded in failed_windows:
+                    await set_recluster_status(
+                        table,
+                        window_from_oday,
+                        window_to_oday,
+                        scope,
+                        window_days_excluded,
+                        ReclusterStatus.FAILED
+                    )
             raise
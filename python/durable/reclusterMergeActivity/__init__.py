@@ -0,0 +1,47 @@
+import asyncio
+import functools
+import logging
+from datetime import date
+
+from common.enums import ReclusterStatus
+from common.logger_util import CustomDbLogHandler
+from common.recluster import (
+    merge_recluster_partitions,
+    run_asyncio_task,
+    set_recluster_status,
+)
+
+logger = logging.getLogger("importer")
+
+async def main(input: dict) -> None:
+    with CustomDbLogHandler("importer"):
+        table: str = input["table"]
+        route_ids: list = input.get("route_ids", [])
+        n_partitions: int = input["n_partitions"]
+        from_oday = date.fromisoformat(input["from_oday"])
+        to_oday = date.fromisoformat(input["to_oday"])
+        days_excluded: list[date] = [
+            date.fromisoformat(d_str) for d_str in input.get("days_excluded", [])
+        ]
+
+        logger.debug(
+            f"ReclusterMergeActivity starting: {route_ids}, {n_partitions} partitions, {from_oday}, {to_oday}, {days_excluded}"
+        )
+        try:
+            await asyncio.to_thread(
+                functools.partial(
+                    run_asyncio_task,
+                    merge_recluster_partitions,
+                    route_ids,
+                    n_partitions,
+                    from_oday,
+                    to_oday,
+                    days_excluded,
+                )
+            )
+        except Exception:
+            logger.exception("ReclusterMergeActivity error")
+            await set_recluster_status(
+                table, from_oday, to_oday, route_ids, days_excluded, ReclusterStatus.FAILED
+            )
+            raise
@@ -0,0 +1,52 @@
+import asyncio
+import functools
+import logging
+from datetime import date
+
+from common.enums import ReclusterStatus
+from common.logger_util import CustomDbLogHandler
+from common.recluster import (
+    recluster_partition_analysis,
+    run_asyncio_task,
+    set_recluster_status,
+)
+
+logger = logging.getLogger("importer")
+
+async def main(input: dict) -> None:
+    with CustomDbLogHandler("importer"):
+        table: str = input["table"]
+        route_ids: list = input.get("route_ids", [])
+        partition_no: int = input["partition_no"]
+        partition_route_ids: list = input["partition_route_ids"]
+        n_routes: int = input["n_routes"]
+        from_oday = date.fromisoformat(input["from_oday"])
+        to_oday = date.fromisoformat(input["to_oday"])
+        days_excluded: list[date] = [
+            date.fromisoformat(d_str) for d_str in input.get("days_excluded", [])
+        ]
+
+        logger.debug(
+            f"ReclusterPartitionActivity starting: {route_ids} partition {partition_no} "
+            f"of {len(partition_route_ids)} routes, {from_oday}, {to_oday}, {days_excluded}"
+        )
+        try:
+            await asyncio.to_thread(
+                functools.partial(
+                    run_asyncio_task,
+                    recluster_partition_analysis,
+                    route_ids,
+                    partition_no,
+                    partition_route_ids,
+                    n_routes,
+                    from_oday,
+                    to_oday,
+                    days_excluded,
+                )
+            )
+        except Exception:
+            logger.exception("ReclusterPartitionActivity error")
+            await set_recluster_status(
+                table, from_oday, to_oday, route_ids, days_excluded, ReclusterStatus.FAILED
+            )
+            raise
@@ -0,0 +1,25 @@
+import logging
+from datetime import date
+
+from common.logger_util import CustomDbLogHandler
+from common.recluster import plan_recluster_partitions
+
+logger = logging.getLogger("importer")
+
+async def main(input: dict) -> list:
+    with CustomDbLogHandler("importer"):
+        route_ids: list = input.get("route_ids", [])
+        from_oday = date.fromisoformat(input["from_oday"])
+        to_oday = date.fromisoformat(input["to_oday"])
+        days_excluded: list[date] = [
+            date.fromisoformat(d_str) for d_str in input.get("days_excluded", [])
+        ]
+
+        partitions = await plan_recluster_partitions(
+            route_ids, from_oday, to_oday, days_excluded
+        )
+        logger.debug(
+            f"ReclusterPlanActivity: {route_ids}, {from_oday}, {to_oday}, {days_excluded} "
+            f"split into {len(partitions)} partitions of {[len(p) for p in partitions]} routes"
+        )
+        return partitions
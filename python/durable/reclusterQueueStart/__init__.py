@@ -0,0 +1,21 @@
+import logging
+
+import azure.durable_functions as durableFunc
+import azure.functions as func
+from common.logger_util import CustomDbLogHandler
+from common.recluster import dispatch_recluster_jobs
+
+logger = logging.getLogger("importer")
+
+
+async def main(timer: func.TimerRequest, starter: str) -> None:
+    """
+    Start queued recluster jobs as running ones finish. Runs every minute, so that the queue
+    moves on also when nobody polls httpStart, e.g. for the precomputed windows.
+    """
+    with CustomDbLogHandler("importer"):
+        started = await dispatch_recluster_jobs(
+            durableFunc.DurableOrchestrationClient(starter)
+        )
+        if started:
+            logger.debug(f"Started {started} queued recluster jobs.")
@@ -6,6 +6,7 @@ import httpx
 import psycopg2
 from common.config import DIGITRANSIT_APIKEY, POSTGRES_CONNECTION_STRING
 from common.preprocess import check_preprocessed_files, load_delay_hfp_data, preprocess
+from common.profiler import StageProfiler
 from common.utils import get_target_oday
 
 start_time = 0
@@ -77,14 +78,17 @@ async def run_delay_analysis(requested_oday: date = None):
                         logger.debug(f"[{i}/{len(filtered_route_ids)}] Preprocessed files for {oday} for route_id={route_id} exists. Skipping.")
                         continue
 
-                    df = await load_delay_hfp_data(route_id, oday)
+                    profiler = StageProfiler("preprocess", route_id=route_id, from_oday=oday, to_oday=oday)
+                    df = await load_delay_hfp_data(route_id, oday, profiler)
                     logger.debug(f"[{i}/{len(filtered_route_ids)}] Data fetched from oday {oday} for route_id={route_id}. Running preprocess.")
 
                     try:
-                        await preprocess(df, route_id, oday)
+                        await preprocess(df, route_id, oday, profiler)
                     except ValueError as e:
                         logger.debug(f"[{i}/{len(filtered_route_ids)}] Preprocessing failed for route_id={route_id}, skipping. Error: {e}")
                         continue
+                    finally:
+                        await profiler.store()
                     
                     logger.debug(f"[{i}/{len(filtered_route_ids)}] Preprocessed {route_id}.")
                 
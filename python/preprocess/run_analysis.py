@@ -5,6 +5,7 @@ import httpx
 import psycopg2
 from common.config import DIGITRANSIT_APIKEY, POSTGRES_CONNECTION_STRING
 from common.preprocess import check_preprocessed_files, load_delay_hfp_data, preprocess
+from common.profiler import StageProfiler
 from common.utils import get_target_oday
 
 start_time = 0
@@ -75,14 +76,17 @@ async def run_delay_analysis():
                         logger.debug(f"[{i}/{len(filtered_route_ids)}] Preprocessed files for {yesterday} for route_id={route_id} exists. Skipping.")
                         continue
 
-                    df = await load_delay_hfp_data(route_id, yesterday)
+                    profiler = StageProfiler("preprocess", route_id=route_id, from_oday=yesterday, to_oday=yesterday)
+                    df = await load_delay_hfp_data(route_id, yesterday, profiler)
                     logger.debug(f"[{i}/{len(filtered_route_ids)}] Data fetched from oday {yesterday} for route_id={route_id}. Running preprocess.")
 
                     try:
-                        await preprocess(df, route_id, yesterday)
+                        await preprocess(df, route_id, yesterday, profiler)
                     except ValueError as e:
                         logger.debug(f"[{i}/{len(filtered_route_ids)}] Preprocessing failed for route_id={route_id}, skipping. Error: {e}")
                         continue
+                    finally:
+                        await profiler.store()
                     
                     logger.debug(f"[{i}/{len(filtered_route_ids)}] Preprocessed {route_id}.")
 
@@ -0,0 +1,23 @@
+import asyncio
+import os
+
+# Settings that common.config requires. The tests do not connect to any of them.
+REQUIRED_ENV = {
+    "APC_STORAGE_CONTAINER_NAME": "test",
+    "HFP_STORAGE_CONTAINER_NAME": "test",
+    "HFP_STORAGE_CONNECTION_STRING": "test",
+    "POSTGRES_CONNECTION_STRING": "postgresql://postgres@localhost/test",
+    "DURABLE_BASE_URL": "http://localhost",
+    "AzureWebJobsStorage": "test",
+    "HFP_EVENTS_TO_IMPORT": "VP",
+}
+for name, value in REQUIRED_ENV.items():
+    os.environ.setdefault(name, value)
+
+
+async def import_database():
+    # common.database opens its connection pool on import, which requires a running event loop
+    import common.database  # noqa: F401
+
+
+asyncio.run(import_database())
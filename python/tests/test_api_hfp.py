@@ -0,0 +1,61 @@
+from datetime import date
+
+import pytest
+from api.routers import hfp
+from fastapi import HTTPException
+
+
+def test_parse_route_ids_sorted():
+    assert hfp.parse_route_ids(" 1070, 1057,,") == ["1057", "1070"]
+    assert hfp.parse_route_ids(None) == []
+    assert hfp.parse_route_ids(" ") == []
+
+
+def test_parse_route_ids_invalid():
+    with pytest.raises(HTTPException) as e:
+        hfp.parse_route_ids("1057;1070", loc="route_scopes")
+    assert e.value.status_code == 422
+    assert e.value.detail[0]["loc"] == ["query", "route_scopes"]
+
+
+def test_parse_exclude_dates_sorted():
+    assert hfp.parse_exclude_dates("2025-05-03,2025-05-01") == ["2025-05-01", "2025-05-03"]
+    with pytest.raises(HTTPException):
+        hfp.parse_exclude_dates("2025-05-32")
+
+
+@pytest.mark.asyncio
+async def test_delay_analytics_batch_scopes(monkeypatch):
+    posted = []
+
+    async def post_to_orchestrator(payload):
+        posted.append(payload)
+
+    monkeypatch.setattr(hfp, "post_to_orchestrator", post_to_orchestrator)
+    await hfp.get_delay_analytics_batch(
+        route_scopes="1070,1057;1057;1057,1070",
+        from_oday=date(2025, 5, 1),
+        to_oday=date(2025, 5, 15),
+        exclude_dates="2025-05-03",
+    )
+
+    assert posted == [
+        {
+            "scopes": [["1057", "1070"], ["1057"]],
+            "from_oday": "2025-05-01",
+            "to_oday": "2025-05-15",
+            "days_excluded": ["2025-05-03"],
+        }
+    ]
+
+
+@pytest.mark.asyncio
+async def test_delay_analytics_batch_empty_scope():
+    with pytest.raises(HTTPException) as e:
+        await hfp.get_delay_analytics_batch(
+            route_scopes="1057;;1070",
+            from_oday=date(2025, 5, 1),
+            to_oday=date(2025, 5, 15),
+            exclude_dates=None,
+        )
+    assert e.value.status_code == 422
@@ -0,0 +1,50 @@
+import os
+from datetime import date
+
+from common.file_cache import PreprocessFileCache
+
+ODAY = date(2025, 5, 1)
+
+
+def write_files(cache: PreprocessFileCache, n_files: int, size: int) -> list[str]:
+    """Files of routes 0..n_files-1, the oldest first, and their paths."""
+    paths = []
+    for i in range(n_files):
+        cache.write("preprocess_clusters", str(i), ODAY, 1, b"x" * size)
+        path = cache.path("preprocess_clusters", str(i), ODAY, 1)
+        os.utime(path, (1000 + i, 1000 + i))
+        paths.append(path)
+    return paths
+
+
+def test_read_write_by_version(tmp_path):
+    cache = PreprocessFileCache(str(tmp_path), 1000)
+    assert cache.read("preprocess_clusters", "1057", ODAY, 1) is None
+
+    cache.write("preprocess_clusters", "1057", ODAY, 1, b"data")
+    data = cache.read("preprocess_clusters", "1057", ODAY, 1)
+    assert bytes(data) == b"data"
+    data.close()
+
+    assert not cache.contains("preprocess_clusters", "1057", ODAY, 2)
+    assert not cache.contains("preprocess_departures", "1057", ODAY, 1)
+    assert [p.suffix for p in tmp_path.iterdir()] == [".zst"]
+
+
+def test_evict_removes_least_recently_used_files(tmp_path):
+    cache = PreprocessFileCache(str(tmp_path), 350)
+    paths = write_files(cache, 5, 100)
+
+    # Reading a file makes it the most recently used
+    cache.read("preprocess_clusters", "0", ODAY, 1).close()
+    cache.evict()
+
+    assert [os.path.exists(p) for p in paths] == [True, False, False, True, True]
+
+
+def test_evict_keeps_a_cache_within_max_bytes(tmp_path):
+    cache = PreprocessFileCache(str(tmp_path), 500)
+    paths = write_files(cache, 5, 100)
+    cache.evict()
+
+    assert all(os.path.exists(p) for p in paths)
@@ -0,0 +1,189 @@
+import json
+from datetime import datetime, timedelta, timezone
+
+import durable.httpStart as http_start
+import pytest
+from common.enums import ReclusterStatus
+
+WINDOW = {"from_oday": "2025-05-01", "to_oday": "2025-05-15", "days_excluded": []}
+
+
+class FakeClient:
+    def __init__(self):
+        self.started = []
+        self.fail = False
+
+    async def start_new(self, name, instance_id, payload):
+        if self.fail:
+            raise ConnectionError("durable functions host down")
+        self.started.append(payload)
+
+
+@pytest.fixture
+def recluster_routes(monkeypatch):
+    """In-memory statuses of delay.recluster_routes by route ids, and the queued entries."""
+    rows = {}
+    queued = []
+
+    async def get_recluster_status(table, from_oday, to_oday, route_id=[], exclude_dates=[]):
+        return rows.get(tuple(route_id), {"status": None, "createdAt": None, "progress": None})
+
+    async def enqueue_recluster_jobs(jobs, queue_payload=None):
+        queued.append((jobs, queue_payload))
+        for route_ids, *_ in jobs:
+            rows[tuple(route_ids)] = {
+                "status": ReclusterStatus.QUEUED,
+                "createdAt": datetime.now(timezone.utc),
+                "progress": None,
+            }
+
+    async def dispatch_recluster_jobs(client):
+        return 0
+
+    async def get_queue_position(*args):
+        return 1
+
+    monkeypatch.setattr(http_start, "get_recluster_status", get_recluster_status)
+    monkeypatch.setattr(http_start, "enqueue_recluster_jobs", enqueue_recluster_jobs)
+    monkeypatch.setattr(http_start, "dispatch_recluster_jobs", dispatch_recluster_jobs)
+    monkeypatch.setattr(http_start, "get_queue_position", get_queue_position)
+    monkeypatch.setattr(http_start.durableFunc, "DurableOrchestrationClient", lambda starter: FakeClient())
+    return rows, queued
+
+
+def status_row(status: ReclusterStatus, age: timedelta = timedelta(0)) -> dict:
+    return {"status": status, "createdAt": datetime.now(timezone.utc) - age, "progress": None}
+
+
+@pytest.mark.asyncio
+async def test_start_batch_queues_scopes_not_done_or_in_progress_as_one_entry(recluster_routes):
+    rows, queued = recluster_routes
+    rows[("1001",)] = status_row(ReclusterStatus.DONE)
+    rows[("1002",)] = status_row(ReclusterStatus.RUNNING, timedelta(minutes=5))
+    rows[("1003",)] = status_row(ReclusterStatus.PENDING, timedelta(hours=2))
+    rows[("1004",)] = status_row(ReclusterStatus.FAILED)
+
+    payload = {"scopes": [["1001"], ["1002"], ["1003"], ["1004"], ["1005", "1001"]], **WINDOW}
+    response = await http_start.start_batch(payload, "{}")
+
+    assert response.status_code == 202
+    [(jobs, queue_payload)] = queued
+    to_start = [["1003"], ["1004"], ["1001", "1005"]]
+    assert [route_ids for route_ids, *_ in jobs] == to_start
+    assert queue_payload["scopes"] == to_start
+    body = json.loads(response.get_body())
+    assert [(s["route_ids"], s["status"]) for s in body["scopes"]] == [
+        (["1001"], "DONE"),
+        (["1002"], "RUNNING"),
+        (["1003"], "QUEUED"),
+        (["1004"], "QUEUED"),
+        (["1001", "1005"], "QUEUED"),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_start_batch_all_done(recluster_routes):
+    rows, queued = recluster_routes
+    rows[("1001",)] = status_row(ReclusterStatus.DONE)
+    rows[("1002",)] = status_row(ReclusterStatus.DONE)
+
+    response = await http_start.start_batch({"scopes": [["1001"], ["1002"]], **WINDOW}, "{}")
+
+    assert response.status_code == 200
+    assert queued == []
+
+
+@pytest.fixture
+def recluster_previews(monkeypatch):
+    """In-memory preview status, the statuses set, the exact jobs queued and the client."""
+    preview = {"status": None, "createdAt": None, "progress": None}
+    statuses = []
+    queued = []
+    client = FakeClient()
+
+    async def get_recluster_status(table, from_oday, to_oday, route_id=[], exclude_dates=[]):
+        assert table == "recluster_previews"
+        return preview
+
+    async def set_recluster_status(table, from_oday, to_oday, route_id, days_excluded, status):
+        statuses.append((table, status))
+
+    async def load_recluster_result(table, from_oday, to_oday, days_excluded, route_ids):
+        return None
+
+    async def enqueue_recluster_job(route_ids, from_oday, to_oday, days_excluded):
+        queued.append(route_ids)
+
+    async def dispatch_recluster_jobs(client):
+        return 0
+
+    monkeypatch.setattr(http_start, "get_recluster_status", get_recluster_status)
+    monkeypatch.setattr(http_start, "set_recluster_status", set_recluster_status)
+    monkeypatch.setattr(http_start, "load_recluster_result", load_recluster_result)
+    monkeypatch.setattr(http_start, "enqueue_recluster_job", enqueue_recluster_job)
+    monkeypatch.setattr(http_start, "dispatch_recluster_jobs", dispatch_recluster_jobs)
+    monkeypatch.setattr(http_start.durableFunc, "DurableOrchestrationClient", lambda starter: client)
+    return preview, statuses, queued, client
+
+
+@pytest.mark.asyncio
+async def test_preview_is_started_as_a_durable_job(recluster_previews):
+    preview, statuses, queued, client = recluster_previews
+    payload = {"route_ids": ["1057"], **WINDOW}
+
+    response = await http_start.respond_preview(payload, "{}", queue_exact=True)
+
+    assert response.status_code == 202
+    assert json.loads(response.get_body())["preview"] is True
+    assert queued == [["1057"]]
+    assert statuses == [("recluster_previews", ReclusterStatus.PENDING)]
+    assert client.started == [{**payload, "preview": True}]
+
+
+@pytest.mark.asyncio
+async def test_preview_in_progress_is_not_started_again(recluster_previews):
+    preview, statuses, queued, client = recluster_previews
+    preview.update(status_row(ReclusterStatus.RUNNING, timedelta(minutes=1)))
+
+    response = await http_start.respond_preview({"route_ids": ["1057"], **WINDOW}, "{}", queue_exact=False)
+
+    assert response.status_code == 202
+    assert json.loads(response.get_body())["status"] == "RUNNING"
+    assert client.started == []
+    assert queued == []
+
+
+@pytest.mark.asyncio
+async def test_stale_preview_is_started_again(recluster_previews):
+    preview, statuses, queued, client = recluster_previews
+    preview.update(status_row(ReclusterStatus.PENDING, timedelta(hours=1)))
+
+    response = await http_start.respond_preview({"route_ids": ["1057"], **WINDOW}, "{}", queue_exact=False)
+
+    assert response.status_code == 202
+    assert len(client.started) == 1
+
+
+@pytest.mark.asyncio
+async def test_done_preview_without_clusters(recluster_previews):
+    preview, statuses, queued, client = recluster_previews
+    preview.update(status_row(ReclusterStatus.DONE))
+
+    response = await http_start.respond_preview({"route_ids": ["1057"], **WINDOW}, "{}", queue_exact=False)
+
+    assert response.status_code == 204
+    assert client.started == []
+
+
+@pytest.mark.asyncio
+async def test_preview_that_cannot_be_started_fails(recluster_previews):
+    preview, statuses, queued, client = recluster_previews
+    client.fail = True
+
+    response = await http_start.respond_preview({"route_ids": ["1057"], **WINDOW}, "{}", queue_exact=False)
+
+    assert response.status_code == 500
+    assert statuses == [
+        ("recluster_previews", ReclusterStatus.PENDING),
+        ("recluster_previews", ReclusterStatus.FAILED),
+    ]
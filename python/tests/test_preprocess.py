@@ -0,0 +1,265 @@
+import io
+import warnings
+
+import numpy as np
+import pandas as pd
+import pytest
+import pytz
+from common.preprocess import (
+    EARHT_RADIUS_KM,
+    EPS_DISTANCE_1,
+    HDG_DIFF_LOWER_LIMIT,
+    HDG_DIFF_UPPER_LIMIT,
+    HDG_SPEED_LIMIT,
+    HFP_DTYPES,
+    MAX_TIME_GAP,
+    MIN_DELAY_EVENTS,
+    SPEED_CLASSES,
+    TIME_GROUP_D,
+    classify_events,
+    make_time_groups,
+    preprocess_dataframe,
+    tst_seconds_from_midnight,
+)
+from sklearn.cluster import DBSCAN
+
+
+def make_hfp_day(seed: int, n_departures: int = 40) -> bytes:
+    """
+    One day of HFP of a route as the CSV that load_delay_hfp_data reads. Departures drive,
+    stop with the doors opening and closing and get missing values, other events and
+    duplicate rows, so that some fail the quality checks.
+    """
+    rng = np.random.default_rng(seed)
+    rows = []
+    for departure_no in range(n_departures):
+        start = f"{5 + departure_no // 3:02d}:{(departure_no % 3) * 20:02d}:00"
+        t0 = pd.Timestamp(f"2025-05-06T{start}", tz="Europe/Helsinki").tz_convert("UTC")
+        lat, long, odo, seconds = 60.17, 24.94, 0.0, 0
+        for i in range(int(rng.integers(3, 400))):
+            phase = (i // 20) % 3
+            if phase == 0:
+                spd = float(rng.choice([0.0, 0.1, 0.27, 0.5, 0.83, 2.0, 8.0]))
+                drst = 0
+                stop = None if rng.random() < 0.7 else 1000000 + i // 60
+            elif phase == 1:
+                spd = float(rng.choice([0.0, 0.1, 0.3, 1.0]))
+                drst = int(rng.choice([0, 1, 1]))
+                stop = 1000000 + i // 60
+            else:
+                spd = float(rng.choice([0.2, 0.6, 3.0]))
+                drst = 0 if rng.random() < 0.9 else None
+                stop = 1000000 + i // 60 if rng.random() < 0.5 else None
+            odo += spd + (rng.random() if spd else 0)
+            lat += spd * 1e-6 * rng.random()
+            long += spd * 2e-6 * rng.random()
+            # Unique timestamps, the order of events with equal tst is not defined
+            seconds += 1 if rng.random() > 0.003 else 200
+            rows.append(
+                {
+                    "tst": (t0 + pd.Timedelta(seconds=seconds)).isoformat(),
+                    "event_type": "VP" if rng.random() < 0.95 else "DOO",
+                    "route_id": "1057",
+                    "direction_id": 1 + departure_no % 2,
+                    "operator_id": 22,
+                    "oper": 22,
+                    "vehicle_number": 100 + departure_no % 7,
+                    "transport_mode": "bus",
+                    "oday": "2025-05-06",
+                    "start": start,
+                    "odo": round(odo, 1) if rng.random() < 0.99 else None,
+                    "spd": spd,
+                    "drst": drst,
+                    "loc": "GPS" if rng.random() < 0.97 else rng.choice(["DR", "ODO"]),
+                    "stop": stop,
+                    "hdg": float(rng.integers(0, 360)) if rng.random() < 0.98 else None,
+                    "long": round(long, 6),
+                    "lat": round(lat, 6),
+                }
+            )
+            if rng.random() < 0.01:
+                rows.append(dict(rows[-1]))
+    df = pd.DataFrame(rows).astype({"stop": "Int64", "drst": "Int64"})
+    buffer = io.StringIO()
+    df.to_csv(buffer, index=False)
+    return buffer.getvalue().encode()
+
+
+def reference_classify(drst: np.ndarray, mean_spd: np.ndarray, stop: np.ndarray) -> tuple:
+    """Speed and delay classes of one departure as the per departure preprocess computed them."""
+    vp_event_df = pd.DataFrame(
+        {"tst": np.arange(len(drst)), "drst": drst, "mean_spd": mean_spd, "stop": stop}
+    )
+    vp_event_df["drst"] = vp_event_df["drst"].fillna(2)
+    vp_event_df["sclass"] = ""
+    doors_closed = vp_event_df[vp_event_df["drst"] == 0]
+
+    for k, v in SPEED_CLASSES.items():
+        if "SLOW_MIN" in v:
+            doors_closed.loc[doors_closed["mean_spd"].between(v["SLOW_MIN"], v["SLOW_MAX"]), "sclass"] = k
+        elif "DELAY_MAX" in v:
+            doors_closed.loc[doors_closed["mean_spd"] < v["DELAY_MAX"], "sclass"] = k
+        else:
+            doors_closed.loc[doors_closed["mean_spd"] > v["FAST_MIN"], "sclass"] = k
+
+    doors_opened = vp_event_df[vp_event_df["drst"] != 0]
+    doors_opened.loc[doors_opened["drst"] == 2, "sclass"] = "DRS_ERR"
+    doors_opened.loc[doors_opened["mean_spd"] < 1, "sclass"] = "STOP"
+    doors_opened.loc[doors_opened["mean_spd"] >= 1, "sclass"] = "SPD_ERR"
+
+    vp_event_df = pd.concat([doors_closed, doors_opened], axis=0).sort_values(by="tst").reset_index(drop=True)
+    vp_event_df['stop'] = vp_event_df['stop'].fillna(0)
+    dfs = []
+    for k, res in vp_event_df.groupby('stop'):
+        if k == 0:
+            res['dclass'] = 'on_route'
+        elif set(res.drst) == {1, 0}:
+            idx_doors_open_first_time = res[res.drst == 1].sort_values(by='tst').head(1).index.values[0]
+            res['dclass'] = np.where((res.index < idx_doors_open_first_time) & (pd.notna(res.stop)), "arr", "stop")
+            idx_doors_close_last_time = res[res.drst == 1].sort_values(by='tst').tail(1).index.values[0]
+            res['dclass'] = np.where((res.index > idx_doors_close_last_time) & (pd.notna(res.stop)), "dep", res['dclass'])
+        else:
+            res['dclass'] = np.where(pd.notna(res.stop), "pass", "")
+        dfs.append(res)
+    dfs = pd.concat(dfs).sort_values(by='tst')
+    return dfs["sclass"].to_numpy(), dfs["dclass"].to_numpy()
+
+
+def reference_preprocess(df: pd.DataFrame) -> tuple:
+    """First level clusters and departures of a day as the per departure preprocess computed them."""
+    clusters = []
+    departures = []
+    timezone = pytz.timezone("Europe/Helsinki")
+
+    df["oday"] = pd.to_datetime(df.oday)
+    df['stop'] = df['stop'].astype('Int64')
+    df.tst = pd.to_datetime(df.tst, format="ISO8601").dt.tz_convert(timezone)
+    df['time_group'] = make_time_groups(df, "oday", "start", TIME_GROUP_D)
+    g = df.groupby(["route_id", "direction_id", "oday", "start", "vehicle_number"])
+    for key, sub_df in g:
+        sub_df = sub_df.reset_index(drop=True)
+        sub_df = sub_df[sub_df["loc"].isin(["GPS", "DR"])].reset_index(drop=True)
+        if sub_df.empty:
+            continue
+
+        vp_event_df = sub_df[(sub_df["event_type"] == "VP")]
+        if vp_event_df.empty:
+            continue
+
+        vp_event_df = vp_event_df.drop_duplicates().sort_values(by="tst").reset_index(drop=True)
+        vp_event_df = tst_seconds_from_midnight(vp_event_df)
+        vp_event_df["diff_btwn_tsts"] = np.append([0], np.diff(vp_event_df["tst_seconds_from_midnight"]))
+        vp_event_df["diff_btwn_tsts"] = np.where(vp_event_df["diff_btwn_tsts"] == -60 * 60 * 24 + 1, 1, vp_event_df["diff_btwn_tsts"])
+        vp_event_df["hdg"] = vp_event_df["hdg"].ffill().bfill()
+        vp_event_df["diff_btwn_hdg"] = np.append([0], np.diff(vp_event_df["hdg"]))
+        vp_event_df = vp_event_df.reset_index(drop=True)
+
+        if (
+            (vp_event_df["drst"] == 0.0).all()
+            or (vp_event_df["drst"] == 1.0).all()
+            or vp_event_df['drst'].isna().all()
+            or len(vp_event_df) <= 5
+            or vp_event_df['stop'].isna().all()
+            or pd.isna(vp_event_df["odo"]).all()
+            or pd.isna(vp_event_df["lat"]).all()
+            or pd.isna(vp_event_df["long"]).all()
+            or (vp_event_df["lat"] == 0.0).all()
+            or (vp_event_df["long"] == 0.0).all()
+            or any(vp_event_df.diff_btwn_tsts > MAX_TIME_GAP)
+            or any((np.abs(vp_event_df.diff_btwn_hdg).between(HDG_DIFF_LOWER_LIMIT, HDG_DIFF_UPPER_LIMIT, inclusive='both')) & (vp_event_df.spd > HDG_SPEED_LIMIT))
+        ):
+            continue
+
+        vp_event_df = vp_event_df.loc[vp_event_df[pd.notna(vp_event_df.stop)].head(1).index.values[0] :,].reset_index(drop=True)
+        vp_event_df = vp_event_df.loc[: vp_event_df[pd.notna(vp_event_df.stop)].tail(1).index.values[0],].reset_index(drop=True)
+
+        departures.append(
+            vp_event_df.head(1).reset_index(drop=True)[['tst', 'event_type', 'route_id', 'direction_id', 'operator_id', 'oper', 'vehicle_number', 'transport_mode', 'oday', 'start', 'time_group']]
+        )
+
+        vp_event_df = vp_event_df.dropna(subset=["lat", "long"], how="all")
+        vp_event_df = vp_event_df.sort_values(by="tst").reset_index(drop=True)
+        vp_event_df["odo_spd"] = np.append(np.nan, np.diff(vp_event_df["odo"]))
+        vp_event_df["odo_spd"] = vp_event_df["odo_spd"].rolling(window=5, min_periods=1).mean()
+        vp_event_df["odo_spd"] = vp_event_df["odo_spd"] / vp_event_df["diff_btwn_tsts"]
+        vp_event_df["odo_spd"] = vp_event_df["odo_spd"].ffill().bfill()
+        vp_event_df["mean_spd"] = vp_event_df[["odo_spd", "spd"]].mean(axis=1)
+
+        sclass, dclass = reference_classify(
+            vp_event_df["drst"].to_numpy(dtype="float64", na_value=np.nan),
+            vp_event_df["mean_spd"].to_numpy(),
+            vp_event_df["stop"].to_numpy(dtype="float64", na_value=np.nan),
+        )
+        vp_event_df["sclass"] = sclass
+        vp_event_df["dclass"] = dclass
+        delay_df = vp_event_df[(vp_event_df.dclass != "stop") & vp_event_df['sclass'].isin(['DELAY', 'SLOW'])].copy()
+
+        for _, delay_class_df in delay_df.groupby('dclass'):
+            X = np.radians(delay_class_df[['lat', 'long']])
+            dbscan = DBSCAN(eps=EPS_DISTANCE_1 / EARHT_RADIUS_KM, min_samples=MIN_DELAY_EVENTS, metric='haversine')
+            delay_class_df['cluster'] = dbscan.fit_predict(X)
+            delay_class_df = delay_class_df[delay_class_df['cluster'] != -1]
+            if not delay_class_df.empty:
+                my_vars = ['route_id', 'direction_id', 'dclass', 'oday', 'start', 'time_group', 'cluster']
+                cluster_counts = delay_class_df.groupby(my_vars).size().reset_index(name='weight')
+                median_vars = delay_class_df.groupby(my_vars)[['lat', 'long', 'tst', 'hdg']].median().reset_index()
+                cluster_df = median_vars.merge(cluster_counts, on=my_vars, how='outer')
+                cluster_df = cluster_df[['route_id', 'direction_id', 'hdg', 'dclass', 'oday', 'start', 'tst', 'weight', 'time_group', 'lat', 'long']].rename(
+                    columns={'tst': 'tst_median', 'hdg': 'hdg_median', 'lat': 'lat_median', 'long': 'long_median'}
+                )
+                clusters.append(cluster_df)
+
+    return pd.concat(clusters), pd.concat(departures)
+
+
+def as_stored(df: pd.DataFrame) -> pd.DataFrame:
+    """The frame as it is read back from the stored CSV, so that dtypes do not matter."""
+    buffer = io.StringIO()
+    df.to_csv(buffer, sep=";", index=False)
+    buffer.seek(0)
+    return pd.read_csv(buffer, sep=";")
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_preprocess_dataframe_matches_per_departure_preprocess(seed):
+    raw = make_hfp_day(seed)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        expected_clusters, expected_departures = reference_preprocess(pd.read_csv(io.BytesIO(raw)))
+    clusters, departures = preprocess_dataframe(pd.read_csv(io.BytesIO(raw), dtype=HFP_DTYPES))
+
+    assert len(expected_departures) > 0
+    pd.testing.assert_frame_equal(
+        as_stored(departures).reset_index(drop=True),
+        as_stored(expected_departures).reset_index(drop=True),
+    )
+
+    assert len(expected_clusters) > 0
+    key = ["direction_id", "start", "dclass", "tst_median"]
+    pd.testing.assert_frame_equal(
+        as_stored(clusters).sort_values(key).reset_index(drop=True),
+        as_stored(expected_clusters).sort_values(key).reset_index(drop=True),
+    )
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_classify_events_matches_per_departure_classes(seed):
+    rng = np.random.default_rng(seed)
+    n = int(rng.integers(1, 200))
+    drst = rng.choice([0.0, 0.0, 1.0, np.nan], n)
+    # Speeds on the class boundaries included
+    mean_spd = np.where(
+        rng.random(n) < 0.3,
+        rng.choice([0.27, 0.83, 1.0, np.nan], n),
+        rng.exponential(0.8, n),
+    )
+    # Runs of events at the same stop, 0 when not at a stop
+    stop = np.repeat(rng.choice([0, 0, 1000001, 1000002, 1000003], n), rng.integers(1, 8, n))[:n]
+
+    sclass, dclass = classify_events(drst, mean_spd, stop)
+    expected_sclass, expected_dclass = reference_classify(
+        drst, mean_spd, np.where(stop == 0, np.nan, stop)
+    )
+
+    np.testing.assert_array_equal(sclass, expected_sclass)
+    np.testing.assert_array_equal(dclass, expected_dclass)
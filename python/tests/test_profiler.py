@@ -0,0 +1,122 @@
+import subprocess
+import sys
+import time
+from contextlib import asynccontextmanager
+
+import numpy as np
+import pytest
+from common import profiler as profiler_module
+from common.profiler import StageProfiler
+
+
+class FakeCursor:
+    def __init__(self, rows: list):
+        self.rows = rows
+
+    async def executemany(self, query, rows):
+        self.rows.extend(rows)
+
+
+class FakeConnection:
+    def __init__(self, rows: list):
+        self.rows = rows
+
+    @asynccontextmanager
+    async def cursor(self):
+        yield FakeCursor(self.rows)
+
+
+class FakePool:
+    def __init__(self, fail: bool = False):
+        self.rows = []
+        self.fail = fail
+
+    @asynccontextmanager
+    async def connection(self):
+        if self.fail:
+            raise ConnectionError("no database")
+        yield FakeConnection(self.rows)
+
+
+def test_stage_profiler_sums_calls_of_a_stage():
+    profiler = StageProfiler("test", enabled=True)
+    for _ in range(3):
+        with profiler.stage("load"):
+            time.sleep(0.01)
+    with profiler.stage("dbscan"):
+        with profiler.stage("features"):
+            pass
+
+    assert list(profiler.stages) == ["load", "features", "dbscan"]
+    assert profiler.stages["load"]["calls"] == 3
+    assert profiler.stages["load"]["wall_s"] >= 0.03
+    assert profiler.stages["dbscan"]["wall_s"] >= profiler.stages["features"]["wall_s"]
+
+
+def test_stage_profiler_records_a_stage_that_raises():
+    profiler = StageProfiler("test", enabled=True)
+    with pytest.raises(ValueError):
+        with profiler.stage("load"):
+            raise ValueError()
+    assert profiler.stages["load"]["calls"] == 1
+
+
+def test_stage_profiler_peak_rss_includes_memory_freed_in_the_stage():
+    profiler = StageProfiler("test", enabled=True)
+    with profiler.stage("dbscan"):
+        data = np.ones(64 * 1024 * 1024, dtype=np.uint8)
+        time.sleep(10 * profiler_module.RSS_SAMPLE_INTERVAL_S)
+        del data
+
+    stats = profiler.stages["dbscan"]
+    assert stats["rss_delta_mb"] > 48
+    assert stats["peak_rss_mb"] >= stats["rss_delta_mb"]
+
+
+def test_stage_profiler_counts_cpu_of_child_processes():
+    profiler = StageProfiler("test", enabled=True)
+    with profiler.stage("dbscan"):
+        subprocess.run(
+            [sys.executable, "-c", "import time\nend = time.process_time() + 0.3\nwhile time.process_time() < end: pass"],
+            check=True,
+        )
+    assert profiler.stages["dbscan"]["cpu_s"] >= 0.25
+
+
+@pytest.mark.asyncio
+async def test_disabled_stage_profiler_is_a_no_op(monkeypatch):
+    fake_pool = FakePool()
+    monkeypatch.setattr(profiler_module, "pool", fake_pool)
+    profiler = StageProfiler.disabled()
+    with profiler.stage("load"):
+        pass
+    await profiler.store()
+
+    assert profiler.stages == {}
+    assert fake_pool.rows == []
+
+
+@pytest.mark.asyncio
+async def test_stage_profiler_stores_one_row_per_stage(monkeypatch):
+    fake_pool = FakePool()
+    monkeypatch.setattr(profiler_module, "pool", fake_pool)
+    profiler = StageProfiler("recluster", route_id="1057", enabled=True)
+    with profiler.stage("load"):
+        pass
+    with profiler.stage("dbscan"):
+        pass
+    await profiler.store()
+
+    assert [(row["job"], row["route_id"], row["stage"], row["calls"]) for row in fake_pool.rows] == [
+        ("recluster", "1057", "load", 1),
+        ("recluster", "1057", "dbscan", 1),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_stage_profiler_store_does_not_fail_the_job(monkeypatch):
+    monkeypatch.setattr(profiler_module, "pool", FakePool(fail=True))
+    profiler = StageProfiler("recluster", enabled=True)
+    with profiler.stage("load"):
+        pass
+    await profiler.store()
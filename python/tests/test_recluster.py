@@ -0,0 +1,206 @@
+from datetime import date
+
+import numpy as np
+import pandas as pd
+import pytest
+from common import recluster
+from common.profiler import StageProfiler
+from common.recluster import (
+    RECLUSTER_GROUP_BY,
+    calculate_cluster_features,
+    fit_groups_cached,
+    get_window_days,
+    group_cache_key,
+    has_preview,
+    make_recluster_plan,
+    sample_recluster_plan,
+)
+from common.recluster_groups import fit_groups
+
+CLUSTER_ID_VARS = [*RECLUSTER_GROUP_BY, "cluster_on_reclustered_level"]
+
+
+def labelled_clusters(rng: np.random.Generator, n_rows: int) -> pd.DataFrame:
+    """
+    First level clusters with second level labels of several DBSCAN groups. The same
+    labels and departures occur in many groups, as labels are only unique within a group.
+    """
+    odays = pd.date_range("2025-05-01", periods=5).strftime("%Y-%m-%d")
+    oday = rng.choice(odays, n_rows)
+    return pd.DataFrame(
+        {
+            "route_id": rng.choice(["1001", "1002"], n_rows),
+            "direction_id": rng.integers(1, 3, n_rows),
+            "time_group": rng.choice(["1_AHT_6:30_9:00", "0_weekday_all"], n_rows),
+            "dclass": rng.choice(["arr", "dep", "pass"], n_rows),
+            "cluster_on_reclustered_level": rng.integers(0, 3, n_rows),
+            "oday": oday,
+            "start": rng.choice(["07:00:00", "07:30:00", "08:00:00"], n_rows),
+            "tst_median": [f"{d}T07:{m:02d}:00+03:00" for d, m in zip(oday, rng.integers(0, 60, n_rows))],
+            "lat_median": 60.17 + rng.normal(0, 0.001, n_rows),
+            "long_median": 24.94 + rng.normal(0, 0.001, n_rows),
+            "hdg_median": rng.integers(0, 360, n_rows).astype(float),
+            "weight": rng.integers(1, 30, n_rows),
+        }
+    )
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_calculate_cluster_features_grouped_matches_per_group(seed):
+    df = labelled_clusters(np.random.default_rng(seed), 600)
+
+    grouped = calculate_cluster_features(df, CLUSTER_ID_VARS, group_vars=RECLUSTER_GROUP_BY)
+    per_group = pd.concat(
+        [
+            calculate_cluster_features(group_df, CLUSTER_ID_VARS)
+            for _, group_df in df.groupby(RECLUSTER_GROUP_BY)
+        ]
+    )
+
+    assert len(grouped) == df.groupby(CLUSTER_ID_VARS).ngroups
+    pd.testing.assert_frame_equal(
+        grouped.sort_values(CLUSTER_ID_VARS).reset_index(drop=True),
+        per_group[grouped.columns].sort_values(CLUSTER_ID_VARS).reset_index(drop=True),
+    )
+
+
+def test_make_recluster_plan_adds_weekday_rows_to_0_weekday_all():
+    df = labelled_clusters(np.random.default_rng(0), 200)
+    df["time_group"] = np.random.default_rng(1).choice(
+        ["1_AHT_6:30_9:00", "4_weekday_other", "5_weekend"], len(df)
+    )
+    plan = make_recluster_plan(df)
+
+    time_group = RECLUSTER_GROUP_BY.index("time_group")
+    weekday_all = np.sort(
+        np.concatenate([idx for key, idx in plan if key[time_group] == "0_weekday_all"])
+    )
+    np.testing.assert_array_equal(weekday_all, np.flatnonzero(df["time_group"] != "5_weekend"))
+    # Every row is also in the group of its own time group
+    own = np.sort(np.concatenate([idx for key, idx in plan if key[time_group] != "0_weekday_all"]))
+    np.testing.assert_array_equal(own, np.arange(len(df)))
+
+
+def test_group_cache_key_addresses_the_group_content():
+    rng = np.random.default_rng(0)
+    coords = np.radians(60.17 + rng.normal(0, 0.001, (20, 2)))
+    weights = rng.integers(1, 30, 20)
+    key = ("1001", 1, "1_AHT_6:30_9:00", "arr")
+    cache_key = group_cache_key(key, coords, weights, 1e-6, 60)
+
+    assert cache_key == group_cache_key(key, coords.copy(), weights.astype(np.int32), 1e-6, 60)
+    changed_weights = weights.copy()
+    changed_weights[0] += 1
+    changed_coords = coords.copy()
+    changed_coords[0, 0] += 1e-9
+    assert len(
+        {
+            cache_key,
+            group_cache_key(("1001", 2, "1_AHT_6:30_9:00", "arr"), coords, weights, 1e-6, 60),
+            group_cache_key(key, changed_coords, weights, 1e-6, 60),
+            group_cache_key(key, coords, changed_weights, 1e-6, 60),
+            group_cache_key(key, coords[::-1], weights[::-1], 1e-6, 60),
+            group_cache_key(key, coords, weights, 2e-6, 60),
+            group_cache_key(key, coords, weights, 1e-6, 61),
+        }
+    ) == 7
+
+
+@pytest.mark.asyncio
+async def test_fit_groups_cached_fits_only_missing_groups(monkeypatch):
+    cache = {}
+    fitted_groups = []
+
+    async def load_group_labels(cache_keys):
+        return {k: cache[k] for k in cache_keys if k in cache}
+
+    async def store_group_labels(labels_by_key):
+        cache.update(labels_by_key)
+
+    async def counting_fit_groups(coords, weights, plan, *args, **kwargs):
+        fitted_groups.append(len(plan))
+        return await fit_groups(coords, weights, plan, *args, **kwargs)
+
+    monkeypatch.setattr(recluster, "RECLUSTER_GROUP_CACHE", True)
+    monkeypatch.setattr(recluster, "load_group_labels", load_group_labels)
+    monkeypatch.setattr(recluster, "store_group_labels", store_group_labels)
+    monkeypatch.setattr(recluster, "fit_groups", counting_fit_groups)
+
+    rng = np.random.default_rng(0)
+    df = labelled_clusters(rng, 400)
+    df["weight"] = np.where(df["route_id"] == "1002", 1, rng.integers(1, 15, len(df)))
+    plan = make_recluster_plan(df)
+    coords = np.radians(df[["lat_median", "long_median"]].to_numpy())
+    weights = df["weight"].to_numpy()
+    epsilon = 0.02 / 6371
+    profiler = StageProfiler.disabled()
+
+    expected = await fit_groups(coords, weights, plan, epsilon, 60, 1)
+    first = await fit_groups_cached(coords, weights, plan, epsilon, 60, profiler)
+    second = await fit_groups_cached(coords, weights, plan, epsilon, 60, profiler)
+
+    heavy = sum(weights[idx].sum() >= 60 for _, idx in plan)
+    assert 0 < heavy < len(plan)
+    # Groups too light to have clusters are not cached
+    assert len(cache) == heavy
+    assert fitted_groups == [len(plan), len(plan) - heavy]
+    for expected_labels, first_labels, second_labels in zip(expected, first, second):
+        np.testing.assert_array_equal(first_labels, expected_labels)
+        np.testing.assert_array_equal(second_labels, expected_labels)
+
+
+def test_get_window_days_sample_is_evenly_spaced():
+    days = get_window_days(date(2025, 5, 1), date(2025, 5, 28), [date(2025, 5, 2)], max_days=7)
+
+    assert len(days) == 7
+    assert days[0] == date(2025, 5, 1)
+    assert date(2025, 5, 2) not in days
+    assert all(3 <= (b - a).days <= 5 for a, b in zip(days, days[1:]))
+    assert get_window_days(date(2025, 5, 1), date(2025, 5, 3), [], max_days=7) == [
+        date(2025, 5, 1),
+        date(2025, 5, 2),
+        date(2025, 5, 3),
+    ]
+
+
+def test_has_preview_only_for_windows_longer_than_the_sample(monkeypatch):
+    monkeypatch.setattr(recluster, "RECLUSTER_PREVIEW_DAYS", 7)
+    assert not has_preview(date(2025, 5, 1), date(2025, 5, 7), [])
+    assert has_preview(date(2025, 5, 1), date(2025, 5, 8), [])
+    assert not has_preview(date(2025, 5, 1), date(2025, 5, 8), [date(2025, 5, 4)])
+
+
+def test_sample_recluster_plan_caps_rows_per_group():
+    rng = np.random.default_rng(0)
+    df = labelled_clusters(rng, 400)
+    plan = make_recluster_plan(df)
+    max_rows = 20
+    sample, sample_plan, sample_weights, fractions = sample_recluster_plan(df, plan, max_rows)
+
+    assert [key for key, _ in sample_plan] == [key for key, _ in plan]
+    assert len(fractions) == len(plan)
+    assert len(sample) == len(sample_weights) == sum(len(idx) for _, idx in sample_plan)
+    for (key, idx), (_, sample_idx), fraction in zip(plan, sample_plan, fractions["row_fraction"]):
+        rows = sample.iloc[sample_idx]
+        expected_rows = df.iloc[idx].reset_index(drop=True)
+        if len(idx) <= max_rows:
+            assert fraction == 1.0
+            pd.testing.assert_frame_equal(rows.reset_index(drop=True), expected_rows)
+        else:
+            assert len(sample_idx) == max_rows
+            assert fraction == max_rows / len(idx)
+            # Distinct rows of the group, in their original order
+            merged = rows.reset_index(drop=True).merge(expected_rows.reset_index(), how="left")
+            assert merged["index"].is_unique and merged["index"].is_monotonic_increasing
+        np.testing.assert_allclose(sample_weights[sample_idx], rows["weight"] / fraction)
+    assert (fractions["row_fraction"] < 1).any()
+    assert fractions[RECLUSTER_GROUP_BY].apply(tuple, axis=1).tolist() == [key for key, _ in plan]
+
+
+def test_sample_recluster_plan_is_reproducible():
+    df = labelled_clusters(np.random.default_rng(0), 400)
+    plan = make_recluster_plan(df)
+    first = sample_recluster_plan(df, plan, 20)
+    second = sample_recluster_plan(df, plan, 20)
+    pd.testing.assert_frame_equal(first[0], second[0])
+    np.testing.assert_array_equal(first[2], second[2])
@@ -0,0 +1,188 @@
+import numpy as np
+import pandas as pd
+import pytest
+from common import recluster_groups
+from common.recluster_groups import (
+    fit_groups,
+    make_batches,
+    make_group_plan,
+    plan_column,
+)
+
+EARTH_RADIUS_KM = 6371
+EPSILON = 0.02 / EARTH_RADIUS_KM
+MIN_WEIGHTED_SAMPLES = 60
+
+
+def random_clusters(rng: np.random.Generator, n_groups: int) -> pd.DataFrame:
+    """First level clusters of several groups around Helsinki, with dense spots and noise."""
+    frames = []
+    for group_no in range(n_groups):
+        n = int(rng.integers(1, 120))
+        centers = rng.normal([60.17, 24.94], 0.002, (3, 2))
+        coords = centers[rng.integers(0, 3, n)] + rng.normal(0, 0.0001, (n, 2))
+        frames.append(
+            pd.DataFrame(
+                {
+                    "route_id": str(1000 + group_no // 4),
+                    "direction_id": 1 + group_no % 2,
+                    "time_group": ["1_AHT_6:30_9:00", "5_weekend"][group_no // 2 % 2],
+                    "lat_median": coords[:, 0],
+                    "long_median": coords[:, 1],
+                    "weight": rng.integers(1, 15, n),
+                }
+            )
+        )
+    return pd.concat(frames, ignore_index=True)
+
+
+def test_make_batches_balances_costs():
+    batches = make_batches([5, 4, 3, 3, 2, 1], 2)
+    assert batches == [[0, 3, 5], [1, 2, 4]]
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_make_batches_assigns_every_item_once(seed):
+    rng = np.random.default_rng(seed)
+    costs = rng.integers(1, 1000, int(rng.integers(1, 200))).tolist()
+    n_batches = int(rng.integers(1, 20))
+    batches = make_batches(costs, n_batches)
+
+    assert len(batches) == min(n_batches, len(costs))
+    assert sorted(i for batch in batches for i in batch) == list(range(len(costs)))
+    loads = [sum(costs[i] for i in batch) for batch in batches]
+    assert loads == sorted(loads, reverse=True)
+    # Bound of assigning the most expensive item first to the least loaded batch
+    assert loads[0] <= sum(costs) / len(batches) + max(costs)
+
+
+def test_make_batches_with_more_batches_than_items():
+    assert make_batches([1, 2], 8) == [[1], [0]]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("seed", range(3))
+async def test_fit_groups_same_labels_with_every_backend(monkeypatch, seed):
+    rng = np.random.default_rng(seed)
+    clusters = random_clusters(rng, 24)
+    plan = make_group_plan(clusters, ["route_id", "direction_id", "time_group"])
+    coords = np.radians(clusters[["lat_median", "long_median"]].to_numpy())
+    weights = clusters["weight"].to_numpy()
+
+    serial = await fit_groups(coords, weights, plan, EPSILON, MIN_WEIGHTED_SAMPLES, 1)
+    monkeypatch.setattr(recluster_groups, "MIN_GROUPS_FOR_POOL", 1)
+    pooled = await fit_groups(coords, weights, plan, EPSILON, MIN_WEIGHTED_SAMPLES, 2)
+    kdtree = await fit_groups(
+        coords, weights, plan, EPSILON, MIN_WEIGHTED_SAMPLES, 1, backend="kdtree"
+    )
+
+    assert len(serial) == len(plan)
+    assert any((labels != -1).any() for labels in serial)
+    for (_, idx), serial_labels, pooled_labels, kdtree_labels in zip(plan, serial, pooled, kdtree):
+        assert len(serial_labels) == len(idx)
+        np.testing.assert_array_equal(serial_labels, pooled_labels)
+        np.testing.assert_array_equal(serial_labels, kdtree_labels)
+
+
+@pytest.mark.asyncio
+async def test_fit_groups_leaves_light_groups_as_noise():
+    clusters = pd.DataFrame(
+        {
+            "group": [0, 0, 0, 1, 1],
+            "lat_median": 60.17,
+            "long_median": 24.94,
+            "weight": [10, 10, 10, 40, 40],
+        }
+    )
+    plan = make_group_plan(clusters, ["group"])
+    coords = np.radians(clusters[["lat_median", "long_median"]].to_numpy())
+    labels = await fit_groups(
+        coords, clusters["weight"].to_numpy(), plan, EPSILON, MIN_WEIGHTED_SAMPLES, 1
+    )
+    np.testing.assert_array_equal(labels[0], [-1, -1, -1])
+    np.testing.assert_array_equal(labels[1], [0, 0])
+
+
+@pytest.mark.asyncio
+async def test_fit_groups_reports_progress(monkeypatch):
+    monkeypatch.setattr(recluster_groups, "PROGRESS_INTERVAL", 5)
+    clusters = random_clusters(np.random.default_rng(0), 24)
+    plan = make_group_plan(clusters, ["route_id", "direction_id", "time_group"])
+    reports = []
+
+    async def on_progress(done: int, total: int):
+        reports.append((done, total))
+
+    await fit_groups(
+        np.radians(clusters[["lat_median", "long_median"]].to_numpy()),
+        clusters["weight"].to_numpy(),
+        plan,
+        EPSILON,
+        MIN_WEIGHTED_SAMPLES,
+        1,
+        on_progress=on_progress,
+    )
+    assert reports
+    assert reports[-1][1] == len(plan)
+    assert [done for done, _ in reports] == sorted(done for done, _ in reports)
+
+
+@pytest.mark.asyncio
+async def test_fit_groups_unknown_backend():
+    with pytest.raises(ValueError):
+        await fit_groups(np.empty((0, 2)), np.empty(0), [], EPSILON, MIN_WEIGHTED_SAMPLES, 1, backend="gpu")
+
+
+def test_make_group_plan_sorted_keys_and_positions():
+    df = pd.DataFrame({"route_id": ["2", "1", "2", "1"], "dclass": ["arr", "dep", "arr", "arr"]})
+    plan = make_group_plan(df, ["route_id", "dclass"])
+
+    assert [key for key, _ in plan] == [("1", "arr"), ("1", "dep"), ("2", "arr")]
+    assert [idx.tolist() for _, idx in plan] == [[3], [1], [0, 2]]
+
+
+def test_make_group_plan_virtual_groups_share_rows():
+    df = pd.DataFrame(
+        {
+            "route_id": ["1", "1", "1", "1", "2"],
+            "time_group": ["1_AHT_6:30_9:00", "2_PT_9:00_15:00", "5_weekend", "2_PT_9:00_15:00", "5_weekend"],
+        }
+    )
+    weekday = ~df["time_group"].str.contains("weekend").to_numpy()
+    plan = make_group_plan(
+        df, ["route_id", "time_group"], virtual_groups=[("time_group", "0_weekday_all", weekday)]
+    )
+
+    assert [(key, idx.tolist()) for key, idx in plan] == [
+        (("1", "0_weekday_all"), [0, 1, 3]),
+        (("1", "1_AHT_6:30_9:00"), [0]),
+        (("1", "2_PT_9:00_15:00"), [1, 3]),
+        (("1", "5_weekend"), [2]),
+        (("2", "5_weekend"), [4]),
+    ]
+    assert plan_column(plan, ["route_id", "time_group"], "time_group").tolist() == [
+        "0_weekday_all",
+        "0_weekday_all",
+        "0_weekday_all",
+        "1_AHT_6:30_9:00",
+        "2_PT_9:00_15:00",
+        "2_PT_9:00_15:00",
+        "5_weekend",
+        "5_weekend",
+    ]
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_make_group_plan_virtual_group_equals_copied_rows(seed):
+    df = random_clusters(np.random.default_rng(seed), 12)
+    group_by = ["route_id", "direction_id", "time_group"]
+    weekday = (df["time_group"] != "5_weekend").to_numpy()
+    plan = make_group_plan(df, group_by, virtual_groups=[("time_group", "0_weekday_all", weekday)])
+
+    # The view gives the same groups as appending a relabelled copy of the weekday rows
+    copied = pd.concat([df, df[weekday].assign(time_group="0_weekday_all")], ignore_index=True)
+    copied_plan = make_group_plan(copied, group_by)
+    positions = np.concatenate([np.arange(len(df)), np.flatnonzero(weekday)])
+    assert [key for key, _ in plan] == [key for key, _ in copied_plan]
+    for (_, idx), (_, copied_idx) in zip(plan, copied_plan):
+        np.testing.assert_array_equal(idx, positions[copied_idx])
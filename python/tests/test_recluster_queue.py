@@ -0,0 +1,201 @@
+from contextlib import asynccontextmanager
+from datetime import date
+
+import pytest
+from common import recluster
+from common.enums import ReclusterStatus
+from common.recluster import (
+    canonicalize_recluster_payload,
+    dispatch_recluster_jobs,
+    estimate_recluster_cost,
+)
+
+
+class FakeCursor:
+    def __init__(self, rows=None, log=None):
+        self.rows = rows or []
+        self.log = log
+
+    async def fetchone(self):
+        return self.rows[0]
+
+    async def fetchall(self):
+        return self.rows
+
+    async def executemany(self, query, params_seq):
+        self.log.append((query, list(params_seq)))
+
+
+class FakeConnection:
+    """Answers the queries of the queue from the rows given, and logs every query."""
+
+    def __init__(self, active=(0, 0), queued=(), count=0):
+        self.active = active
+        self.queued = list(queued)
+        self.count = count
+        self.log = []
+
+    async def execute(self, query, params=None):
+        self.log.append((query, params))
+        if "pg_advisory_xact_lock" in query:
+            return FakeCursor()
+        if "status IN ('PENDING', 'RUNNING')" in query:
+            return FakeCursor([self.active])
+        if "status = 'QUEUED'" in query:
+            return FakeCursor(self.queued)
+        return FakeCursor([(self.count,)])
+
+    @asynccontextmanager
+    async def transaction(self):
+        yield
+
+    @asynccontextmanager
+    async def cursor(self):
+        yield FakeCursor(log=self.log)
+
+    def pending(self) -> list:
+        """Route ids of the jobs set PENDING, in order."""
+        return [
+            params["route_id"]
+            for query, params_seq in self.log
+            if "SET status = 'PENDING'" in query
+            for params in params_seq
+        ]
+
+
+class FakePool:
+    def __init__(self, conn: FakeConnection):
+        self.conn = conn
+
+    @asynccontextmanager
+    async def connection(self):
+        yield self.conn
+
+
+class FakeClient:
+    def __init__(self, fail: bool = False):
+        self.started = []
+        self.fail = fail
+
+    async def start_new(self, name, instance_id, payload):
+        if self.fail:
+            raise ConnectionError("durable functions host down")
+        self.started.append(payload)
+
+
+def queued_job(route_ids, cost, queue_payload=None):
+    return (route_ids, date(2025, 5, 1), date(2025, 5, 15), [], cost, queue_payload)
+
+
+@pytest.fixture
+def queue_limits(monkeypatch):
+    monkeypatch.setattr(recluster, "RECLUSTER_MAX_CONCURRENT_JOBS", 2)
+    monkeypatch.setattr(recluster, "RECLUSTER_MAX_RUNNING_COST", 100)
+
+
+def test_canonicalize_recluster_payload():
+    payload = {
+        "route_ids": [" 1070", "1057", "1070", "2550b", ""],
+        "from_oday": date(2025, 5, 1),
+        "to_oday": "2025-05-15",
+        "days_excluded": ["2025-05-03", date(2025, 5, 3), "2025-04-30", "2025-05-02"],
+        "preview": True,
+    }
+    canonical = canonicalize_recluster_payload(payload)
+
+    assert canonical == {
+        "route_ids": ["1057", "1070", "2550B"],
+        "from_oday": "2025-05-01",
+        "to_oday": "2025-05-15",
+        "days_excluded": ["2025-05-02", "2025-05-03"],
+        "preview": True,
+    }
+    assert canonicalize_recluster_payload(canonical) == canonical
+
+
+@pytest.mark.asyncio
+async def test_estimate_recluster_cost(monkeypatch):
+    conn = FakeConnection(count=42)
+    monkeypatch.setattr(recluster, "pool", FakePool(conn))
+
+    cost = await estimate_recluster_cost(
+        ["1057", "1070"], date(2025, 5, 1), date(2025, 5, 15), [date(2025, 5, 3)]
+    )
+
+    assert cost == 42
+    [(query, params)] = conn.log
+    assert "FROM delay.preprocess_clusters" in query
+    assert params == {
+        "from_oday": date(2025, 5, 1),
+        "to_oday": date(2025, 5, 15),
+        "route_id0": "1057",
+        "route_id1": "1070",
+        "exclude_dates": [date(2025, 5, 3)],
+    }
+
+
+@pytest.mark.asyncio
+async def test_dispatch_starts_entries_in_queue_order_within_limits(monkeypatch, queue_limits):
+    batch = {"scopes": [["1001"], ["1002"]], "from_oday": "2025-05-01", "to_oday": "2025-05-15"}
+    conn = FakeConnection(
+        queued=[
+            queued_job(["1001"], 30, batch),
+            queued_job(["1002"], 30, batch),
+            queued_job(["1003"], 30),
+            queued_job(["1004"], 10),
+        ]
+    )
+    monkeypatch.setattr(recluster, "pool", FakePool(conn))
+    client = FakeClient()
+
+    assert await dispatch_recluster_jobs(client) == 2
+    # The jobs of a batch are one entry started with its payload
+    assert client.started == [
+        batch,
+        {"route_ids": ["1003"], "from_oday": "2025-05-01", "to_oday": "2025-05-15", "days_excluded": []},
+    ]
+    assert conn.pending() == [["1001"], ["1002"], ["1003"]]
+
+
+@pytest.mark.asyncio
+async def test_dispatch_does_not_pass_a_large_entry_at_the_head(monkeypatch, queue_limits):
+    conn = FakeConnection(active=(1, 50), queued=[queued_job(["1001"], 80), queued_job(["1002"], 10)])
+    monkeypatch.setattr(recluster, "pool", FakePool(conn))
+    client = FakeClient()
+
+    assert await dispatch_recluster_jobs(client) == 0
+    assert conn.pending() == []
+
+
+@pytest.mark.asyncio
+async def test_dispatch_starts_a_large_entry_alone(monkeypatch, queue_limits):
+    conn = FakeConnection(queued=[queued_job(["1001"], 500), queued_job(["1002"], 10)])
+    monkeypatch.setattr(recluster, "pool", FakePool(conn))
+    client = FakeClient()
+
+    assert await dispatch_recluster_jobs(client) == 1
+    assert conn.pending() == [["1001"]]
+
+
+@pytest.mark.asyncio
+async def test_dispatch_nothing_when_all_slots_are_taken(monkeypatch, queue_limits):
+    conn = FakeConnection(active=(2, 20), queued=[queued_job(["1001"], 1)])
+    monkeypatch.setattr(recluster, "pool", FakePool(conn))
+
+    assert await dispatch_recluster_jobs(FakeClient()) == 0
+    assert not any("status = 'QUEUED'" in query for query, _ in conn.log)
+
+
+@pytest.mark.asyncio
+async def test_dispatch_queues_an_entry_again_if_it_cannot_be_started(monkeypatch, queue_limits):
+    conn = FakeConnection(queued=[queued_job(["1001"], 10)])
+    monkeypatch.setattr(recluster, "pool", FakePool(conn))
+    statuses = []
+
+    async def set_recluster_status(table, from_oday, to_oday, route_id, days_excluded, status):
+        statuses.append((route_id, status))
+
+    monkeypatch.setattr(recluster, "set_recluster_status", set_recluster_status)
+
+    assert await dispatch_recluster_jobs(FakeClient(fail=True)) == 0
+    assert statuses == [(["1001"], ReclusterStatus.QUEUED)]
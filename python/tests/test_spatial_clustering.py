@@ -0,0 +1,187 @@
+import numpy as np
+import pytest
+from common.spatial_clustering import (
+    match_nearest,
+    weighted_dbscan,
+    weighted_dbscan_sweep,
+)
+from sklearn.cluster import DBSCAN
+
+EARTH_RADIUS_KM = 6371
+EPSILON = 0.02 / EARTH_RADIUS_KM
+MIN_WEIGHTED_SAMPLES = 60
+
+# Helsinki, where the projection to EPSG:3067 is used
+CENTER = np.array([60.17, 24.94])
+
+
+def offset(center_deg: np.ndarray, distance_km: np.ndarray, bearing: np.ndarray) -> np.ndarray:
+    """Points at distance_km to the bearing (radians) from center_deg, in degrees."""
+    lat = np.radians(center_deg[0])
+    return np.column_stack(
+        [
+            center_deg[0] + np.degrees(distance_km * np.cos(bearing) / EARTH_RADIUS_KM),
+            center_deg[1]
+            + np.degrees(distance_km * np.sin(bearing) / (EARTH_RADIUS_KM * np.cos(lat))),
+        ]
+    )
+
+
+def random_groups(rng: np.random.Generator, n_groups: int) -> tuple:
+    """
+    Weighted points of several groups at the same places, so only the group keeps
+    them apart. Each group has dense spots around a few centers and scattered noise.
+    """
+    coords, weights, group_codes = [], [], []
+    for group_no in range(n_groups):
+        for _ in range(rng.integers(2, 6)):
+            center = CENTER + rng.normal(0, 0.002, 2)
+            n = int(rng.integers(5, 40))
+            coords.append(offset(center, rng.exponential(0.015, n), rng.uniform(0, 2 * np.pi, n)))
+        n_noise = int(rng.integers(10, 30))
+        coords.append(CENTER + rng.normal(0, 0.004, (n_noise, 2)))
+        n_group = sum(len(c) for c in coords) - len(group_codes)
+        weights.append(rng.integers(1, 40, n_group).astype(np.float64))
+        group_codes.append(np.full(n_group, group_no))
+    coords = np.radians(np.concatenate(coords))
+    group_codes = np.concatenate(group_codes)
+    # Groups are interleaved in the input, as rows of the plan are not sorted by group
+    order = rng.permutation(len(coords))
+    return coords[order], np.concatenate(weights)[order], group_codes[order]
+
+
+def sklearn_labels(
+    coords: np.ndarray,
+    weights: np.ndarray,
+    group_codes: np.ndarray,
+    epsilon: float,
+    min_weighted_samples: float,
+) -> np.ndarray:
+    """Labels of sklearn DBSCAN fitted separately for every group."""
+    labels = np.full(len(coords), -1, dtype=np.int64)
+    for group_no in np.unique(group_codes):
+        idx = np.flatnonzero(group_codes == group_no)
+        labels[idx] = DBSCAN(
+            eps=epsilon, min_samples=min_weighted_samples, metric="haversine"
+        ).fit_predict(coords[idx], sample_weight=weights[idx])
+    return labels
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_weighted_dbscan_matches_sklearn(seed):
+    coords, weights, group_codes = random_groups(np.random.default_rng(seed), 6)
+
+    labels = weighted_dbscan(
+        coords, weights, group_codes, EPSILON, MIN_WEIGHTED_SAMPLES, EARTH_RADIUS_KM
+    )
+
+    expected = sklearn_labels(coords, weights, group_codes, EPSILON, MIN_WEIGHTED_SAMPLES)
+    assert (expected != -1).any() and (expected == -1).any()
+    np.testing.assert_array_equal(labels, expected)
+
+
+def test_weighted_dbscan_border_point_of_two_clusters():
+    # Two clusters on a line west and east of a border point that is within eps of the
+    # nearest point of both but not core itself. The east cluster comes first in the
+    # input, so it gets label 0 and the border point joins it, like in sklearn.
+    distances_km = np.array([0.018, 0.030, 0.042])
+    east = offset(CENTER, distances_km, np.full(3, np.pi / 2))
+    west = offset(CENTER, distances_km, np.full(3, -np.pi / 2))
+    coords = np.radians(np.concatenate([east, CENTER.reshape(1, 2), west]))
+    weights = np.array([25.0, 40, 25, 5, 25, 40, 25])
+    group_codes = np.zeros(len(coords), dtype=np.int64)
+
+    labels = weighted_dbscan(
+        coords, weights, group_codes, EPSILON, MIN_WEIGHTED_SAMPLES, EARTH_RADIUS_KM
+    )
+
+    expected = sklearn_labels(coords, weights, group_codes, EPSILON, MIN_WEIGHTED_SAMPLES)
+    np.testing.assert_array_equal(expected, [0, 0, 0, 0, 1, 1, 1])
+    np.testing.assert_array_equal(labels, expected)
+
+
+@pytest.mark.parametrize("bearing_deg", range(0, 360, 15))
+def test_weighted_dbscan_pairs_at_epsilon(bearing_deg):
+    # Points just inside and just outside eps of the center in every direction: the
+    # projected candidate search with CANDIDATE_MARGIN must keep exactly the pairs sklearn
+    # finds by haversine.
+    distances_km = EPSILON * EARTH_RADIUS_KM * np.array([0.999, 1.001])
+    bearing = np.radians(np.array([bearing_deg, bearing_deg + 180]))
+    coords = np.radians(
+        np.concatenate([CENTER.reshape(1, 2), offset(CENTER, distances_km, bearing)])
+    )
+    # The center alone is not core, with the point inside eps it is
+    weights = np.array([40.0, 30, 30])
+    group_codes = np.zeros(3, dtype=np.int64)
+
+    labels = weighted_dbscan(
+        coords, weights, group_codes, EPSILON, MIN_WEIGHTED_SAMPLES, EARTH_RADIUS_KM
+    )
+
+    expected = sklearn_labels(coords, weights, group_codes, EPSILON, MIN_WEIGHTED_SAMPLES)
+    np.testing.assert_array_equal(expected, [0, 0, -1])
+    np.testing.assert_array_equal(labels, expected)
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_weighted_dbscan_sweep_matches_sklearn(seed):
+    coords, weights, group_codes = random_groups(np.random.default_rng(100 + seed), 4)
+    settings = [
+        (EPSILON, MIN_WEIGHTED_SAMPLES),
+        (EPSILON, 2 * MIN_WEIGHTED_SAMPLES),
+        (EPSILON / 2, MIN_WEIGHTED_SAMPLES),
+        (1.5 * EPSILON, 40),
+    ]
+
+    all_labels = weighted_dbscan_sweep(coords, weights, group_codes, settings, EARTH_RADIUS_KM)
+
+    assert len(all_labels) == len(settings)
+    for (epsilon, min_weighted_samples), labels in zip(settings, all_labels):
+        np.testing.assert_array_equal(
+            labels,
+            sklearn_labels(coords, weights, group_codes, epsilon, min_weighted_samples),
+        )
+
+
+def test_weighted_dbscan_empty():
+    assert len(weighted_dbscan(np.empty((0, 2)), np.empty(0), np.empty(0), EPSILON, 1, EARTH_RADIUS_KM)) == 0
+    assert weighted_dbscan_sweep(np.empty((0, 2)), np.empty(0), np.empty(0), [], EARTH_RADIUS_KM) == []
+
+
+def test_match_nearest_within_groups():
+    coords_a = offset(CENTER, np.array([0.0, 0.5, 1.0]), np.zeros(3))
+    # Each point b is 5 m east of a point a, in reverse order
+    coords_b = np.vstack(
+        [offset(point, np.array([0.005]), np.array([np.pi / 2])) for point in coords_a[::-1]]
+    )
+    idx_a, idx_b, distance = match_nearest(coords_a, np.zeros(3), coords_b, np.zeros(3), 20)
+
+    np.testing.assert_array_equal(idx_b, [0, 1, 2])
+    np.testing.assert_array_equal(idx_a, [2, 1, 0])
+    np.testing.assert_allclose(distance, 5, rtol=0.01)
+
+
+def test_match_nearest_not_across_groups_or_beyond_max_distance():
+    coords_a = np.vstack([CENTER, CENTER])
+    coords_b = offset(CENTER, np.array([0.005, 0.05]), np.array([0.0, 0.0]))
+    idx_a, idx_b, _ = match_nearest(coords_a, np.array([0, 1]), coords_b, np.array([1, 0]), 20)
+
+    # The second point b is in the group of the first point a but 50 m away
+    np.testing.assert_array_equal(idx_a, [1])
+    np.testing.assert_array_equal(idx_b, [0])
+
+
+def test_match_nearest_is_one_to_one():
+    coords_a = np.vstack([CENTER, offset(CENTER, np.array([1.0]), np.array([0.0]))])
+    coords_b = offset(CENTER, np.array([0.010, 0.003, 0.007]), np.array([0.0, np.pi, np.pi / 2]))
+    idx_a, idx_b, distance = match_nearest(coords_a, np.zeros(2), coords_b, np.zeros(3), 20)
+
+    # All points b are nearest to the first point a, and only the nearest of them is matched
+    np.testing.assert_array_equal(idx_a, [0])
+    np.testing.assert_array_equal(idx_b, [1])
+    np.testing.assert_allclose(distance, 3, rtol=0.01)
+
+
+def test_match_nearest_empty():
+    idx_a, idx_b, distance = match_nearest(np.empty((0, 2)), np.empty(0), CENTER[None], np.zeros(1), 20)
+    assert len(idx_a) == len(idx_b) == len(distance) == 0
@@ -0,0 +1,151 @@
+import asyncio
+import json
+from contextlib import asynccontextmanager
+from datetime import date
+
+import psycopg
+import pytest
+from api.services import hfp
+from api.services.hfp import ReclusterStatusListener
+
+KEY_A = {"route_id": "{1057}", "from_oday": "2025-05-01", "to_oday": "2025-05-15", "days_excluded": "{}"}
+KEY_B = {**KEY_A, "route_id": "{1070}"}
+
+
+class FakeNotify:
+    def __init__(self, payload: str):
+        self.payload = payload
+
+
+class FakeListenConnection:
+    """LISTEN connection whose notifications are put to a queue. An exception put to it is raised."""
+
+    def __init__(self):
+        self.queries = []
+        self.notifications: asyncio.Queue = asyncio.Queue()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def execute(self, query, params=None):
+        self.queries.append(query)
+
+    async def notifies(self):
+        while True:
+            notify = await self.notifications.get()
+            if isinstance(notify, Exception):
+                raise notify
+            yield notify
+
+    def notify(self, key: dict) -> None:
+        self.notifications.put_nowait(FakeNotify(json.dumps(key)))
+
+
+@pytest.fixture
+def listen_connections(monkeypatch):
+    """The LISTEN connections opened, in order."""
+    connections = []
+
+    async def connect(*args, **kwargs):
+        conn = FakeListenConnection()
+        connections.append(conn)
+        return conn
+
+    monkeypatch.setattr(hfp.psycopg.AsyncConnection, "connect", connect)
+    return connections
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+@pytest.mark.asyncio
+async def test_listener_fans_out_notifications_of_a_job(listen_connections):
+    listener = ReclusterStatusListener()
+    assert await listener.start()
+    assert await listener.start()
+
+    with listener.waiter(KEY_A) as a1, listener.waiter(KEY_A) as a2, listener.waiter(KEY_B) as b:
+        # Keys are matched regardless of the order of their fields
+        listen_connections[0].notify(dict(reversed(list(KEY_A.items()))))
+        await asyncio.wait_for(asyncio.gather(a1.wait(), a2.wait()), 1)
+        await settle()
+        assert not b.is_set()
+
+    assert len(listen_connections) == 1
+    assert listen_connections[0].queries == [f"LISTEN {hfp.RECLUSTER_STATUS_CHANNEL}"]
+    assert listener._waiters == {}
+    await listener.stop()
+
+
+@pytest.mark.asyncio
+async def test_listener_wakes_waiters_and_reconnects_after_losing_the_connection(listen_connections):
+    listener = ReclusterStatusListener()
+    assert await listener.start()
+
+    with listener.waiter(KEY_A) as notified:
+        listen_connections[0].notifications.put_nowait(psycopg.OperationalError("connection lost"))
+        await asyncio.wait_for(notified.wait(), 1)
+
+    assert await listener.start()
+    assert len(listen_connections) == 2
+    await listener.stop()
+
+
+@pytest.mark.asyncio
+async def test_listener_start_fails_without_connection(monkeypatch):
+    async def connect(*args, **kwargs):
+        raise psycopg.OperationalError("no database")
+
+    monkeypatch.setattr(hfp.psycopg.AsyncConnection, "connect", connect)
+    assert not await ReclusterStatusListener().start()
+
+
+class FakeKeyConnection:
+    async def execute(self, query, params):
+        return self
+
+    async def fetchone(self):
+        return "{" + ",".join(self.route_ids) + "}", "{}"
+
+
+@pytest.mark.asyncio
+async def test_wait_delay_analytics_status_returns_on_notification(monkeypatch, listen_connections):
+    listener = ReclusterStatusListener()
+    monkeypatch.setattr(hfp, "recluster_status_listener", listener)
+
+    @asynccontextmanager
+    async def connection():
+        conn = FakeKeyConnection()
+        conn.route_ids = ["1057"]
+        yield conn
+
+    monkeypatch.setattr(hfp.pool, "connection", connection)
+    statuses = [
+        {"status": "RUNNING", "progress": "1/2", "queue_position": None},
+        {"status": "DONE", "progress": None, "queue_position": None},
+    ]
+
+    async def get_delay_analytics_status(*args):
+        return statuses[0]
+
+    monkeypatch.setattr(hfp, "get_delay_analytics_status", get_delay_analytics_status)
+
+    async def finish():
+        while not listener._waiters:
+            await asyncio.sleep(0.01)
+        statuses.pop(0)
+        listen_connections[0].notify(KEY_A)
+
+    finishing = asyncio.create_task(finish())
+    job_status = await hfp.wait_delay_analytics_status(
+        ["1057"], date(2025, 5, 1), date(2025, 5, 15), [], "RUNNING", "1/2", timeout=5
+    )
+    await finishing
+
+    assert job_status["status"] == "DONE"
+    await listener.stop()